@@ -0,0 +1,527 @@
+"""Benchmark de punta a punta, sin red: Groq, GitHub, Supabase y Telegram simulados.
+
+Uso: python benchmarks/bench_e2e.py [--n 40] [--concurrencia 8] [--chats 8]
+                                    [--escenarios chat,codear,foto,autofix,imagina]
+                                    [--lat-groq 0.4] [--lat-github 0.08] [--lat-supabase 0.03]
+                                    [--lat-telegram 0.03] [--lat-imagen 1.0] [--prompts-distintos 0]
+                                    [--fallas 0.0] [--semilla 1]
+
+Cada escenario maneja los handlers reales de lia_bot.py (chat_texto, cmd_codear,
+handle_photo, cmd_imagina) y el WebhookHandler real (POST de un log de GCC -> trabajo de
+auto-fix) con `--concurrencia` pedidos en paralelo repartidos en `--chats` chats
+(los de un mismo chat se serializan, como en el bot). Los servicios externos son
+dobles en memoria con latencia configurable (el de imágenes es un servidor HTTP
+local de verdad, al que apunta IMAGEN_URL_BASE) (+-50% de jitter) y probabilidad de
+falla. Reporta p50/p95/p99 y la cantidad de llamadas externas por escenario.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import http.client
+import io
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+from github import GithubException
+from PIL import Image
+
+import lia_bot as L
+
+MAIN_C = """#include "gba.h"
+
+int main(void) {
+    REG_DISPCNT = MODE_3 | BG2_ENABLE;
+    for (int i = 0; i < SCREEN_W * SCREEN_H; i++) ((volatile u16*)VRAM)[i] = 0x7C00;
+    while (1) {}
+    return 0;
+}
+"""
+
+
+class ServicioCaido(Exception):
+    pass
+
+
+class Servicios:
+    """Latencia y fallas por servicio, y conteo de llamadas (servicio, operación)"""
+    def __init__(self, latencias, prob_falla, semilla):
+        self.latencias = latencias
+        self.prob_falla = prob_falla
+        self.rng = random.Random(semilla)
+        self.llamadas = Counter()
+        self.lock = threading.Lock()
+
+    def _registrar(self, servicio, op):
+        with self.lock:
+            self.llamadas[(servicio, op)] += 1
+            demora = self.latencias[servicio] * self.rng.uniform(0.5, 1.5)
+            falla = self.rng.random() < self.prob_falla
+        return demora, falla
+
+    def sync(self, servicio, op):
+        demora, falla = self._registrar(servicio, op)
+        time.sleep(demora)
+        if falla: raise ServicioCaido(f"{servicio}.{op} simuló una falla")
+
+    async def aio(self, servicio, op):
+        demora, falla = self._registrar(servicio, op)
+        await asyncio.sleep(demora)
+        if falla: raise ServicioCaido(f"{servicio}.{op} simuló una falla")
+
+
+# --- GROQ ---
+def responder_llm(messages):
+    """Respuesta guionada según el prompt: [[FILE]] para codear/auto-fix, texto para el chat"""
+    texto = messages[-1]["content"]
+    if "[MODO: SENIOR DEVELOPER GBA" in texto:
+        ruta = texto.split("[ARCHIVO OBJETIVO]")[1].split()[0]
+        return f"[[FILE: {ruta}]]\n{MAIN_C.replace('0x7C00', '0x03E0')}\n[[ENDFILE]]"
+    if "[MODO: SENIOR SOFTWARE ENGINEER]" in texto:
+        ruta = texto.split("[ERRORES REPORTADOS POR GCC/LD]")[1].split("- ")[1].split(":")[0]
+        return f"[[FILE: {ruta}]]\n{MAIN_C}\n[[ENDFILE]]"
+    return "Claro. En Mode 3 cada píxel es un u16 BGR555 en VRAM; " * 12
+
+
+class FakeGroq:
+    def __init__(self, svc):
+        self.svc = svc
+        self.chat = SimpleNamespace(completions=self)
+
+    async def create(self, model, messages, temperature, stream=False):
+        if not stream:
+            await self.svc.aio("groq", "completions")
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=responder_llm(messages)))],
+                                   usage=SimpleNamespace(prompt_tokens=L.contar_tokens(str(messages)), completion_tokens=200))
+        # Streaming: ~30% de la latencia hasta el primer token, el resto repartido en fragmentos
+        demora, falla = self.svc._registrar("groq", "completions_stream")
+        texto = responder_llm(messages)
+        trozos = [texto[i:i + 24] for i in range(0, len(texto), 24)]
+
+        async def fragmentos():
+            await asyncio.sleep(demora * 0.3)
+            if falla: raise ServicioCaido("groq.completions_stream simuló una falla")
+            for t in trozos:
+                await asyncio.sleep(demora * 0.7 / len(trozos))
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=t))])
+        return fragmentos()
+
+
+# --- GITHUB (GIT DATA API EN MEMORIA) ---
+def _sha(x):
+    return hashlib.sha1(repr(x).encode()).hexdigest()
+
+
+class FakeRef:
+    def __init__(self, repo, nombre):
+        self.repo, self.nombre = repo, nombre
+        self.object = SimpleNamespace(sha=repo.refs[nombre])
+
+    def edit(self, sha, force=False):
+        self.repo.svc.sync("github", "ref_edit")
+        with self.repo.lock:
+            actual = self.repo.refs[self.nombre]
+            # Igual que GitHub: sin force solo avanza si el commit nuevo desciende del actual
+            if not force and actual not in self.repo.objs[sha].padres:
+                raise GithubException(422, {"message": "Update is not a fast forward"}, None)
+            self.repo.refs[self.nombre] = sha
+            if self.nombre == "heads/main": self.repo.avances += 1
+
+
+class FakeRepo:
+    full_name = "kaia/bench"
+    default_branch = "main"
+
+    def __init__(self, svc, archivos):
+        self.svc = svc
+        self.lock = threading.Lock()
+        self.objs, self.refs = {}, {}
+        self.avances = 0  # commits que entraron a la rama (los backups van a otro ref)
+        arbol = {}
+        for ruta, contenido in archivos.items():
+            sha = L.sha_blob_git(contenido)
+            self.objs[sha] = contenido.encode()
+            arbol[ruta] = sha
+        self.refs["heads/main"] = self._commit("inicial", self._tree(arbol), []).sha
+
+    def _tree(self, arbol):
+        sha = _sha(sorted(arbol.items()))
+        self.objs[sha] = arbol
+        return SimpleNamespace(sha=sha)
+
+    def _commit(self, msg, arbol, padres):
+        commit = SimpleNamespace(sha=_sha((msg, arbol.sha, padres, time.time_ns())), tree=SimpleNamespace(sha=arbol.sha),
+                                 padres=[p.sha for p in padres])
+        self.objs[commit.sha] = commit
+        return commit
+
+    def _arbol_head(self):
+        return self.objs[self.objs[self.refs["heads/main"]].tree.sha]
+
+    def get_branch(self, rama):
+        self.svc.sync("github", "get_branch")
+        return SimpleNamespace(commit=SimpleNamespace(sha=self.refs[f"heads/{rama}"]))
+
+    def get_git_ref(self, nombre):
+        self.svc.sync("github", "get_git_ref")
+        if nombre not in self.refs: raise GithubException(404, {"message": "Not Found"}, None)
+        return FakeRef(self, nombre)
+
+    def create_git_ref(self, nombre, sha):
+        self.svc.sync("github", "create_git_ref")
+        self.refs[nombre[len("refs/"):]] = sha
+
+    def get_git_commit(self, sha):
+        self.svc.sync("github", "get_git_commit")
+        return self.objs[sha]
+
+    def get_git_tree(self, sha, recursive=False):
+        self.svc.sync("github", "get_git_tree")
+        arbol = self.objs[sha]
+        if not isinstance(arbol, dict): arbol = self.objs[arbol.tree.sha]  # GitHub acepta el sha de un commit
+        return SimpleNamespace(tree=[SimpleNamespace(path=p, sha=s, type="blob") for p, s in arbol.items()])
+
+    def get_git_blob(self, sha):
+        self.svc.sync("github", "get_git_blob")
+        return SimpleNamespace(content=base64.b64encode(self.objs[sha]).decode())
+
+    def create_git_blob(self, contenido, codificacion):
+        self.svc.sync("github", "create_git_blob")
+        datos = base64.b64decode(contenido)
+        sha = hashlib.sha1(b"blob %d\0" % len(datos) + datos).hexdigest()
+        self.objs[sha] = datos
+        return SimpleNamespace(sha=sha)
+
+    def create_git_tree(self, elementos, base_tree=None):
+        self.svc.sync("github", "create_git_tree")
+        arbol = dict(self.objs[base_tree.sha]) if base_tree else {}
+        for e in elementos:
+            d = e._identity
+            if "content" in d:
+                sha = L.sha_blob_git(d["content"])
+                self.objs[sha] = d["content"].encode()
+                arbol[d["path"]] = sha
+            elif d.get("sha") is None: arbol.pop(d["path"], None)
+            else: arbol[d["path"]] = d["sha"]
+        return self._tree(arbol)
+
+    def create_git_commit(self, msg, arbol, padres):
+        self.svc.sync("github", "create_git_commit")
+        return self._commit(msg, arbol, padres)
+
+    def get_contents(self, ruta):
+        self.svc.sync("github", "get_contents")
+        sha = self._arbol_head().get(ruta)
+        if sha is None: raise GithubException(404, {"message": "Not Found"}, None)
+        return SimpleNamespace(sha=sha, decoded_content=self.objs[sha])
+
+    def create_issue(self, **kw):
+        self.svc.sync("github", "create_issue")
+        return SimpleNamespace(html_url="https://example.invalid/issue/1")
+
+
+# --- SUPABASE ---
+class FakeConsulta:
+    def __init__(self, db, tabla):
+        self.db, self.tabla, self.op = db, tabla, "select"
+        self.filtros, self.fila, self.rango = [], None, None
+
+    def select(self, *_): return self
+    def order(self, *_): return self
+    def gte(self, col, valor): self.filtros.append(lambda f: str(f.get(col, "")) >= valor); return self
+    def eq(self, col, valor): self.filtros.append(lambda f: f.get(col) == valor); return self
+    def range(self, a, b): self.rango = (a, b + 1); return self
+    def insert(self, fila): self.op, self.fila = "insert", fila; return self
+    def update(self, fila): self.op, self.fila = "update", fila; return self
+
+    def execute(self):
+        self.db.svc.sync("supabase", f"{self.tabla}.{self.op}")
+        filas = self.db.tablas.setdefault(self.tabla, [])
+        with self.db.lock:
+            if self.op == "insert":
+                nueva = dict(self.fila, id=len(filas) + 1, created_at=f"2026-01-01T00:00:{len(filas):06d}")
+                filas.append(nueva)
+                return SimpleNamespace(data=[nueva])
+            elegidas = [f for f in filas if all(c(f) for c in self.filtros)]
+            if self.op == "update":
+                for f in elegidas: f.update(self.fila)
+            return SimpleNamespace(data=elegidas[slice(*self.rango)] if self.rango else elegidas)
+
+
+class FakeSupabase:
+    def __init__(self, svc):
+        self.svc, self.lock = svc, threading.Lock()
+        self.tablas = {
+            "memoria": [{"id": i, "contenido": f"Recuerdo {i}: sprites en OAM, paletas y modo {i % 5}",
+                         "created_at": f"2026-01-01T00:00:{i:06d}"} for i in range(1, 301)],
+            "tareas": [{"id": 1, "descripcion": "Pulir el HUD", "estado": "pendiente"}],
+        }
+
+    def table(self, nombre):
+        return FakeConsulta(self, nombre)
+
+
+# --- IMÁGENES ---
+def servidor_imagenes(svc, png):
+    """Servidor HTTP local que imita al generador de imágenes: cada GET tarda lat-imagen y devuelve un PNG"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            try: svc.sync("imagen", "generar")
+            except ServicioCaido:
+                self.send_response(502)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(png)))
+            self.end_headers()
+            self.wfile.write(png)
+
+        def log_message(self, *a): pass
+
+    servidor = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
+
+
+# --- TELEGRAM ---
+class FakeMensaje:
+    def __init__(self, svc, texto="", caption=None, foto=None, enviados=None):
+        self.svc, self.text, self.caption = svc, texto, caption
+        self.photo = [SimpleNamespace(file_id="foto")] if foto else []
+        self.document = None
+        self.enviados = [] if enviados is None else enviados  # todo lo que el bot le mostró a este chat
+
+    async def _api(self, metodo, texto=""):
+        await self.svc.aio("telegram", metodo)
+        if texto: self.enviados.append(texto)
+        return FakeMensaje(self.svc, texto, enviados=self.enviados)
+
+    async def reply_text(self, texto, parse_mode=None): return await self._api("sendMessage", texto)
+    async def reply_photo(self, photo, caption=None): return await self._api("sendPhoto")
+    async def reply_document(self, *a, **kw): return await self._api("sendDocument")
+    async def reply_chat_action(self, accion): return await self._api("sendChatAction")
+    async def edit_text(self, texto, parse_mode=None): return await self._api("editMessageText", texto)
+    async def delete(self): return await self._api("deleteMessage")
+
+
+class FakeBot:
+    def __init__(self, svc, foto):
+        self.svc, self.foto = svc, foto
+
+    async def get_file(self, file_id):
+        await self.svc.aio("telegram", "getFile")
+
+        async def bajar():
+            await self.svc.aio("telegram", "downloadFile")
+            return bytearray(self.foto)
+        return SimpleNamespace(download_as_bytearray=bajar)
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        await self.svc.aio("telegram", "sendMessage")
+
+
+def png_pixel_art(w=128, h=128):
+    y, x = np.mgrid[0:h, 0:w]
+    paleta = np.array([[0, 0, 0], [40, 40, 120], [80, 160, 80], [200, 200, 40], [255, 255, 255]], np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(paleta[((x // 8) + (y // 8)) % 5], "RGB").save(buf, format="PNG")
+    return buf.getvalue()
+
+
+# --- ESCENARIOS ---
+def percentil(valores, q):
+    xs = sorted(valores)
+    return xs[min(len(xs) - 1, int(round(q * (len(xs) - 1))))] if xs else float("nan")
+
+
+async def correr(n, concurrencia, pedido):
+    """Lanza n pedidos con a lo sumo `concurrencia` en vuelo. Devuelve (latencias, errores, segundos)"""
+    semaforo = asyncio.Semaphore(concurrencia)
+    latencias, errores = [], []
+
+    async def uno(i):
+        async with semaforo:
+            t0 = time.perf_counter()
+            try:
+                await pedido(i)
+                latencias.append(time.perf_counter() - t0)
+            except Exception as e: errores.append(f"{type(e).__name__}: {e}")
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(uno(i) for i in range(n)))
+    return latencias, errores, time.perf_counter() - t0
+
+
+class ChatDelDueno(int):
+    """id de chat propio (sesión y lock aparte) que pasa el filtro de dueño de handle_photo
+    (str(id) == MY_CHAT_ID): si no, con --chats > 1 casi todas las fotos serían no-ops"""
+    def __str__(self): return L.MY_CHAT_ID
+
+
+def update_y_context(svc, bot, texto="", args=(), caption=None, foto=False, chat=1):
+    mensaje = FakeMensaje(svc, texto, caption=caption, foto=foto)
+    update = SimpleNamespace(message=mensaje, effective_user=SimpleNamespace(first_name="Bench", id=chat),
+                             effective_chat=SimpleNamespace(id=chat))
+    return update, SimpleNamespace(args=list(args), bot=bot)
+
+
+def sin_errores(handler):
+    """El handler contesta los errores en vez de lanzarlos: un ❌ en el chat también es un pedido fallido"""
+    async def envuelto(update, context):
+        await handler(update, context)
+        fallo = next((t for t in update.message.enviados if "❌" in t), None)
+        if fallo: raise RuntimeError(fallo)
+    return envuelto
+
+
+def escenarios(svc, bot, puerto, chats, prompts_distintos):
+    # Igual que en __main__: cada update pasa por su sesión (un update a la vez por chat)
+    chat_texto, cmd_codear, handle_photo, cmd_imagina = (
+        sin_errores(L.en_sesion(f)) for f in (L.chat_texto, L.cmd_codear, L.handle_photo, L.cmd_imagina))
+
+    async def chat(i):
+        await chat_texto(*update_y_context(svc, bot, f"¿Cómo dibujo un sprite {i} en Mode 3 con OAM?", chat=1 + i % chats))
+
+    async def codear(i):
+        await cmd_codear(*update_y_context(svc, bot, args=f"pinta el fondo verde en src/mod_{i}.c".split(), chat=1 + i % chats))
+
+    async def foto(i):
+        await handle_photo(*update_y_context(svc, bot, caption="", foto=True, chat=ChatDelDueno(1 + i % chats)))
+
+    async def autofix(i):
+        log = f"src/mod_{i}.c:4:5: error: 'REG_DISPCNT{i}' undeclared (first use in this function)\nmake: *** [build] Error 1"
+
+        def post():
+            con = http.client.HTTPConnection("127.0.0.1", puerto, timeout=30)
+            con.request("POST", "/", body=log.encode(), headers={"Content-Type": "text/plain", "Authorization": f"Bearer {L.CI_WEBHOOK_TOKEN}"})
+            r = con.getresponse()
+            cuerpo = r.read()
+            con.close()
+            if r.status != 202: raise RuntimeError(f"webhook respondió {r.status}: {cuerpo[:80]}")
+            return json.loads(cuerpo)["job"]
+
+        trabajo = await asyncio.to_thread(post)
+        while True:
+            estado = (await asyncio.to_thread(L.estado_compartido.trabajos, trabajo) or [{}])[0]
+            if estado.get("estado") not in ("en_cola", "procesando"): break
+            await asyncio.sleep(0.01)
+        if estado.get("estado") != "ok": raise RuntimeError(f"trabajo {estado.get('estado')}: {estado.get('resultado')}")
+
+    async def imagina(i):
+        # Con --prompts-distintos k se repiten k prompts (misma seed): prueba la fusión en vuelo y el cache
+        variante = i % prompts_distintos if prompts_distintos else i
+        await cmd_imagina(*update_y_context(svc, bot, args=["castillo", "pixel", str(variante), "seed=7", "size=256x256"], chat=1 + i % chats))
+
+    return {"chat": chat, "codear": codear, "foto": foto, "autofix": autofix, "imagina": imagina}
+
+
+def preparar(args, svc, tmp):
+    """Apunta los globals de lia_bot a los dobles. Cada escenario arranca con caches frías."""
+    archivos = {"Makefile": "all:\n\tmake -f gba.mk\n", "include/gba.h": "#define MODE_3 0x0003\n", "src/main.c": MAIN_C}
+    archivos.update({f"src/mod_{i}.c": MAIN_C for i in range(args.n)})
+    repo = FakeRepo(svc, archivos)
+    L.repo_defecto = L.Perezoso("repo", lambda: repo)
+    # Si el doble no sirve para armar el índice, todo lo medido sería el camino de error
+    if L._revalidar_mapa_repo(repo) is None: sys.exit("❌ FakeRepo: no se pudo armar el índice del repo")
+    L.supabase = FakeSupabase(svc)
+    L.indice_memoria = L.IndiceMemoria(os.path.join(tmp, f"memoria_{time.time_ns()}.db"))
+    L.estado_compartido = L.EstadoCompartido(os.path.join(tmp, f"estado_{time.time_ns()}.db"), "bench", L.LIDER_TTL_SEG)
+    L.sesiones = L.Sesiones(L.SESIONES_MAX, L.SESION_IDLE_SEG)
+    L.motor_llm = L.MotorLLM(FakeGroq(svc), L.LLM_MAX_CONCURRENCIA, L.LLM_TIMEOUT)
+    L.mapas_repo.clear()  # después del chequeo: cada escenario arranca con el índice frío
+    L.cache_contenidos = L.CacheContenidos(L.cache_contenidos.max_bytes)
+    L.estado_backups.update(commit=None, indice={})
+    L.limpiar_historial_fixes()
+    L.generador_imagenes = L.GeneradorImagenes(L.IMAGEN_MAX_CONCURRENCIA, L.generador_imagenes.max_bytes)
+    return repo
+
+
+ESCENARIOS_CON_COMMIT = ("codear", "foto", "autofix")
+
+
+async def principal(args):
+    latencias = {"groq": args.lat_groq, "github": args.lat_github, "supabase": args.lat_supabase,
+                 "telegram": args.lat_telegram, "imagen": args.lat_imagen}
+    svc = Servicios(latencias, args.fallas, args.semilla)
+    bot = FakeBot(svc, png_pixel_art())
+    L.MY_CHAT_ID = "1"
+    L.CI_WEBHOOK_TOKEN = "bench"  # sin token el webhook del CI no acepta logs
+    L.global_app_loop = asyncio.get_running_loop()
+    L.app = SimpleNamespace(bot=bot)
+    L.STREAM_INTERVALO_SEG = 0.25
+
+    servidor = ThreadingHTTPServer(("127.0.0.1", 0), L.WebhookHandler)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    imagenes = servidor_imagenes(svc, png_pixel_art())
+    L.IMAGEN_URL_BASE = f"http://127.0.0.1:{imagenes.server_port}/prompt/"
+    todos = escenarios(svc, bot, servidor.server_port, args.chats or args.concurrencia, args.prompts_distintos)
+
+    resultados = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for nombre in args.escenarios.split(","):
+            repo = preparar(args, svc, tmp)
+            svc.llamadas.clear()
+            lat, errores, total = await correr(args.n, args.concurrencia, todos[nombre])
+            # Los backups se escriben en hilos aparte: se esperan para contarlos en su escenario
+            while any(getattr(t, "_target", None) is L.guardar_backups for t in threading.enumerate()):
+                await asyncio.sleep(0.01)
+            # Cada pedido ok de estos escenarios es un commit en la rama: si el ref no avanzó, no lo fue
+            if nombre in ESCENARIOS_CON_COMMIT and repo.avances < len(lat):
+                errores += [f"ref sin avanzar: {repo.avances} commit(s) para {len(lat)} pedido(s) ok"] * (len(lat) - repo.avances)
+            resultados.append((nombre, lat, errores, total, Counter(svc.llamadas)))
+            # Sin fallas simuladas, un índice que no se pudo armar es un bug del doble o del bot
+            fallidas = sum(v for k, v in L.metricas.contadores.get("lia_externo_total", {}).items()
+                           if dict(k).get("op") in ("head", "arbol") and dict(k).get("resultado") == "error")
+            if fallidas and not args.fallas: sys.exit(f"❌ {nombre}: {fallidas} lectura(s) del índice del repo fallaron")
+    servidor.shutdown()
+    imagenes.shutdown()
+    if L.http_async: await L.http_async.aclose()
+
+    print(f"\nconcurrencia={args.concurrencia} n={args.n} latencias={latencias} fallas={args.fallas:.0%}\n")
+    print(f"{'escenario':>10} {'ok':>4} {'err':>4} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>7}")
+    for nombre, lat, errores, total, _ in resultados:
+        p = [percentil(lat, q) * 1e3 for q in (0.5, 0.95, 0.99)]
+        print(f"{nombre:>10} {args.n - len(errores):>4} {len(errores):>4} {p[0]:>8.0f} {p[1]:>8.0f} {p[2]:>8.0f} {args.n / total:>7.1f}")
+    for nombre, lat, errores, total, llamadas in resultados:
+        print(f"\n[{nombre}] llamadas externas por pedido:")
+        for (servicio, op), cuantas in sorted(llamadas.items()):
+            print(f"  {servicio:>9}.{op:<22} {cuantas:>5}  ({cuantas / args.n:.2f}/pedido)")
+        for e, veces in Counter(errores).most_common(3): print(f"  error x{veces}: {e[:100]}")
+    fallidos = sum(len(errores) for _, _, errores, _, _ in resultados)
+    if fallidos and not args.fallas: sys.exit(f"❌ {fallidos} pedido(s) fallaron sin fallas simuladas")
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--n", type=int, default=40, help="pedidos por escenario")
+    p.add_argument("--concurrencia", type=int, default=8)
+    p.add_argument("--chats", type=int, default=0, help="chats distintos (0 = uno por pedido en vuelo)")
+    p.add_argument("--escenarios", default="chat,codear,foto,autofix")
+    p.add_argument("--lat-groq", type=float, default=0.4)
+    p.add_argument("--lat-github", type=float, default=0.08)
+    p.add_argument("--lat-supabase", type=float, default=0.03)
+    p.add_argument("--lat-telegram", type=float, default=0.03)
+    p.add_argument("--lat-imagen", type=float, default=1.0)
+    p.add_argument("--prompts-distintos", type=int, default=0, help="imagina: 0 = todos distintos")
+    p.add_argument("--fallas", type=float, default=0.0, help="probabilidad de falla por llamada externa")
+    p.add_argument("--semilla", type=int, default=1)
+    args = p.parse_args()
+    logging.disable(logging.CRITICAL)
+    asyncio.run(principal(args))
+
+
+if __name__ == "__main__":
+    main()
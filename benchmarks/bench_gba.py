@@ -0,0 +1,95 @@
+"""Micro-benchmark del convertidor de imágenes a GBA.
+
+Uso: python benchmarks/bench_gba.py [repeticiones]
+Mide píxeles/segundo de convertir_imagen_a_gba para tamaños típicos
+(sprite 64x64, fondo 240x160 y un mapa de 1024x1024) y lo compara con
+el bucle píxel a píxel original. También mide la exportación binaria
+comprimida (LZ77/RLE de la BIOS) y verifica que descomprima idéntico.
+"""
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+from PIL import Image
+
+from lia_bot import COMPRESIONES_GBA, convertir_imagen_a_gba, generar_tiles_gba
+
+TAMANOS = [(64, 64), (240, 160), (1024, 1024)]
+
+
+def convertir_legacy(image_bytes, nombre="sprite"):
+    """Versión original (bucle + concatenación) como referencia"""
+    img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    w, h = img.size
+    hex_data = []
+    rgb = img.tobytes()
+    for r, g, b in zip(rgb[0::3], rgb[1::3], rgb[2::3]):
+        hex_data.append(f"0x{((b >> 3) << 10) | ((g >> 3) << 5) | (r >> 3):04X}")
+    c_code = (
+        f"// Generado por Lia Art Studio\n"
+        f"// Dimensiones: {w}x{h}\n"
+        f"const unsigned short {nombre}_data[{w * h}] = {{\n"
+    )
+    for i in range(0, len(hex_data), 8):
+        c_code += f"    {', '.join(hex_data[i:i+8])},\n"
+    c_code += "};\n"
+    return c_code
+
+
+def imagen_png(w, h):
+    rng = np.random.default_rng(w * h)
+    img = Image.fromarray(rng.integers(0, 256, (h, w, 3), dtype=np.uint8), "RGB")
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def imagen_pixel_art(w, h):
+    """Anillos de 6 colores planos: se parece más a un fondo real que el ruido"""
+    y, x = np.mgrid[0:h, 0:w]
+    paleta = np.array([[0, 0, 0], [40, 40, 120], [80, 160, 80], [200, 200, 40], [220, 80, 60], [255, 255, 255]], np.uint8)
+    return Image.fromarray(paleta[((x - w // 2) ** 2 + (y - h // 2) ** 2) // 256 % 6], "RGB")
+
+
+def medir(fn, datos, reps):
+    mejor = float("inf")
+    for _ in range(reps):
+        t0 = time.perf_counter()
+        fn(datos)
+        mejor = min(mejor, time.perf_counter() - t0)
+    return mejor
+
+
+def main():
+    reps = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    print(f"{'tamaño':>10} {'nuevo (ms)':>11} {'Mpx/s':>8} {'legacy (ms)':>12} {'Mpx/s':>8} {'x':>6}")
+    for w, h in TAMANOS:
+        datos = imagen_png(w, h)
+        assert convertir_imagen_a_gba(datos)[0] == convertir_legacy(datos), "salida distinta"
+        nuevo = medir(convertir_imagen_a_gba, datos, reps)
+        legacy = medir(convertir_legacy, datos, 1 if w * h > 100_000 else reps)
+        px = w * h / 1e6
+        print(f"{f'{w}x{h}':>10} {nuevo * 1e3:>11.2f} {px / nuevo:>8.2f} "
+              f"{legacy * 1e3:>12.2f} {px / legacy:>8.2f} {legacy / nuevo:>6.1f}")
+
+    # Tiles 4bpp de un fondo con pocos colores (caso típico de pixel art)
+    print(f"\n{'tamaño':>10} {'formato':>8} {'bytes':>9} {'ratio':>6} {'comp (ms)':>10} {'desc (ms)':>10}")
+    for w, h in TAMANOS[:2]:
+        img = imagen_pixel_art(w, h)
+        crudo = generar_tiles_gba(img, 4, "bg")[0].tobytes()
+        for nombre, (_, comprimir, descomprimir, _) in COMPRESIONES_GBA.items():
+            t0 = time.perf_counter()
+            blob = comprimir(crudo)
+            t1 = time.perf_counter()
+            assert descomprimir(blob) == crudo, f"round-trip {nombre} falló"
+            t2 = time.perf_counter()
+            print(f"{f'{w}x{h}':>10} {nombre:>8} {len(blob):>9} {len(crudo) / max(1, len(blob)):>6.2f} "
+                  f"{(t1 - t0) * 1e3:>10.2f} {(t2 - t1) * 1e3:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
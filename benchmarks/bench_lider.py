@@ -0,0 +1,114 @@
+"""Failover del lease de los cron entre réplicas: procesos reales y un SQLite compartido.
+
+Uso: python benchmarks/bench_lider.py [--replicas 3] [--ttl 1.5] [--segundos 8] [--tick 0.1]
+
+Lanza N procesos que importan lia_bot y hacen lo mismo que el scheduler del bot:
+renuevan el lease cada TTL/3 y, en cada tick, "disparan" un cron con el mismo
+chequeo que solo_lider (¿soy líder? + reclamo del horario). A mitad de la corrida
+mata a la líder con SIGKILL (sin liberar el lease) y después apaga otra con
+liberar(). Verifica que ningún tick corrió dos veces y mide cuánto tardó otra
+réplica en tomar los cron en cada caso.
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, RAIZ)
+
+
+def replica(db, ttl, tick):
+    """Proceso hijo: imprime 'corrio <tick> <instancia> <t>' cada vez que le toca un cron"""
+    import lia_bot as L
+    estado = L.EstadoCompartido(db, f"replica-{os.getpid()}", ttl)
+    signal.signal(signal.SIGTERM, lambda *_: (estado.liberar(), os._exit(0)))
+
+    def renovar():
+        while True:
+            estado.renovar()
+            time.sleep(ttl / 3)
+
+    threading.Thread(target=renovar, daemon=True).start()
+    while True:
+        n = int(time.time() / tick)
+        if estado.soy_lider() and estado.reclamar(f"tick:{n}"):
+            print(f"corrio {n} {estado.instancia} {time.time():.3f}", flush=True)
+        time.sleep(tick - time.time() % tick + 0.001)
+
+
+def lanzar(args, db):
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), "--hijo", db, "--ttl", str(args.ttl), "--tick", str(args.tick)],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, cwd=RAIZ)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--replicas", type=int, default=3)
+    p.add_argument("--ttl", type=float, default=1.5)
+    p.add_argument("--segundos", type=float, default=8)
+    p.add_argument("--tick", type=float, default=0.1)
+    p.add_argument("--hijo")
+    args = p.parse_args()
+    if args.hijo: return replica(args.hijo, args.ttl, args.tick)
+
+    corridas = []  # (tick, instancia, t)
+    lock = threading.Lock()
+
+    def leer(proc):
+        for linea in proc.stdout:
+            _, n, inst, t = linea.split()
+            with lock: corridas.append((int(n), inst, float(t)))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = os.path.join(tmp, "estado.db")
+        procs = [lanzar(args, db) for _ in range(args.replicas)]
+        hilos = [threading.Thread(target=leer, args=(pr,), daemon=True) for pr in procs]
+        for h in hilos: h.start()
+
+        def lider_actual():
+            with lock: return corridas[-1][1] if corridas else None
+
+        def proceso(instancia):
+            return next(pr for pr in procs if f"replica-{pr.pid}" == instancia)
+
+        eventos = []
+        time.sleep(args.segundos / 3)
+        for modo in ("SIGKILL", "SIGTERM"):
+            vivos = [pr for pr in procs if pr.poll() is None]
+            if len(vivos) < 2: break
+            victima = lider_actual()
+            pr = proceso(victima)
+            t0 = time.time()
+            if modo == "SIGKILL": pr.kill()
+            else: pr.terminate()
+            pr.wait()
+            while time.time() - t0 < args.ttl * 3:
+                with lock: despues = [c for c in corridas if c[2] > t0 and c[1] != victima]
+                if despues: break
+                time.sleep(0.01)
+            eventos.append((modo, victima, despues[0][2] - t0 if despues else float("nan")))
+            time.sleep(args.segundos / 3)
+
+        for pr in procs:
+            if pr.poll() is None: pr.terminate()
+        for pr in procs: pr.wait()
+
+    repetidos = [n for n, k in Counter(n for n, _, _ in corridas).items() if k > 1]
+    ticks = sorted({n for n, _, _ in corridas})
+    huecos = (ticks[-1] - ticks[0] + 1 - len(ticks)) if ticks else 0
+    print(f"réplicas={len(procs)} ttl={args.ttl}s tick={args.tick}s")
+    print(f"corridas={len(corridas)} repetidas={len(repetidos)} ticks sin líder={huecos}")
+    print(f"por réplica: {dict(Counter(i for _, i, _ in corridas))}")
+    for modo, victima, seg in eventos:
+        print(f"{modo:>8} a {victima}: otra réplica corre el cron a los {seg:.2f}s")
+    if repetidos: sys.exit(f"❌ ticks corridos más de una vez: {repetidos[:10]}")
+
+
+if __name__ == "__main__":
+    main()
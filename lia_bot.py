@@ -1,28 +1,41 @@
+import time
+T_ARRANQUE = time.perf_counter()
 import os
-import sys
 import io
 import asyncio
 import threading
+import contextvars
 import random
 import logging
-import requests
 import re
 import json
-import time
+import hashlib
+import hmac
+import sqlite3
+import signal
+import socket
+import unicodedata
+import uuid
+import urllib.parse
+import base64
+import struct
 from datetime import datetime
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import pytz 
-from bs4 import BeautifulSoup
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import httpx
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from telegram import Update
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
-from groq import Groq
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-import edge_tts
-from supabase import create_client, Client
-from github import Github, Auth 
-from PIL import Image, ImageOps
 import io
 import html  # <--- IMPORTANTE: Necesario para limpiar el código
+# groq, supabase, github, edge_tts, numpy, bs4 y apscheduler pesan ~1s en frío:
+# se importan recién donde se usan (ver CLIENTES PEREZOSOS)
+tiempos_arranque = {"imports": time.perf_counter() - T_ARRANQUE}  # fase -> segundos desde T_ARRANQUE
+bot_listo = threading.Event()  # señal de readiness: el bot ya está escuchando a Telegram
+
 # --- LOGS ---
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -30,41 +43,485 @@ logger = logging.getLogger(__name__)
 # --- ENV ---
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL")  # p. ej. https://lia.onrender.com -> modo webhook en vez de polling
+TELEGRAM_WEBHOOK_SECRETO = os.getenv("TELEGRAM_WEBHOOK_SECRETO") or (hashlib.sha256(TELEGRAM_TOKEN.encode()).hexdigest()[:32] if TELEGRAM_TOKEN else "")
+WEBHOOK_RUTA = "/telegram"
+ESTADO_DB = os.getenv("ESTADO_DB", "estado_compartido.db")  # SQLite que comparten las réplicas (mismo host o volumen)
+INSTANCIA_ID = os.getenv("INSTANCIA_ID") or f"{socket.gethostname()}-{os.getpid()}"
+LIDER_TTL_SEG = float(os.getenv("LIDER_TTL_SEG", "30"))
 MY_CHAT_ID = os.getenv("MY_CHAT_ID")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 GITHUB_REPO = os.getenv("GITHUB_REPO") or os.getenv("REPO_NAME")
+LLM_MAX_CONCURRENCIA = int(os.getenv("LLM_MAX_CONCURRENCIA", "4"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "90"))
+MEMORIA_DB = os.getenv("MEMORIA_DB", "memoria_local.db")
+MEMORIA_SYNC_SEG = float(os.getenv("MEMORIA_SYNC_SEG", "60"))
+PROMPT_TOKENS_MAX = int(os.getenv("PROMPT_TOKENS_MAX", "6000"))
+TTS_VOZ = os.getenv("TTS_VOZ", "es-MX-DaliaNeural")
+TTS_RATE = os.getenv("TTS_RATE", "+10%")
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", ".cache_tts")
+TTS_CACHE_MAX_MB = float(os.getenv("TTS_CACHE_MAX_MB", "50"))
+ASSETS_TTL_SEG = float(os.getenv("ASSETS_TTL_SEG", "1800"))
+REVIEW_CHUNK_CHARS = int(os.getenv("REVIEW_CHUNK_CHARS", "6000"))
+REVIEW_MAX_PARALELO = int(os.getenv("REVIEW_MAX_PARALELO", str(max(1, LLM_MAX_CONCURRENCIA // 2))))  # un /review grande no acapara el motor
+STREAM_INTERVALO_SEG = float(os.getenv("STREAM_INTERVALO_SEG", "1.2"))  # mínimo entre ediciones de Telegram
+BACKUP_REF = os.getenv("BACKUP_REF", "lia/backups")  # refs/lia/backups: fuera de cualquier rama
+BACKUP_MAX_VERSIONES = int(os.getenv("BACKUP_MAX_VERSIONES", "10"))
+BACKUP_MAX_DIAS = float(os.getenv("BACKUP_MAX_DIAS", "30"))
+METRICAS_GITHUB_MIN = float(os.getenv("METRICAS_GITHUB_MIN", "30"))  # refresco de seguidores/estrellas
+CACHE_ARCHIVOS_MB = float(os.getenv("CACHE_ARCHIVOS_MB", "32"))
+IMAGEN_URL_BASE = os.getenv("IMAGEN_URL_BASE", "https://image.pollinations.ai/prompt/")
+IMAGEN_MAX_CONCURRENCIA = int(os.getenv("IMAGEN_MAX_CONCURRENCIA", "2"))
+IMAGEN_TIMEOUT = float(os.getenv("IMAGEN_TIMEOUT", "60"))
+IMAGEN_CACHE_MB = float(os.getenv("IMAGEN_CACHE_MB", "64"))
+CI_WEBHOOK_TOKEN = os.getenv("CI_WEBHOOK_TOKEN", "")  # el CI lo manda en 'Authorization: Bearer ...'
+AUTOFIX_WORKERS = int(os.getenv("AUTOFIX_WORKERS", "2"))
+AUTOFIX_COLA_MAX = int(os.getenv("AUTOFIX_COLA_MAX", "20"))
+AUTOFIX_VENTANA_SEG = float(os.getenv("AUTOFIX_VENTANA_SEG", "900"))
+AUTOFIX_MAX_INTENTOS = int(os.getenv("AUTOFIX_MAX_INTENTOS", "3"))
+AUTOFIX_BACKOFF_SEG = float(os.getenv("AUTOFIX_BACKOFF_SEG", "60"))
+AUTOFIX_CONTEXTO_LINEAS = int(os.getenv("AUTOFIX_CONTEXTO_LINEAS", "12"))
+AUTOFIX_LINEAS_COMPLETO = int(os.getenv("AUTOFIX_LINEAS_COMPLETO", "150"))
+COMMIT_INTENTOS = int(os.getenv("COMMIT_INTENTOS", "5"))
+COMMIT_BACKOFF_SEG = float(os.getenv("COMMIT_BACKOFF_SEG", "0.5"))  # base del backoff exponencial entre reintentos
+
+# --- MÉTRICAS (TEXTO PROMETHEUS EN /metrics) ---
+BUCKETS_SEG = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+def _etiquetas(pares):
+    if not pares: return ""
+    valores = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pares)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pares, valores)) + "}"
+
+class Metricas:
+    """Contadores e histogramas con etiquetas, thread-safe, sin dependencias.
+    Los valores que ya viven en otro lado (caches, cuota de GitHub) se leen al exportar."""
+    def __init__(self, buckets=BUCKETS_SEG):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.contadores = {}   # nombre -> {etiquetas: valor}
+        self.histogramas = {}  # nombre -> {etiquetas: [conteos acumulados por bucket, suma, total]}
+        self.lecturas = {}     # nombre -> (tipo, fn() -> [(dict etiquetas, valor)])
+
+    def sumar(self, nombre, valor=1, **etiquetas):
+        clave = tuple(sorted(etiquetas.items()))
+        with self.lock:
+            serie = self.contadores.setdefault(nombre, {})
+            serie[clave] = serie.get(clave, 0) + valor
+
+    def observar(self, nombre, valor, **etiquetas):
+        clave = tuple(sorted(etiquetas.items()))
+        with self.lock:
+            h = self.histogramas.setdefault(nombre, {}).setdefault(clave, [[0] * len(self.buckets), 0.0, 0])
+            for i, limite in enumerate(self.buckets):
+                if valor <= limite: h[0][i] += 1
+            h[1] += valor
+            h[2] += 1
+
+    @contextmanager
+    def medir(self, nombre, **etiquetas):
+        """Duración en lia_<nombre>_seconds y resultado (ok/error) en lia_<nombre>_total"""
+        t0, resultado = time.perf_counter(), "ok"
+        try: yield
+        except BaseException:
+            resultado = "error"
+            raise
+        finally:
+            self.observar(f"lia_{nombre}_seconds", time.perf_counter() - t0, **etiquetas)
+            self.sumar(f"lia_{nombre}_total", resultado=resultado, **etiquetas)
+
+    def registrar_lectura(self, nombre, tipo, fn):
+        self.lecturas[nombre] = (tipo, fn)
+
+    def exportar(self):
+        lineas = []
+        with self.lock:
+            contadores = {n: dict(s) for n, s in self.contadores.items()}
+            histogramas = {n: {k: (list(h[0]), h[1], h[2]) for k, h in s.items()} for n, s in self.histogramas.items()}
+        for nombre, serie in sorted(contadores.items()):
+            lineas.append(f"# TYPE {nombre} counter")
+            lineas += [f"{nombre}{_etiquetas(k)} {v}" for k, v in sorted(serie.items())]
+        for nombre, serie in sorted(histogramas.items()):
+            lineas.append(f"# TYPE {nombre} histogram")
+            for k, (conteos, suma, total) in sorted(serie.items()):
+                lineas += [f"{nombre}_bucket{_etiquetas(k + (('le', str(b)),))} {c}" for b, c in zip(self.buckets, conteos)]
+                lineas += [f"{nombre}_bucket{_etiquetas(k + (('le', '+Inf'),))} {total}",
+                           f"{nombre}_sum{_etiquetas(k)} {suma:.6f}", f"{nombre}_count{_etiquetas(k)} {total}"]
+        for nombre, (tipo, fn) in sorted(self.lecturas.items()):
+            try: valores = fn()
+            except Exception as e:
+                logger.warning(f"Métrica {nombre}: {e}")
+                continue
+            lineas.append(f"# TYPE {nombre} {tipo}")
+            lineas += [f"{nombre}{_etiquetas(tuple(sorted(et.items())))} {v}" for et, v in valores]
+        return "\n".join(lineas) + "\n"
+
+metricas = Metricas()
+
+def medir_handler(nombre, fn):
+    """Envuelve un handler de Telegram: lia_handler_seconds/_total{handler=...}"""
+    async def envuelto(update, context):
+        with metricas.medir("handler", handler=nombre):
+            return await fn(update, context)
+    return envuelto
 
 # --- VARIABLE GLOBAL PARA EL LOOP (PUENTE HILOS) ---
 # Esto arregla el error "RuntimeWarning: coroutine was never awaited"
 global_app_loop = None
-
-# --- CLIENTES ---
-client = Groq(api_key=GROQ_API_KEY) if GROQ_API_KEY else None
-
-# Supabase
-supabase: Client = None
-if SUPABASE_URL and SUPABASE_KEY:
-    try: supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-    except Exception as e: logger.error(f"Error Supabase: {e}")
-
-# GitHub
-gh_client = None
-repo_obj = None
-if GITHUB_TOKEN:
+app = None  # la Application de Telegram (se arma en __main__)
+
+# --- CLIENTES PEREZOSOS ---
+class Perezoso:
+    """Proxy que construye el cliente real (import incluido) recién en el primer uso.
+    bool(proxy) es False si falta la config o la fábrica falló, igual que antes con None."""
+    def __init__(self, nombre, fabrica):
+        self._nombre, self._fabrica = nombre, fabrica
+        self._objeto, self._listo = None, False
+        self._lock = threading.Lock()
+
+    def resolver(self):
+        if not self._listo:
+            with self._lock:
+                if not self._listo:
+                    t0 = time.perf_counter()
+                    try: self._objeto = self._fabrica()
+                    except Exception as e: logger.error(f"❌ Error {self._nombre}: {e}")
+                    self._listo = True
+                    tiempos_arranque[f"cliente_{self._nombre}"] = time.perf_counter() - t0
+        return self._objeto
+
+    async def resolver_async(self):
+        """resolver() fuera del loop: la primera vez hay import y red (get_repo) de por medio"""
+        return self._objeto if self._listo else await asyncio.to_thread(self.resolver)
+
+    def __bool__(self):
+        return self.resolver() is not None
+
+    def __getattr__(self, attr):
+        objeto = self.resolver()
+        if objeto is None: raise AttributeError(f"{self._nombre} no está configurado")
+        return getattr(objeto, attr)
+
+def _crear_groq():
+    if not GROQ_API_KEY: return None
+    from groq import AsyncGroq
+    return AsyncGroq(api_key=GROQ_API_KEY)
+
+def _crear_supabase():
+    if not (SUPABASE_URL and SUPABASE_KEY): return None
+    from supabase import create_client
+    return create_client(SUPABASE_URL, SUPABASE_KEY)
+
+def _crear_github():
+    if not GITHUB_TOKEN: return None
+    from github import Github, Auth
+    return Github(auth=Auth.Token(GITHUB_TOKEN))
+
+def _conectar_repo():
+    if not (GITHUB_REPO and gh_client): return None
     try:
-        auth = Auth.Token(GITHUB_TOKEN)
-        gh_client = Github(auth=auth)
-        if GITHUB_REPO:
-            try:
-                repo_obj = gh_client.get_repo(GITHUB_REPO)
-                logger.info(f"✅ GitHub: {GITHUB_REPO}")
-            except: logger.warning("⚠️ GitHub conectado, pero repo no encontrado.")
-    except: logger.error("❌ Error GitHub Token")
-
-# --- MEMORIA VOLÁTIL ---
-ultimo_codigo_leido = ""
+        repo = gh_client.get_repo(GITHUB_REPO)
+        logger.info(f"✅ GitHub: {GITHUB_REPO}")
+        return repo
+    except Exception:
+        logger.warning("⚠️ GitHub conectado, pero repo no encontrado.")
+        return None
+
+client = Perezoso("groq", _crear_groq)
+supabase = Perezoso("supabase", _crear_supabase)
+gh_client = Perezoso("github", _crear_github)
+repo_defecto = Perezoso("repo", _conectar_repo)  # el de GITHUB_REPO; /conectar lo cambia solo en su chat
+repo_sesion = contextvars.ContextVar("repo_sesion", default=None)
+
+def repo_actual():
+    """Repo concreto de este contexto: el que conectó el chat con /conectar o el del entorno.
+    Resolverlo antes de pasar trabajo a un threading.Thread o a un pool: ahí no viajan los contextvars."""
+    return repo_sesion.get() or repo_defecto.resolver()
+
+class RepoDeSesion:
+    """Lo que antes era el global repo_obj: mismo uso (bool, atributos) pero por chat"""
+    def __bool__(self):
+        return repo_actual() is not None
+
+    def __getattr__(self, attr):
+        repo = repo_actual()
+        if repo is None: raise AttributeError("repo no está configurado")
+        return getattr(repo, attr)
+
+repo_obj = RepoDeSesion()
+
+def precalentar_clientes():
+    """Resuelve los clientes en segundo plano apenas arranca el bot, para que el primer
+    mensaje no pague imports ni el get_repo. Si un handler llega antes, lo resuelve él."""
+    for proxy in (client, supabase, gh_client, repo_defecto):
+        if isinstance(proxy, Perezoso): proxy.resolver()
+    import edge_tts, numpy, bs4, PIL.Image  # noqa: F401  (solo calientan el cache de módulos)
+
+async def clientes_listos():
+    """Para handlers y cron: si llegan antes de que termine precalentar_clientes, el primer uso
+    de un proxy (import + red) se resuelve en un hilo y no frena el loop. Ya resueltos, no cuesta nada."""
+    await asyncio.gather(*(proxy.resolver_async() for proxy in (client, supabase, gh_client, repo_defecto)
+                           if isinstance(proxy, Perezoso)))
+
+def _cuota_github():
+    if not gh_client: return []
+    restantes, limite = gh_client.rate_limiting
+    return [({"tipo": "restantes"}, restantes), ({"tipo": "limite"}, limite)]
+
+metricas.registrar_lectura("lia_github_cuota", "gauge", _cuota_github)
+
+# --- ESTADO COMPARTIDO ENTRE RÉPLICAS ---
+class EstadoCompartido:
+    """Lo que todas las réplicas tienen que ver igual, en un SQLite compartido: el lease del líder
+    de los cron, qué cron ya corrió, el repo conectado de cada chat y el anti-bucle y los trabajos
+    del auto-fix (los POST del CI caen en cualquier réplica). Una conexión por llamada
+    (lo usan el loop vía to_thread, APScheduler y el servidor HTTP); el archivo se crea en el primer uso."""
+    def __init__(self, ruta, instancia, ttl):
+        self.ruta, self.instancia, self.ttl = ruta, instancia, ttl
+        self.vence = 0.0  # hasta cuándo ESTA réplica se considera líder
+        self.esquema_listo = False
+
+    @contextmanager
+    def _conectar(self):
+        db = sqlite3.connect(self.ruta, timeout=10, isolation_level=None)
+        try:
+            if not self.esquema_listo:
+                db.execute("PRAGMA journal_mode=WAL")
+                db.executescript("""
+                    CREATE TABLE IF NOT EXISTS lideres (nombre TEXT PRIMARY KEY, instancia TEXT, vence REAL);
+                    CREATE TABLE IF NOT EXISTS ejecuciones (clave TEXT PRIMARY KEY, instancia TEXT, ts REAL);
+                    CREATE TABLE IF NOT EXISTS repos_chat (chat_id TEXT PRIMARY KEY, repo TEXT, ts REAL);
+                    CREATE TABLE IF NOT EXISTS fixes (firma TEXT PRIMARY KEY, intentos INTEGER, ultimo REAL, avisado INTEGER);
+                    CREATE TABLE IF NOT EXISTS fixes_huellas (huella TEXT PRIMARY KEY, ts REAL);
+                    CREATE TABLE IF NOT EXISTS backoff_fix (ruta TEXT PRIMARY KEY, intentos INTEGER, proximo REAL);
+                    CREATE TABLE IF NOT EXISTS trabajos_fix (id TEXT PRIMARY KEY, firma TEXT, estado TEXT, creado REAL,
+                                                             inicio REAL, fin REAL, resultado TEXT, instancia TEXT);
+                """)
+                self.esquema_listo = True
+            yield db
+        finally: db.close()
+
+    def renovar(self, nombre="cron"):
+        """Toma el lease si está libre o vencido, o lo renueva si ya es nuestro. Devuelve si somos líder.
+        Localmente nos creemos líder solo 2/3 del TTL: una renovación perdida no deja dos líderes."""
+        ahora = time.time()
+        try:
+            with self._conectar() as db:
+                db.execute("BEGIN IMMEDIATE")
+                fila = db.execute("SELECT instancia, vence FROM lideres WHERE nombre = ?", (nombre,)).fetchone()
+                nuestro = fila is None or fila[0] == self.instancia or fila[1] < ahora
+                if nuestro: db.execute("INSERT OR REPLACE INTO lideres VALUES (?, ?, ?)", (nombre, self.instancia, ahora + self.ttl))
+                db.execute("COMMIT")
+        except sqlite3.Error as e:
+            logger.error(f"Lease {nombre}: {e}")
+            return self.soy_lider()  # lo que ya teníamos sigue valiendo hasta self.vence
+        if nuestro != self.soy_lider(): logger.info(f"👑 {self.instancia}: {'soy líder' if nuestro else 'dejo de ser líder'} ({nombre})")
+        self.vence = ahora + self.ttl * 2 / 3 if nuestro else 0.0
+        return nuestro
+
+    def soy_lider(self):
+        return time.time() < self.vence
+
+    def liberar(self, nombre="cron"):
+        """Al apagar: suelta el lease para que otra réplica lo tome sin esperar al TTL"""
+        if not self.soy_lider(): return
+        self.vence = 0.0
+        try:
+            with self._conectar() as db:
+                db.execute("UPDATE lideres SET vence = 0 WHERE nombre = ? AND instancia = ?", (nombre, self.instancia))
+        except sqlite3.Error as e: logger.error(f"Liberando lease {nombre}: {e}")
+
+    def reclamar(self, clave):
+        """True solo para la primera réplica que reclama `clave` (un cron en un horario dado)"""
+        ahora = time.time()
+        with self._conectar() as db:
+            db.execute("DELETE FROM ejecuciones WHERE ts < ?", (ahora - 7 * 86400,))
+            return db.execute("INSERT OR IGNORE INTO ejecuciones VALUES (?, ?, ?)", (clave, self.instancia, ahora)).rowcount == 1
+
+    def guardar_repo_chat(self, chat_id, repo):
+        """Devuelve la versión guardada: (repo, ts)"""
+        version = (repo, time.time())
+        with self._conectar() as db:
+            db.execute("INSERT OR REPLACE INTO repos_chat VALUES (?, ?, ?)", (str(chat_id), *version))
+        return version
+
+    def repo_de_chat(self, chat_id):
+        """(repo, ts) del último /conectar de ese chat en cualquier réplica, o None"""
+        with self._conectar() as db:
+            return db.execute("SELECT repo, ts FROM repos_chat WHERE chat_id = ?", (str(chat_id),)).fetchone()
+
+    def registrar_intento_fix(self, firma, huella, rutas):
+        """Dedupe por ventana, tope de intentos por error y backoff por archivo en UNA transacción:
+        dos réplicas con el mismo reporte no gastan dos intentos. Devuelve (motivo o None, avisar)."""
+        ahora, motivo, avisar = time.time(), None, False
+        with self._conectar() as db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("DELETE FROM fixes WHERE ultimo < ?", (ahora - 86400,))
+            db.execute("DELETE FROM fixes_huellas WHERE ts < ?", (ahora - 86400,))
+            intentos, avisado = db.execute("SELECT intentos, avisado FROM fixes WHERE firma = ?", (firma,)).fetchone() or (0, 0)
+            visto = db.execute("SELECT ts FROM fixes_huellas WHERE huella = ?", (huella,)).fetchone()
+            en_espera = db.execute(f"SELECT ruta, proximo FROM backoff_fix WHERE proximo > ? AND ruta IN ({','.join('?' * len(rutas))}) "
+                                   "ORDER BY ruta", (ahora, *rutas)).fetchall()
+            if visto and ahora - visto[0] < AUTOFIX_VENTANA_SEG:
+                motivo = "reporte repetido (mismo error sobre los mismos archivos)"
+            elif intentos >= AUTOFIX_MAX_INTENTOS:
+                motivo = f"límite de {AUTOFIX_MAX_INTENTOS} intentos para este error"
+                avisar = not avisado
+                db.execute("UPDATE fixes SET avisado = 1 WHERE firma = ?", (firma,))
+            elif en_espera:
+                r, proximo = en_espera[0]
+                motivo = f"backoff en {r or 'build'}: próximo intento en {proximo - ahora:.0f}s"
+            else:
+                for r in rutas:
+                    n = (db.execute("SELECT intentos FROM backoff_fix WHERE ruta = ?", (r,)).fetchone() or (0,))[0] + 1
+                    db.execute("INSERT OR REPLACE INTO backoff_fix VALUES (?, ?, ?)", (r, n, ahora + AUTOFIX_BACKOFF_SEG * 2 ** (n - 1)))
+                db.execute("INSERT OR REPLACE INTO fixes VALUES (?, ?, ?, ?)", (firma, intentos + 1, ahora, avisado))
+                db.execute("INSERT OR REPLACE INTO fixes_huellas VALUES (?, ?)", (huella, ahora))
+            db.execute("COMMIT")
+        return motivo, avisar
+
+    def limpiar_fixes(self):
+        with self._conectar() as db:
+            db.executescript("BEGIN; DELETE FROM fixes; DELETE FROM fixes_huellas; DELETE FROM backoff_fix; COMMIT;")
+
+    def encolar_trabajo(self, firma, cola_max):
+        """(id, es_duplicado). Si hay un trabajo activo con la misma firma en cualquier réplica se
+        devuelve ese; (None, False) si ESTA réplica ya tiene cola_max activos. Un trabajo que sigue
+        activo después de AUTOFIX_VENTANA_SEG se da por abandonado (la réplica murió a mitad)."""
+        ahora = time.time()
+        activos = "estado IN ('en_cola', 'procesando') AND creado > ?"
+        with self._conectar() as db:
+            db.execute("BEGIN IMMEDIATE")
+            fila = db.execute(f"SELECT id FROM trabajos_fix WHERE {activos} AND firma = ?", (ahora - AUTOFIX_VENTANA_SEG, firma)).fetchone()
+            if fila: resultado = (fila[0], True)
+            elif db.execute(f"SELECT COUNT(*) FROM trabajos_fix WHERE {activos} AND instancia = ?",
+                            (ahora - AUTOFIX_VENTANA_SEG, self.instancia)).fetchone()[0] >= cola_max:
+                resultado = (None, False)
+            else:
+                resultado = (uuid.uuid4().hex[:12], False)
+                db.execute("INSERT INTO trabajos_fix VALUES (?, ?, 'en_cola', ?, NULL, NULL, NULL, ?)", (resultado[0], firma, ahora, self.instancia))
+                db.execute("DELETE FROM trabajos_fix WHERE id NOT IN (SELECT id FROM trabajos_fix ORDER BY creado DESC LIMIT 100)")
+            db.execute("COMMIT")
+        return resultado
+
+    def actualizar_trabajo(self, id_trabajo, **campos):
+        if "resultado" in campos: campos["resultado"] = json.dumps(campos["resultado"])
+        with self._conectar() as db:
+            db.execute(f"UPDATE trabajos_fix SET {', '.join(f'{k} = ?' for k in campos)} WHERE id = ?", (*campos.values(), id_trabajo))
+
+    def trabajos(self, id_trabajo=None):
+        """Los últimos trabajos de auto-fix de todas las réplicas, del más viejo al más nuevo (o uno solo)"""
+        with self._conectar() as db:
+            db.row_factory = sqlite3.Row
+            if id_trabajo: filas = db.execute("SELECT * FROM trabajos_fix WHERE id = ?", (id_trabajo,)).fetchall()
+            else: filas = db.execute("SELECT * FROM trabajos_fix ORDER BY creado").fetchall()
+        return [dict(f, resultado=json.loads(f["resultado"]) if f["resultado"] else None) for f in filas]
+
+    def trabajos_por_estado(self):
+        """{estado: cantidad} de los trabajos de ESTA réplica (cada una exporta los suyos en /metrics)"""
+        with self._conectar() as db:
+            return dict(db.execute("SELECT estado, COUNT(*) FROM trabajos_fix WHERE instancia = ? GROUP BY estado", (self.instancia,)).fetchall())
+
+estado_compartido = EstadoCompartido(ESTADO_DB, INSTANCIA_ID, LIDER_TTL_SEG)
+metricas.registrar_lectura("lia_lider", "gauge",
+                           lambda: [({"instancia": INSTANCIA_ID}, int(estado_compartido.soy_lider()))])
+
+def solo_lider(fn):
+    """Cron de Telegram: corre en la réplica con el lease y una sola vez por horario
+    (el reclamo en la DB cubre el borde en que el lease cambia de manos)."""
+    async def envuelto(context):
+        if not estado_compartido.soy_lider(): return
+        clave = f"{fn.__name__}:{time.strftime('%Y-%m-%dT%H:%M', time.gmtime())}"
+        if not await asyncio.to_thread(estado_compartido.reclamar, clave): return
+        logger.info(f"⏰ {clave} corre en {INSTANCIA_ID}")
+        await clientes_listos()
+        return await fn(context)
+    envuelto.__name__ = fn.__name__
+    return envuelto
+
+# --- SESIONES POR CHAT ---
+SESIONES_MAX = int(os.getenv("SESIONES_MAX", "500"))
+SESION_IDLE_SEG = float(os.getenv("SESION_IDLE_SEG", "3600"))
+SESION_CODIGO_MAX = int(os.getenv("SESION_CODIGO_MAX", str(100 * 1024)))  # chars del último código leído
+BOT_CONCURRENCIA = int(os.getenv("BOT_CONCURRENCIA", "32"))  # updates de Telegram procesados a la vez
+
+class Sesion:
+    """Estado de un chat: repo conectado y último código leído.
+    El lock serializa los updates del MISMO chat; chats distintos corren en paralelo."""
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.repo = None  # None = repo_defecto
+        self.version_repo = None  # (repo, ts) de repos_chat que refleja self.repo
+        self.ultimo_codigo = ""
+        self.visto = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def recordar_codigo(self, codigo):
+        self.ultimo_codigo = codigo[:SESION_CODIGO_MAX]
+
+class Sesiones:
+    """chat_id -> Sesion, acotado por cantidad (LRU) y por inactividad. Solo se toca desde
+    el loop de asyncio, así que no necesita lock de hilos."""
+    def __init__(self, max_sesiones, idle_seg):
+        self.datos = OrderedDict()  # de menos a más reciente
+        self.max_sesiones, self.idle_seg = max_sesiones, idle_seg
+        self.desalojos = 0
+
+    def obtener(self, chat_id):
+        ahora = time.monotonic()
+        sesion = self.datos.get(chat_id)
+        if sesion is None: sesion = self.datos[chat_id] = Sesion(chat_id)
+        self.datos.move_to_end(chat_id)
+        sesion.visto = ahora
+        self._desalojar(ahora)
+        return sesion
+
+    def _desalojar(self, ahora):
+        for chat_id, sesion in list(self.datos.items()):
+            if len(self.datos) <= self.max_sesiones and ahora - sesion.visto <= self.idle_seg: break
+            if sesion.lock.locked(): continue  # tiene un update en curso
+            del self.datos[chat_id]
+            self.desalojos += 1
+
+sesiones = Sesiones(SESIONES_MAX, SESION_IDLE_SEG)
+sesion_actual = contextvars.ContextVar("sesion_actual", default=None)
+
+def sesion_del_chat(update):
+    return sesion_actual.get() or sesiones.obtener(update.effective_chat.id)
+
+def _sincronizar_repo_chat(sesion):
+    """Relee repos_chat (búsqueda por clave primaria) y adopta el repo si otra réplica hizo /conectar.
+    get_repo solo corre cuando la fila cambió."""
+    fila = estado_compartido.repo_de_chat(sesion.chat_id)
+    if fila is None or tuple(fila) == sesion.version_repo: return
+    nombre = fila[0]
+    if not (sesion.repo and sesion.repo.full_name == nombre):
+        if not gh_client: return
+        sesion.repo = gh_client.get_repo(nombre)
+    sesion.version_repo = tuple(fila)
+
+def en_sesion(fn):
+    """Corre el handler con la sesión de su chat (contextvars) y de a un update por chat"""
+    async def envuelto(update, context):
+        if update.effective_chat is None: return await fn(update, context)
+        sesion = sesiones.obtener(update.effective_chat.id)
+        # Los handlers hacen `if not repo_obj` / `if supabase`: nada de eso tiene que construir clientes en el loop
+        await clientes_listos()
+        async with sesion.lock:
+            # En modo webhook los updates de un chat se reparten entre réplicas: /conectar pudo pasar en otra
+            try: await asyncio.to_thread(_sincronizar_repo_chat, sesion)
+            except Exception as e: logger.warning(f"Sesión {sesion.chat_id}: no pude sincronizar el repo: {e}")
+            t_sesion, t_repo = sesion_actual.set(sesion), repo_sesion.set(sesion.repo)
+            try: return await fn(update, context)
+            finally:
+                repo_sesion.reset(t_repo)
+                sesion_actual.reset(t_sesion)
+    return envuelto
+
+metricas.registrar_lectura("lia_sesiones", "gauge",
+                           lambda: [({"dato": "activas"}, len(sesiones.datos)), ({"dato": "desalojos"}, sesiones.desalojos)])
 
 # --- DOCUMENTACIÓN TÉCNICA (CEREBRO SENIOR) ---
 GBA_SPECS = """
@@ -88,38 +545,115 @@ GBA_SPECS = """
 3. Si agregas archivos .c nuevos, solo asegúrate de que el Makefile los incluya en la compilación.
 """
 
-# --- FUNCIONES DB (RESTAURADAS) ---
-def obtener_recuerdos_relevantes(query_usuario):
-    identidad = "Eres Lía, Ingeniera de Software Principal en Kaia Alenia."
-    recuerdos = ""
-    if supabase:
+# --- ÍNDICE LOCAL DE MEMORIA (RÉPLICA FTS5 DE LA TABLA memoria) ---
+def tokens_memoria(texto):
+    """Tokenizador del índice: minúsculas, sin acentos, solo palabras clave (> 4 letras)"""
+    plano = unicodedata.normalize("NFKD", texto.lower()).encode("ascii", "ignore").decode()
+    return [w for w in re.findall(r"[a-z0-9_]+", plano) if len(w) > 4]
+
+class IndiceMemoria:
+    """Réplica local de 'memoria' rankeada con bm25(). Supabase sigue siendo la fuente de verdad;
+    aquí solo se baja lo nuevo (por created_at) y se busca sin red. La marca de agua sale solo de
+    filas bajadas por sincronizar(): lo que guardamos nosotros entra al índice sin moverla, así una
+    fila de otra réplica con created_at anterior a la nuestra no queda afuera."""
+    def __init__(self, ruta):
+        self.lock = threading.Lock()
+        self.lock_sync = threading.Lock()
+        self.ultima_sync = 0.0
+        self.db = sqlite3.connect(ruta, check_same_thread=False)
+        self.db.executescript("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS memoria_fts USING fts5(claves, contenido UNINDEXED);
+            CREATE TABLE IF NOT EXISTS memoria_sync (ref TEXT PRIMARY KEY, fts_rowid INTEGER, created_at TEXT);
+            CREATE TABLE IF NOT EXISTS memoria_marca (id INTEGER PRIMARY KEY CHECK (id = 1), created_at TEXT);
+        """)
+
+    def agregar(self, filas):
+        with self.lock, self.db:
+            for f in filas:
+                contenido = f.get("contenido") or ""
+                ref = str(f.get("id") or hashlib.sha1(contenido.encode("utf-8")).hexdigest())
+                if self.db.execute("SELECT 1 FROM memoria_sync WHERE ref = ?", (ref,)).fetchone(): continue
+                cur = self.db.execute("INSERT INTO memoria_fts (claves, contenido) VALUES (?, ?)",
+                                      (" ".join(tokens_memoria(contenido)), contenido))
+                self.db.execute("INSERT INTO memoria_sync VALUES (?, ?, ?)", (ref, cur.lastrowid, f.get("created_at") or ""))
+
+    def sincronizar(self, pagina=500):
+        """Baja solo las filas con created_at >= al último visto (los empates se filtran por id)"""
+        if not supabase or not self.lock_sync.acquire(blocking=False): return
         try:
-            palabras_clave = " ".join([w for w in query_usuario.split() if len(w) > 4]) or "general"
-            try:
-                res = supabase.rpc("buscar_recuerdos", {"query_text": palabras_clave}).execute()
-                if res.data: recuerdos = "\n".join([f"- {r['contenido']}" for r in res.data])
-            except:
-                res = None
-            if not recuerdos:
-                res = supabase.table("memoria").select("contenido").order("created_at", desc=True).limit(3).execute()
-                if res.data: recuerdos = "\n".join([f"- {r['contenido']}" for r in res.data])
-        except Exception as e: logger.error(f"Error Memoria: {e}")
-    return f"{identidad}\n\n[MEMORIA RELEVANTE]:\n{recuerdos}"
+            with self.lock: desde = (self.db.execute("SELECT created_at FROM memoria_marca").fetchone() or [None])[0]
+            inicio = 0
+            while True:
+                q = supabase.table("memoria").select("id, contenido, created_at").order("created_at")
+                if desde: q = q.gte("created_at", desde)
+                with metricas.medir("externo", servicio="supabase", op="memoria_sync"):
+                    filas = q.range(inicio, inicio + pagina - 1).execute().data or []
+                self.agregar(filas)
+                marca = max((f.get("created_at") or "" for f in filas), default="")
+                if marca > (desde or ""):
+                    with self.lock, self.db: self.db.execute("INSERT OR REPLACE INTO memoria_marca VALUES (1, ?)", (marca,))
+                if len(filas) < pagina: break
+                inicio += pagina
+        except Exception as e: logger.error(f"Error sincronizando memoria: {e}")
+        finally:
+            self.ultima_sync = time.time()  # Si falló, se reintenta en segundo plano tras MEMORIA_SYNC_SEG
+            self.lock_sync.release()
+
+    def buscar(self, texto, limite=3):
+        claves = list(dict.fromkeys(tokens_memoria(texto)))
+        with self.lock:
+            if claves:
+                filas = self.db.execute(
+                    "SELECT contenido FROM memoria_fts WHERE memoria_fts MATCH ? ORDER BY bm25(memoria_fts) LIMIT ?",
+                    (" OR ".join(f'"{c}"' for c in claves), limite)
+                ).fetchall()
+                if filas: return [f[0] for f in filas]
+            # Sin coincidencias: lo más reciente, igual que antes
+            filas = self.db.execute(
+                "SELECT f.contenido FROM memoria_sync s JOIN memoria_fts f ON f.rowid = s.fts_rowid "
+                "ORDER BY s.created_at DESC LIMIT ?", (limite,)
+            ).fetchall()
+            return [f[0] for f in filas]
+
+indice_memoria = None
+if SUPABASE_URL and SUPABASE_KEY:
+    try: indice_memoria = IndiceMemoria(MEMORIA_DB)
+    except Exception as e: logger.error(f"Error índice de memoria: {e}")
+
+# --- FUNCIONES DB (RESTAURADAS) ---
+def buscar_recuerdos(query_usuario):
+    if not indice_memoria: return []
+    try:
+        # Primera vez: sincronía completa. Después, refresco en segundo plano sin frenar el chat
+        if not indice_memoria.ultima_sync: indice_memoria.sincronizar()
+        elif time.time() - indice_memoria.ultima_sync > MEMORIA_SYNC_SEG:
+            threading.Thread(target=indice_memoria.sincronizar, daemon=True).start()
+        return indice_memoria.buscar(query_usuario)
+    except Exception as e:
+        logger.error(f"Error Memoria: {e}")
+        return []
 
 def guardar_aprendizaje(dato):
     if supabase:
-        try: supabase.table("memoria").insert({"contenido": dato}).execute()
+        try:
+            with metricas.medir("externo", servicio="supabase", op="memoria_insert"):
+                res = supabase.table("memoria").insert({"contenido": dato}).execute()
+            if indice_memoria: indice_memoria.agregar(res.data or [])
         except: pass
 
 def obtener_tareas_db():
     if supabase:
-        try: return supabase.table("tareas").select("*").eq("estado", "pendiente").execute().data
+        try:
+            with metricas.medir("externo", servicio="supabase", op="tareas_select"):
+                return supabase.table("tareas").select("*").eq("estado", "pendiente").execute().data
         except: return []
     return []
 
 def agregar_tarea_db(desc):
     if supabase:
-        try: supabase.table("tareas").insert({"descripcion": desc}).execute()
+        try:
+            with metricas.medir("externo", servicio="supabase", op="tareas_insert"):
+                supabase.table("tareas").insert({"descripcion": desc}).execute()
         except: pass
 
 def cerrar_tarea_db(numero):
@@ -127,97 +661,425 @@ def cerrar_tarea_db(numero):
     if 0 <= numero - 1 < len(tareas):
         t = tareas[numero - 1]
         if supabase:
-            supabase.table("tareas").update({"estado": "completado"}).eq("id", t['id']).execute()
+            with metricas.medir("externo", servicio="supabase", op="tareas_update"):
+                supabase.table("tareas").update({"estado": "completado"}).eq("id", t['id']).execute()
             return t['descripcion']
     return None
 
 # --- FUNCIONES GITHUB (RESTAURADAS) ---
 def crear_issue_github(titulo, body, labels=[]):
     if not repo_obj: return None
-    try: return repo_obj.create_issue(title=titulo, body=body, labels=labels).html_url
+    try:
+        with metricas.medir("externo", servicio="github", op="issue"):
+            return repo_obj.create_issue(title=titulo, body=body, labels=labels).html_url
     except: return None
 
-def subir_archivo_github(path, cont, msg="Dev: Update por Lía"):
-    if not repo_obj: return "❌ Error: No hay repo conectado."
-    try:
-        # 1. INTENTO DE BACKUP (Solo si el archivo ya existe)
+locks_commit = {}  # full_name -> Lock: en este proceso, un commit a la vez por repo
+lock_locks_commit = threading.Lock()
+
+def _lock_commit(repo):
+    with lock_locks_commit: return locks_commit.setdefault(repo.full_name, threading.Lock())
+
+def subir_cambios_github(archivos, borrados=(), msg="Dev: Update por Lía"):
+    """Sube varios archivos (y borrados) en UN solo commit usando la Git Data API.
+    archivos: lista de (ruta, contenido). Devuelve una línea de log por archivo;
+    si el commit no entró, una sola línea que empieza con ❌ (ver commit_fallido)."""
+    repo = repo_actual()
+    if not repo: return ["❌ Error: No hay repo conectado."]
+    if not archivos and not borrados: return []
+    from github import InputGitTreeElement
+    blobs = {}  # Los binarios no dependen del HEAD: se suben una vez, fuera del lock y de los reintentos
+    for intento in range(COMMIT_INTENTOS):
         try:
-            archivo_viejo = repo_obj.get_contents(path)
-            # Si existe, guardamos una copia en la carpeta 'backups/'
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            nombre_backup = f"backups/{path.replace('/', '_')}_{timestamp}.bak"
-            repo_obj.create_file(nombre_backup, f"Backup antes de tocar {path}", archivo_viejo.decoded_content)
-            logger.info(f"🛡️ Backup creado: {nombre_backup}")
-        except:
-            pass # Si el archivo es nuevo, no hay backup que hacer
+            for path, cont in archivos:
+                if isinstance(cont, (bytes, bytearray)) and path not in blobs:
+                    with metricas.medir("externo", servicio="github", op="blob"):
+                        blobs[path] = repo.create_git_blob(base64.b64encode(cont).decode(), "base64").sha
+            # Leer HEAD -> ref.edit sin otro commit nuestro en el medio; entre réplicas decide el fast forward
+            with _lock_commit(repo), metricas.medir("externo", servicio="github", op="commit"):
+                ref = repo.get_git_ref(f"heads/{repo.default_branch}")
+                base = repo.get_git_commit(ref.object.sha)
+                existentes = blobs_de_commit(repo, ref.object.sha, base.tree.sha)
+
+                elementos, log, tocados, escrituras, respaldos = [], [], [], [], []
+                for path, cont in archivos:
+                    if path in existentes:
+                        # El backup es el sha del blob viejo: va al store de backups, no al árbol
+                        respaldos.append((path, existentes[path]))
+                        log.append(f"Actualizado: `{path}` (backup en curso)")  # se escribe después, en otro hilo
+                    else:
+                        log.append(f"Creado: `{path}`")
+                    if path in blobs:
+                        elementos.append(InputGitTreeElement(path, "100644", "blob", sha=blobs[path]))
+                        tocados.append((path, blobs[path]))
+                        escrituras.append((blobs[path], bytes(cont)))
+                    else:
+                        elementos.append(InputGitTreeElement(path, "100644", "blob", content=cont))
+                        tocados.append((path, sha_blob_git(cont)))
+                        escrituras.append((tocados[-1][1], cont.encode("utf-8")))
+                escritos = {p for p, _ in archivos}
+                for path in borrados:
+                    if path in escritos: continue  # Se reescribe en este mismo commit
+                    if path not in existentes:
+                        log.append(f"⚠️ Error borrando: {path} no existe")
+                        continue
+                    elementos.append(InputGitTreeElement(path, "100644", "blob", sha=None))
+                    tocados.append((path, None))
+                    log.append(f"🗑️ Borrado: {path}")
+                if not elementos: return log
+
+                arbol = repo.create_git_tree(elementos, base_tree=base.tree)
+                commit = repo.create_git_commit(msg, arbol, [base])
+                ref.edit(commit.sha)  # Sin force: si otra réplica empujó antes, reintentamos sobre el HEAD nuevo
+                marcar_cambios_mapa_repo(tocados, repo, commit=commit.sha, base=existentes)
+            for sha, datos in escrituras: cache_contenidos.guardar(sha, datos)  # write-through
+            if respaldos: threading.Thread(target=guardar_backups, args=(respaldos, commit.sha, repo), daemon=True).start()
+            logger.info(f"📦 Commit {commit.sha[:7]}: {len(archivos)} archivo(s), {len(borrados)} borrado(s)")
+            return log
+        except Exception as e:
+            if intento == COMMIT_INTENTOS - 1: return [f"❌ Error GitHub: {e}"]
+            espera = COMMIT_BACKOFF_SEG * 2 ** intento * random.uniform(0.5, 1.5)  # con jitter: las réplicas no chocan de nuevo
+            logger.warning(f"Reintentando commit atómico en {espera:.2f}s ({e})")
+            time.sleep(espera)
 
-        # 2. ACTUALIZACIÓN NORMAL
-        try:
-            c = repo_obj.get_contents(path)
-            repo_obj.update_file(c.path, msg, cont, c.sha)
-            return f"Actualizado: `{path}` (Backup guardado)"
-        except:
-            repo_obj.create_file(path, msg, cont)
-            return f"Creado: `{path}`"
-    except Exception as e: return f"❌ Error GitHub: {e}"
+def commit_fallido(log):
+    """True si subir_cambios_github (o subir_archivo_github) no pudo hacer el commit"""
+    lineas = [log] if isinstance(log, str) else log
+    return any(l.startswith("❌") for l in lineas)
+
+def subir_archivo_github(path, cont, msg="Dev: Update por Lía"):
+    return subir_cambios_github([(path, cont)], msg=msg)[0]
+
+# Foto de las métricas de la cuenta: la arma el scheduler, /status solo la lee
+foto_github = {"seguidores": 0, "estrellas": 0, "repos": 0, "ts": None, "error": None}
+lock_foto_github = threading.Lock()
+
+def refrescar_metricas_github():
+    """Recorre todos los repos (N llamadas paginadas) fuera del camino de los comandos"""
+    if not gh_client: return
+    try:
+        with metricas.medir("externo", servicio="github", op="stats"):
+            u = gh_client.get_user("Kaia-Alenia")
+            estrellas = [x.stargazers_count for x in u.get_repos()]
+            foto = {"seguidores": u.followers, "estrellas": sum(estrellas), "repos": len(estrellas), "ts": time.time(), "error": None}
+        with lock_foto_github: foto_github.update(foto)
+    except Exception as e:
+        logger.error(f"Error métricas GitHub: {e}")
+        with lock_foto_github: foto_github["error"] = str(e)  # se conserva la última foto buena
 
 def obtener_metricas_github_real():
-    if not gh_client: return 0, 0
+    """(seguidores, estrellas, antigüedad en segundos o None) desde la última foto, sin llamar a GitHub"""
+    with lock_foto_github:
+        edad = time.time() - foto_github["ts"] if foto_github["ts"] else None
+        return foto_github["seguidores"], foto_github["estrellas"], edad
+
+def describir_edad(segundos):
+    if segundos is None: return "calculando..."
+    if segundos < 90: return f"hace {segundos:.0f}s"
+    if segundos < 5400: return f"hace {segundos / 60:.0f} min"
+    return f"hace {segundos / 3600:.1f} h"
+
+# --- ÍNDICE DEL REPO (UN SOLO ÁRBOL RECURSIVO, CACHEADO POR HEAD SHA) ---
+MAPA_REPO_TTL = float(os.getenv("MAPA_REPO_TTL", "120"))
+mapas_repo = {}  # full_name -> {"sha", "indice", "ts", "gen", "refrescando"}
+lock_mapas_repo = threading.Lock()
+RE_CANDIDATO_RUTA = re.compile(r"[\w.\-/]+\.\w+|[\w.\-]+/[\w.\-/]+")
+
+def construir_indice_repo(blobs):
+    """blobs: {ruta: sha}. Agrega carpetas y mapas de búsqueda por nombre y por sufijo de ruta"""
+    por_nombre, por_sufijo, dirs = {}, {}, set()
+    for ruta in blobs:
+        partes = ruta.lower().split("/")
+        por_nombre.setdefault(partes[-1], []).append(ruta)
+        for i in range(len(partes) - 1):
+            por_sufijo.setdefault("/".join(partes[i:]), []).append(ruta)
+        dirs.update(ruta.rsplit("/", k)[0] for k in range(1, ruta.count("/") + 1))
+    return {"rutas": sorted(blobs), "blobs": blobs, "dirs": sorted(dirs), "por_nombre": por_nombre, "por_sufijo": por_sufijo}
+
+def resolver_ruta_repo(texto, indice, defecto=None):
+    """Qué archivo del repo menciona el texto: ruta o sufijo de ruta primero, nombre suelto después.
+    Si hay empate (dos main.c) gana el menos profundo."""
+    if not indice: return defecto
+    for token in RE_CANDIDATO_RUTA.findall(texto):
+        clave = token.strip(".,;:()'\"`").lstrip("./").lower()
+        candidatos = indice["por_sufijo"].get(clave) or indice["por_nombre"].get(clave)
+        if candidatos: return min(candidatos, key=lambda r: (r.count("/"), r))
+    return defecto
+
+def _revalidar_mapa_repo(repo):
+    """Pregunta solo el HEAD; el árbol completo se baja únicamente si el sha cambió"""
+    nombre = repo.full_name
+    with lock_mapas_repo:
+        entrada = mapas_repo.get(nombre)
+        gen = entrada["gen"] if entrada else 0
     try:
-        u = gh_client.get_user("Kaia-Alenia")
-        r = u.get_repos()
-        return u.followers, sum([x.stargazers_count for x in r])
-    except: return 0, 0
+        with metricas.medir("externo", servicio="github", op="head"):
+            sha = repo.get_branch(repo.default_branch).commit.sha
+        if entrada and entrada["sha"] == sha:
+            indice = entrada["indice"]
+        else:
+            with metricas.medir("externo", servicio="github", op="arbol"):
+                tree = repo.get_git_tree(sha, recursive=True).tree
+            indice = construir_indice_repo({i.path: i.sha for i in tree if i.type == "blob"})
+        with lock_mapas_repo:
+            actual = mapas_repo.get(nombre)
+            # Si escribimos algo mientras bajaba el árbol, lo local manda y queda vencido
+            if not actual or actual["gen"] == gen:
+                mapas_repo[nombre] = {"sha": sha, "indice": indice, "ts": time.time(), "gen": gen, "refrescando": False}
+            else:
+                actual["refrescando"] = False
+        return indice
+    except Exception as e:
+        logger.error(f"Error leyendo estructura: {e}")
+        with lock_mapas_repo:
+            if nombre in mapas_repo: mapas_repo[nombre]["refrescando"] = False
+        return None
+
+def obtener_indice_repo(repo=None):
+    """Índice del repo (rutas, blobs, carpetas y mapas de búsqueda) o None si no se pudo leer"""
+    repo = repo or repo_actual()
+    if not repo: return None
+    with lock_mapas_repo:
+        entrada = mapas_repo.get(repo.full_name)
+        # Vencido: se sirve lo que hay y se revalida en segundo plano
+        if entrada and not entrada["refrescando"] and time.time() - entrada["ts"] > MAPA_REPO_TTL:
+            entrada["refrescando"] = True
+            threading.Thread(target=_revalidar_mapa_repo, args=(repo,), daemon=True).start()
+    if entrada: return entrada["indice"]
+    return _revalidar_mapa_repo(repo)
+
+def blobs_de_commit(repo, commit, arbol):
+    """{ruta: sha} del árbol de un commit: del índice cacheado si es justo ese HEAD, si no un árbol recursivo"""
+    with lock_mapas_repo:
+        entrada = mapas_repo.get(repo.full_name)
+        if entrada and entrada["sha"] == commit: return entrada["indice"]["blobs"]
+    with metricas.medir("externo", servicio="github", op="arbol"):
+        return {i.path: i.sha for i in repo.get_git_tree(arbol, recursive=True).tree if i.type == "blob"}
 
 def obtener_estructura_repo():
     if not repo_obj: return "Repo desconectado."
-    try:
-        sha = repo_obj.get_commits()[0].sha
-        tree = repo_obj.get_git_tree(sha, recursive=True).tree
-        items = []
-        for i in tree:
-            if i.type == "blob": items.append(i.path)
-        return "\n".join(items)
-    except: return "Error leyendo estructura."
+    indice = obtener_indice_repo()
+    return "\n".join(indice["rutas"]) if indice is not None else "Error leyendo estructura."
+
+def marcar_cambios_mapa_repo(cambios, repo=None, commit=None, base=None):
+    """Refleja en el índice cacheado nuestras escrituras. cambios: lista de (ruta, sha) con
+    sha=None para los borrados. Con commit (sha nuevo) y base ({ruta: sha} del árbol padre) el
+    índice queda exacto para ese HEAD y la próxima revalidación es solo comparar el sha;
+    sin ellos queda vencido y se vuelve a bajar el árbol."""
+    repo = repo or repo_actual()
+    if not repo or not cambios: return
+    with lock_mapas_repo:
+        entrada = mapas_repo.get(repo.full_name)
+        if not entrada and base is None: return
+        blobs = dict(base if base is not None else entrada["indice"]["blobs"])
+        for path, sha in cambios:
+            if sha is None: blobs.pop(path, None)
+            else: blobs[path] = sha
+        gen = entrada["gen"] + 1 if entrada else 1
+        if commit and base is not None:
+            mapas_repo[repo.full_name] = {"sha": commit, "indice": construir_indice_repo(blobs), "ts": time.time(),
+                                          "gen": gen, "refrescando": entrada["refrescando"] if entrada else False}
+        else:
+            entrada.update(indice=construir_indice_repo(blobs), sha=None, ts=0.0, gen=gen)
+
+# --- CACHE DE CONTENIDOS (POR BLOB SHA) ---
+class CacheContenidos:
+    """LRU en memoria sha -> bytes, acotado por bytes totales. Un sha de blob nunca cambia
+    de contenido, así que no hay invalidación: solo hay que preguntar por el sha correcto."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.datos = OrderedDict()
+        self.total = 0
+        self.hits = self.misses = self.desalojos = 0
+        self.lock = threading.Lock()
+
+    def obtener(self, sha):
+        with self.lock:
+            datos = self.datos.get(sha) if sha else None
+            if datos is None:
+                self.misses += 1
+                return None
+            self.datos.move_to_end(sha)
+            self.hits += 1
+            return datos
+
+    def guardar(self, sha, datos):
+        if not sha or len(datos) > self.max_bytes: return
+        with self.lock:
+            if sha in self.datos:
+                self.datos.move_to_end(sha)
+                return
+            self.datos[sha] = datos
+            self.total += len(datos)
+            while self.total > self.max_bytes:
+                self.total -= len(self.datos.popitem(last=False)[1])
+                self.desalojos += 1
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "desalojos": self.desalojos,
+                    "archivos": len(self.datos), "bytes": self.total}
+
+cache_contenidos = CacheContenidos(int(CACHE_ARCHIVOS_MB * 1024 * 1024))
+metricas.registrar_lectura("lia_cache_archivos", "gauge",
+                           lambda: [({"dato": k}, v) for k, v in cache_contenidos.stats().items()])
+
+def leer_archivo_repo(ruta, repo=None, fresco=False):
+    """Contenido (str) de un archivo del repo. El índice dice qué sha tiene la ruta;
+    si ese sha ya está en memoria no se habla con GitHub. Lanza excepción si no existe.
+    fresco=True para lecturas que terminan en un commit: revalida el HEAD antes (1 llamada si
+    nada cambió), así un push ajeno de los últimos MAPA_REPO_TTL segundos no se revierte."""
+    repo = repo or repo_actual()
+    if not repo: raise RuntimeError("Sin repo conectado")
+    indice = _revalidar_mapa_repo(repo) if fresco else obtener_indice_repo(repo)
+    datos = cache_contenidos.obtener(indice["blobs"].get(ruta) if indice else None)
+    if datos is None:
+        with metricas.medir("externo", servicio="github", op="contenido"):
+            archivo = repo.get_contents(ruta)
+            datos = archivo.decoded_content
+        cache_contenidos.guardar(archivo.sha, datos)
+    return datos.decode()
+
+# --- BACKUPS (FUERA DEL ÁRBOL, DIRECCIONADOS POR CONTENIDO) ---
+lock_backups = threading.Lock()
+estado_backups = {"commit": None, "indice": {}}  # último commit leído/escrito en BACKUP_REF
+
+def _leer_indice_backups(repo):
+    """(ref o None, {ruta: [{"sha", "ts", "commit"}]} de más viejo a más nuevo). Llamar con lock_backups."""
+    from github import GithubException
+    try: ref = repo.get_git_ref(BACKUP_REF)
+    except GithubException as e:
+        if e.status == 404: return None, {}
+        raise
+    if ref.object.sha != estado_backups["commit"]:
+        arbol = repo.get_git_tree(repo.get_git_commit(ref.object.sha).tree.sha).tree
+        entrada = next((i for i in arbol if i.path == "indice.json"), None)
+        indice = json.loads(base64.b64decode(repo.get_git_blob(entrada.sha).content)) if entrada else {}
+        estado_backups.update(commit=ref.object.sha, indice=indice)
+    return ref, estado_backups["indice"]
+
+def aplicar_retencion_backups(indice, ahora=None):
+    """Deja las últimas BACKUP_MAX_VERSIONES por ruta y descarta las más viejas que BACKUP_MAX_DIAS"""
+    limite = (ahora or time.time()) - BACKUP_MAX_DIAS * 86400
+    nuevo = {}
+    for ruta, versiones in indice.items():
+        vivas = [v for v in versiones if v["ts"] >= limite][-BACKUP_MAX_VERSIONES:]
+        if vivas: nuevo[ruta] = vivas
+    return nuevo
+
+def guardar_backups(versiones, commit_origen, repo=None):
+    """versiones: [(ruta, sha del blob anterior)]. Escribe un commit huérfano en BACKUP_REF con
+    blobs/<sha> (un contenido repetido se guarda una vez) + indice.json: un commit más en ese ref
+    por escritura (3 a 6 llamadas a la API), nunca en la rama. Sin padre ni base_tree, lo que la
+    retención desaloja ya no lo retiene el ref; el blob sigue existiendo mientras lo alcance
+    la historia de alguna rama (lo normal: es una versión vieja de un archivo del repo)."""
+    repo = repo or repo_actual()
+    if not repo or not versiones: return
+    from github import InputGitTreeElement
+    with lock_backups, metricas.medir("externo", servicio="github", op="backup"):
+        try:
+            ref, indice = _leer_indice_backups(repo)
+            indice = {r: list(v) for r, v in indice.items()}
+            ahora = time.time()
+            for ruta, sha in versiones:
+                historial = indice.setdefault(ruta, [])
+                if historial and historial[-1]["sha"] == sha: continue  # ya respaldado
+                historial.append({"sha": sha, "ts": ahora, "commit": commit_origen})
+            indice = aplicar_retencion_backups(indice, ahora)
+            vivos = sorted({v["sha"] for vs in indice.values() for v in vs})
+            elementos = [InputGitTreeElement(f"blobs/{sha}", "100644", "blob", sha=sha) for sha in vivos]
+            elementos.append(InputGitTreeElement("indice.json", "100644", "blob", content=json.dumps(indice, indent=1)))
+            commit = repo.create_git_commit("Lia: backups", repo.create_git_tree(elementos), [])
+            if ref: ref.edit(commit.sha, force=True)
+            else: repo.create_git_ref(f"refs/{BACKUP_REF}", commit.sha)
+            estado_backups.update(commit=commit.sha, indice=indice)
+            logger.info(f"🗂️ Backups: {len(versiones)} nuevo(s), {len(vivos)} blob(s) retenidos")
+        except Exception as e: logger.error(f"Error guardando backups: {e}")
+
+def versiones_backup(ruta):
+    """Backups de una ruta, del más reciente al más viejo"""
+    if not repo_obj: return []
+    with lock_backups:
+        _, indice = _leer_indice_backups(repo_obj)
+        return list(reversed(indice.get(ruta, [])))
+
+def restaurar_backup(ruta, cual):
+    """cual: posición en versiones_backup (1 = el más reciente) o prefijo de sha.
+    Restaurar es una escritura más: el contenido actual queda a su vez respaldado."""
+    versiones = versiones_backup(ruta)
+    if cual.isdigit() and 1 <= int(cual) <= len(versiones): version = versiones[int(cual) - 1]
+    else: version = next((v for v in versiones if v["sha"].startswith(cual.lower())), None)
+    if not version: return f"⚠️ No hay backup '{cual}' de {ruta}"
+    datos = cache_contenidos.obtener(version["sha"])
+    if datos is None:
+        with metricas.medir("externo", servicio="github", op="blob"):
+            datos = base64.b64decode(repo_obj.get_git_blob(version["sha"]).content)
+        cache_contenidos.guardar(version["sha"], datos)
+    try: contenido = datos.decode("utf-8")
+    except UnicodeDecodeError: contenido = datos
+    return subir_archivo_github(ruta, contenido, msg=f"Lia: Restaurar {ruta} ({version['sha'][:7]})")
 
 def borrar_archivo_github(path, msg="Lia: Limpieza"):
     if not repo_obj: return "❌ No Repo"
-    try:
-        c = repo_obj.get_contents(path)
-        repo_obj.delete_file(path, msg, c.sha)
-        return f"🗑️ Borrado: {path}"
-    except Exception as e: return f"⚠️ Error borrando: {e}"
+    return subir_cambios_github([], [path], msg=msg)[0]
 
 # --- PEGAR AQUÍ LA FUNCIÓN DE CONVERSIÓN ---
+HEX_DIGITOS = b"0123456789ABCDEF"
+
+def bgr555(px):
+    """Array (..., 3) RGB888 -> uint16 BGR555. Fórmula GBA: (Blue << 10) | (Green << 5) | Red"""
+    import numpy as np
+    px = np.asarray(px, dtype=np.uint16)
+    return ((px[..., 2] >> 3) << 10) | ((px[..., 1] >> 3) << 5) | (px[..., 0] >> 3)
+
+def rgb_a_bgr555(img):
+    """RGB888 -> BGR555 sobre todo el buffer de una vez. Devuelve array uint16 (h, w)"""
+    import numpy as np
+    return bgr555(np.asarray(img.convert("RGB")))
+
+def escribir_array_c(out, valores, por_linea=8, filas_por_bloque=4096, digitos=4):
+    """Escribe los valores como filas '    0xNNNN, ...,' directo en un buffer de texto.
+    Cada fila completa tiene ancho fijo, así que se arma byte a byte con numpy."""
+    import numpy as np
+    hex_digitos = np.frombuffer(HEX_DIGITOS, dtype=np.uint8)
+    v = np.ravel(valores).astype(np.uint32 if digitos > 4 else np.uint16)
+    ancho = digitos + 4  # "0x" + dígitos + ", "
+    completas = len(v) // por_linea * por_linea
+    filas = v[:completas].reshape(-1, por_linea)
+    for inicio in range(0, len(filas), filas_por_bloque):
+        bloque = filas[inicio:inicio + filas_por_bloque]
+        buf = np.empty((len(bloque), 4 + ancho * por_linea), dtype=np.uint8)
+        buf[:, :4] = ord(" ")
+        celdas = buf[:, 4:].reshape(len(bloque), por_linea, ancho)
+        celdas[..., 0] = ord("0")
+        celdas[..., 1] = ord("x")
+        for k in range(digitos): celdas[..., 2 + k] = hex_digitos[(bloque >> (4 * (digitos - 1 - k))) & 0xF]
+        celdas[..., -2] = ord(",")
+        celdas[..., -1] = ord(" ")
+        buf[:, -1] = ord("\n")
+        out.write(buf.tobytes().decode("ascii"))
+    resto = v[completas:].tolist()
+    if resto: out.write("    " + ", ".join(f"0x{x:0{digitos}X}" for x in resto) + ",\n")
+
 def convertir_imagen_a_gba(image_bytes, nombre="sprite"):
     """Convierte una imagen PNG/JPG a array de C para GBA (Mode 3 / Linear)"""
+    from PIL import Image
     img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
     
-    # Redimensionar si es gigante (Opcional, protección de memoria)
-    # GBA pantalla es 240x160. Si es mayor, avisamos (pero convertimos igual por si es un mapa)
+    # GBA pantalla es 240x160. Si es mayor, convertimos igual por si es un mapa
     w, h = img.size
-    pixels = list(img.getdata())
-    
-    hex_data = []
-    for r, g, b in pixels:
-        # Conversión matemática a GBA (5 bits por canal)
-        # Fórmula: (Blue << 10) | (Green << 5) | Red
-        gba_val = ((b >> 3) << 10) | ((g >> 3) << 5) | (r >> 3)
-        hex_data.append(f"0x{gba_val:04X}")
+    colores = rgb_a_bgr555(img)
     
-    # Formatear el código C
-    c_code = (
+    # Formatear el código C (agrupado de 8 en 8 para que se vea bonito)
+    out = io.StringIO()
+    out.write(
         f"// Generado por Lia Art Studio\n"
         f"// Dimensiones: {w}x{h}\n"
         f"const unsigned short {nombre}_data[{w * h}] = {{\n"
     )
-    
-    # Agrupamos de 8 en 8 para que se vea bonito
-    for i in range(0, len(hex_data), 8):
-        linea = ", ".join(hex_data[i:i+8])
-        c_code += f"    {linea},\n"
-        
-    c_code += "};\n"
+    escribir_array_c(out, colores)
+    out.write("};\n")
+    c_code = out.getvalue()
     
     h_code = (
         f"// Header file para {nombre}\n"
@@ -228,60 +1090,777 @@ def convertir_imagen_a_gba(image_bytes, nombre="sprite"):
     
     return c_code, h_code, w, h
     
+def indexar_imagen_gba(img, bpp=4):
+    """Cuantiza a 15/255 colores + índice 0 transparente. Colores que caen en el mismo
+    BGR555 comparten entrada. Devuelve (índices uint8 (h, w), paleta uint16)."""
+    import numpy as np
+    q = img.convert("RGB").quantize(colors=(1 << bpp) - 1)
+    idx = np.asarray(q, dtype=np.uint8)
+    pal = bgr555(np.array(q.getpalette()[:768], dtype=np.uint16).reshape(-1, 3))
+    usados = np.unique(idx)
+    colores, inversa = np.unique(pal[usados], return_inverse=True)
+    remap = np.zeros(256, dtype=np.uint8)
+    remap[usados] = inversa + 1
+    paleta = np.zeros(16 if bpp == 4 else len(colores) + 1, dtype=np.uint16)  # 4bpp: banco completo
+    paleta[1:len(colores) + 1] = colores
+    return remap[idx], paleta
+
+def generar_tiles_gba(img, bpp=4, modo="obj"):
+    """Parte la imagen en tiles 8x8 en 4bpp/8bpp con paleta BGR555 compartida.
+    modo "obj": todos los tiles en orden 1D (OAM). modo "bg": tiles únicos + mapa de índices.
+    Devuelve (palabras uint32 de tiles, paleta uint16, mapa uint16 o None, info)."""
+    import numpy as np
+    w, h = img.size
+    idx, paleta = indexar_imagen_gba(img, bpp)
+
+    # Rellenar a múltiplos de 8 con el color transparente y partir en tiles
+    tw, th = -(-w // 8), -(-h // 8)
+    lienzo = np.zeros((th * 8, tw * 8), dtype=np.uint8)
+    lienzo[:h, :w] = idx
+    tiles = lienzo.reshape(th, 8, tw, 8).transpose(0, 2, 1, 3).reshape(-1, 64)
+
+    mapa = None
+    if modo == "bg":
+        # Tiles repetidos se guardan una vez; el mapa apunta al primero que apareció
+        unicos, primero, inversa = np.unique(tiles, axis=0, return_index=True, return_inverse=True)
+        orden = np.argsort(primero)
+        rango = np.empty_like(orden)
+        rango[orden] = np.arange(len(orden))
+        tiles = unicos[orden]
+        mapa = rango[np.ravel(inversa)].astype(np.uint16)
+
+    # 4bpp: dos píxeles por byte (el de la izquierda en el nibble bajo)
+    datos = tiles.reshape(-1, 2) if bpp == 4 else tiles.reshape(-1)
+    if bpp == 4: datos = datos[:, 0] | (datos[:, 1] << 4)
+    palabras = np.ascontiguousarray(datos, dtype=np.uint8).view("<u4")
+
+    info = {
+        "w": w, "h": h, "bpp": bpp, "modo": modo, "map_w": tw,
+        "tiles": tw * th, "tiles_unicos": len(tiles), "colores": int(idx.max()) + 1,
+        "bytes": palabras.nbytes + paleta.nbytes + (mapa.nbytes if mapa is not None else 0),
+        "bytes_mode3": w * h * 2,
+    }
+    if modo == "bg" and len(tiles) > 1024:
+        logger.warning(f"⚠️ {len(tiles)} tiles únicos, el mapa GBA solo direcciona 1024")
+    return palabras, paleta, mapa, info
+
+def convertir_imagen_a_tiles_gba(image_bytes, nombre="sprite", bpp=4, modo="obj"):
+    """Exporta tiles 8x8 + paleta (+ mapa en modo bg) como arrays de C listos para VRAM"""
+    from PIL import Image
+    img = Image.open(io.BytesIO(image_bytes))
+    palabras, paleta, mapa, info = generar_tiles_gba(img, bpp, modo)
+    w, h = img.size
+
+    N = nombre.upper()
+    out = io.StringIO()
+    out.write(
+        f"// Generado por Lia Art Studio ({bpp}bpp, {modo})\n"
+        f"// Dimensiones: {w}x{h} | Tiles: {info['tiles_unicos']} | Colores: {len(paleta)}\n"
+        f"const unsigned int {nombre}_tiles[{len(palabras)}] __attribute__((aligned(4))) = {{\n"
+    )
+    escribir_array_c(out, palabras, digitos=8)
+    out.write(f"}};\n\nconst unsigned short {nombre}_pal[{len(paleta)}] __attribute__((aligned(4))) = {{\n")
+    escribir_array_c(out, paleta)
+    out.write("};\n")
+    if mapa is not None:
+        out.write(f"\nconst unsigned short {nombre}_map[{len(mapa)}] __attribute__((aligned(4))) = {{\n")
+        escribir_array_c(out, mapa)
+        out.write("};\n")
+
+    h_code = (
+        f"// Header file para {nombre} ({bpp}bpp, {modo})\n"
+        f"#define {N}_WIDTH {w}\n"
+        f"#define {N}_HEIGHT {h}\n"
+        f"#define {N}_TILES_LEN {palabras.nbytes}\n"
+        f"#define {N}_PAL_LEN {paleta.nbytes}\n"
+        f"extern const unsigned int {nombre}_tiles[{len(palabras)}];\n"
+        f"extern const unsigned short {nombre}_pal[{len(paleta)}];\n"
+    )
+    if mapa is not None:
+        h_code += (
+            f"#define {N}_MAP_W {info['map_w']}\n"
+            f"#define {N}_MAP_LEN {mapa.nbytes}\n"
+            f"extern const unsigned short {nombre}_map[{len(mapa)}];\n"
+        )
+    return out.getvalue(), h_code, info
+
+# --- COMPRESIÓN COMPATIBLE CON LA BIOS GBA (LZ77 0x10 / RLE 0x30) ---
+def _cabecera_bios(tipo, n):
+    return struct.pack("<I", tipo | (n << 8))
+
+def _alinear4(out):
+    while len(out) % 4: out.append(0)
+    return bytes(out)
+
+def comprimir_lz77_gba(datos, vram=True):
+    """LZ77 tipo 0x10 para LZ77UnCompWram/Vram (SWI 0x11/0x12).
+    vram=True prohíbe distancia 1: la VRAM se escribe de a 16 bits."""
+    datos = bytes(datos)
+    n = len(datos)
+    out = bytearray(_cabecera_bios(0x10, n))
+    min_disp = 2 if vram else 1
+    cadenas = {}  # prefijo de 3 bytes -> posiciones recientes
+    i = 0
+    while i < n:
+        pos_flag = len(out)
+        out.append(0)
+        flag = 0
+        for bit in range(8):
+            if i >= n: break
+            mejor_len, mejor_disp = 0, 0
+            tope = min(18, n - i)
+            if tope >= 3:
+                for j in reversed(cadenas.get(datos[i:i + 3], ())):
+                    disp = i - j
+                    if disp > 4096: break
+                    if disp < min_disp: continue
+                    l = 3
+                    while l < tope and datos[j + l] == datos[i + l]: l += 1
+                    if l > mejor_len:
+                        mejor_len, mejor_disp = l, disp
+                        if l == tope: break
+            if mejor_len:
+                flag |= 0x80 >> bit
+                out += bytes((((mejor_len - 3) << 4) | ((mejor_disp - 1) >> 8), (mejor_disp - 1) & 0xFF))
+                avance = mejor_len
+            else:
+                out.append(datos[i])
+                avance = 1
+            for k in range(i, min(i + avance, n - 2)):
+                cadena = cadenas.get(datos[k:k + 3])
+                if cadena is None: cadena = cadenas[datos[k:k + 3]] = deque(maxlen=64)
+                cadena.append(k)
+            i += avance
+        out[pos_flag] = flag
+    return _alinear4(out)
+
+def descomprimir_lz77_gba(blob):
+    if blob[0] != 0x10: raise ValueError("No es un bloque LZ77 (0x10)")
+    n = int.from_bytes(blob[1:4], "little")
+    out = bytearray()
+    i = 4
+    while len(out) < n:
+        flag = blob[i]; i += 1
+        for bit in range(8):
+            if len(out) >= n: break
+            if flag & (0x80 >> bit):
+                b1, b2 = blob[i], blob[i + 1]; i += 2
+                disp = (((b1 & 0xF) << 8) | b2) + 1
+                for _ in range((b1 >> 4) + 3): out.append(out[-disp])
+            else:
+                out.append(blob[i]); i += 1
+    return bytes(out[:n])
+
+def comprimir_rle_gba(datos):
+    """RLE tipo 0x30 para RLUnCompWram/Vram (SWI 0x14/0x15)"""
+    datos = bytes(datos)
+    n = len(datos)
+    out = bytearray(_cabecera_bios(0x30, n))
+    literal_desde = 0
+    def volcar_literales(hasta):
+        for k in range(literal_desde, hasta, 128):
+            trozo = datos[k:min(k + 128, hasta)]
+            out.append(len(trozo) - 1)
+            out.extend(trozo)
+    i = 0
+    while i < n:
+        run = 1
+        while i + run < n and run < 130 and datos[i + run] == datos[i]: run += 1
+        if run >= 3:
+            volcar_literales(i)
+            out += bytes((0x80 | (run - 3), datos[i]))
+            literal_desde = i + run
+        i += run
+    volcar_literales(n)
+    return _alinear4(out)
+
+def descomprimir_rle_gba(blob):
+    if blob[0] != 0x30: raise ValueError("No es un bloque RLE (0x30)")
+    n = int.from_bytes(blob[1:4], "little")
+    out = bytearray()
+    i = 4
+    while len(out) < n:
+        flag = blob[i]; i += 1
+        if flag & 0x80:
+            out += bytes([blob[i]]) * ((flag & 0x7F) + 3); i += 1
+        else:
+            largo = (flag & 0x7F) + 1
+            out += blob[i:i + largo]; i += largo
+    return bytes(out[:n])
+
+# nombre -> (tipo BIOS, comprimir, descomprimir, SWI de VRAM)
+COMPRESIONES_GBA = {
+    "lz77": (0x10, comprimir_lz77_gba, descomprimir_lz77_gba, "LZ77UnCompVram (SWI 0x12)"),
+    "rle": (0x30, comprimir_rle_gba, descomprimir_rle_gba, "RLUnCompVram (SWI 0x15)"),
+    "raw": (0x00, bytes, bytes, "copia directa (DMA/CpuFastSet)"),
+}
+
+def exportar_tiles_bin_gba(image_bytes, nombre="sprite", bpp=4, modo="obj", compresion="lz77"):
+    """Como convertir_imagen_a_tiles_gba pero en blobs .bin (data/, estilo bin2o de devkitPro)
+    comprimidos para la BIOS. La paleta va sin comprimir. Devuelve ([(ruta, bytes)], h_code, info)."""
+    tipo, comprimir, descomprimir, swi = COMPRESIONES_GBA[compresion]
+    from PIL import Image
+    img = Image.open(io.BytesIO(image_bytes))
+    palabras, paleta, mapa, info = generar_tiles_gba(img, bpp, modo)
+
+    partes = [("tiles", palabras.tobytes(), True), ("pal", paleta.astype("<u2").tobytes(), False)]
+    if mapa is not None: partes.append(("map", mapa.astype("<u2").tobytes(), True))
+
+    N = nombre.upper()
+    archivos = []
+    h_code = (
+        f"// Header file para {nombre} ({bpp}bpp, {modo}, binario {compresion})\n"
+        f"// Tiles/mapa: descomprimir con {swi}. Paleta: copia directa.\n"
+        f"#define {N}_WIDTH {info['w']}\n"
+        f"#define {N}_HEIGHT {info['h']}\n"
+        f"#define {N}_COMPRESION 0x{tipo:02X}\n"
+    )
+    if mapa is not None: h_code += f"#define {N}_MAP_W {info['map_w']}\n"
+    total = 0
+    for parte, crudo, comprimible in partes:
+        blob = comprimir(crudo) if comprimible else crudo
+        # Nunca subimos un blob que la BIOS no pueda reconstruir
+        if comprimible and descomprimir(blob) != crudo:
+            raise RuntimeError(f"Compresión {compresion} inconsistente en {parte}")
+        simbolo = f"{nombre}_{parte}_bin"
+        archivos.append((f"data/{nombre}_{parte}.bin", blob))
+        total += len(blob)
+        h_code += (
+            f"#define {N}_{parte.upper()}_LEN {len(crudo)}\n"
+            f"extern const unsigned char {simbolo}[];\n"
+            f"extern const unsigned int {simbolo}_size;\n"
+        )
+    info.update(bytes_crudos=info["bytes"], bytes=total, compresion=compresion)
+    return archivos, h_code, info
+
+# --- MOTOR LLM ASÍNCRONO ---
+class MotorLLM:
+    """Completions sin bloquear el loop: límite de concurrencia, timeout y fusión de prompts idénticos"""
+    def __init__(self, cliente, max_concurrencia=4, timeout=90):
+        self.cliente = cliente
+        self.timeout = timeout
+        self.semaforo = asyncio.Semaphore(max(1, max_concurrencia))
+        self.en_vuelo = {}  # clave del prompt -> Task compartida
+
+    def _clave(self, modelo, messages, temperature):
+        raw = json.dumps([modelo, temperature, messages], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    async def _llamar(self, modelo, messages, temperature):
+        async with self.semaforo:
+            with metricas.medir("llm", modo="completar", modelo=modelo):
+                resp = await asyncio.wait_for(
+                    self.cliente.chat.completions.create(model=modelo, messages=messages, temperature=temperature),
+                    timeout=self.timeout
+                )
+            uso = getattr(resp, "usage", None)
+            if uso:
+                metricas.sumar("lia_llm_tokens_total", uso.prompt_tokens, tipo="entrada", modelo=modelo)
+                metricas.sumar("lia_llm_tokens_total", uso.completion_tokens, tipo="salida", modelo=modelo)
+            return resp.choices[0].message.content
+
+    async def completar(self, messages, temperature=0.2, modelo="llama-3.3-70b-versatile"):
+        clave = self._clave(modelo, messages, temperature)
+        tarea = self.en_vuelo.get(clave)
+        if tarea is None:
+            tarea = asyncio.ensure_future(self._llamar(modelo, messages, temperature))
+            self.en_vuelo[clave] = tarea
+            tarea.add_done_callback(lambda _t: self.en_vuelo.pop(clave, None))
+        else:
+            logger.info("🔁 Prompt idéntico en vuelo, reutilizando respuesta")
+        # shield: si un chat cancela su espera, los demás siguen recibiendo la respuesta
+        return await asyncio.shield(tarea)
+
+    async def transmitir(self, messages, temperature=0.2, modelo="llama-3.3-70b-versatile"):
+        """Igual que completar pero va entregando los fragmentos a medida que llegan.
+        No se fusiona con otros pedidos: cada stream es de un solo chat. El timeout es por fragmento."""
+        async with self.semaforo:
+            with metricas.medir("llm", modo="stream", modelo=modelo):
+                t0, primero = time.perf_counter(), True
+                stream = await asyncio.wait_for(
+                    self.cliente.chat.completions.create(model=modelo, messages=messages, temperature=temperature, stream=True),
+                    timeout=self.timeout
+                )
+                fragmentos = stream.__aiter__()
+                try:
+                    while True:
+                        try: chunk = await asyncio.wait_for(fragmentos.__anext__(), timeout=self.timeout)
+                        except StopAsyncIteration: return
+                        delta = chunk.choices[0].delta.content if chunk.choices else None
+                        if delta:
+                            if primero:
+                                metricas.observar("lia_llm_primer_token_seconds", time.perf_counter() - t0, modelo=modelo)
+                                primero = False
+                            yield delta
+                finally:
+                    # Timeout, error o consumidor que corta: se cierra la respuesta HTTP (si no, queda colgada en el pool)
+                    cerrar = getattr(stream, "close", None) or getattr(stream, "aclose", None)
+                    if cerrar:
+                        try: await cerrar()
+                        except Exception: pass
+
+motor_llm = MotorLLM(client, LLM_MAX_CONCURRENCIA, LLM_TIMEOUT) if GROQ_API_KEY else None
+
+def ejecutar_en_loop(coro):
+    """Corre una corrutina en el loop del bot desde otro hilo (webhook) y espera el resultado"""
+    if global_app_loop and global_app_loop.is_running():
+        return asyncio.run_coroutine_threadsafe(coro, global_app_loop).result()
+    return asyncio.run(coro)
+
+# --- ENSAMBLADOR DE PROMPT (PRESUPUESTO DE TOKENS) ---
+# Prefijo fijo: idéntico byte a byte en todas las llamadas (cacheable por el proveedor).
+# Todo lo que cambia por mensaje va DESPUÉS de este bloque.
+PROMPT_BASE = f"""Eres Lía, Ingeniera de Software Principal en Kaia Alenia.
+[TU IDENTIDAD]
+Eres Lia, Desarrolladora Principal de Kaia Alenia (GBA/C Specialist).
+{GBA_SPECS}
+[TUS HERRAMIENTAS - ÚSALAS BIEN]
+1. CREAR/EDITAR:
+   [[FILE: src/main.c]]
+   ... código C puro ...
+   [[ENDFILE]]
+
+2. BORRAR ARCHIVOS:
+   [[DELETE: carpeta/archivo_viejo.c]]
+
+[REGLAS DE ORO]
+1. **NO MARKDOWN:** Dentro de los bloques [[FILE]], NO pongas ```c ni ```. Solo el código.
+2. **RUTAS:** Mira el mapa del repo (abajo). Si el makefile dice 'src/', pon los .c en 'src/'.
+3. **ANTI-PEREZA:** Escribe el archivo COMPLETO. Prohibido usar "// ... resto del código".
+"""
+
+def contar_tokens(texto):
+    """Estimación barata: ~4 caracteres por token en código y español"""
+    return (len(texto) + 3) // 4
+
+def recortar_lineas(lineas, presupuesto):
+    """Se queda con las primeras líneas que caben (ya vienen ordenadas por prioridad)"""
+    out, usados = [], 0
+    for i, linea in enumerate(lineas):
+        t = contar_tokens(linea) + 1
+        if usados + t > presupuesto:
+            out.append(f"... ({len(lineas) - i} más omitidas)")
+            break
+        out.append(linea)
+        usados += t
+    return out
+
+def priorizar_rutas(rutas, texto):
+    """Mapa del repo ordenado por cercanía al pedido: archivos mencionados, su carpeta,
+    código fuente/Makefile, el resto y los backups al final"""
+    mencionadas = {r for r in rutas if r in texto or ("." in os.path.basename(r) and len(os.path.basename(r)) > 3 and os.path.basename(r) in texto)}
+    carpetas = {os.path.dirname(r) for r in mencionadas}
+    def peso(r):
+        if r in mencionadas: return 0
+        if os.path.dirname(r) in carpetas: return 1
+        if r.startswith("backups/"): return 4
+        if r.endswith((".c", ".h", ".s")) or os.path.basename(r).lower() == "makefile": return 2
+        return 3
+    return sorted(rutas, key=peso)  # sort estable: dentro de cada grupo se respeta el orden del árbol
+
+def armar_prompt_sistema(texto, recuerdos, rutas, tareas, presupuesto=None):
+    """Prefijo fijo + secciones dinámicas recortadas por prioridad para no pasar el presupuesto.
+    Devuelve (prompt, tokens por sección)."""
+    presupuesto = presupuesto or PROMPT_TOKENS_MAX
+    conteo = {"base": contar_tokens(PROMPT_BASE)}
+    disponible = max(0, presupuesto - conteo["base"])
+    # (nombre, título, líneas en orden de prioridad, tope como fracción de lo disponible)
+    secciones = [
+        ("memoria", "[MEMORIA RELEVANTE]", [f"- {r}" for r in recuerdos], 0.25),
+        ("tareas", "[TAREAS PENDIENTES]", [f"- {t['descripcion']}" for t in tareas] or ["Sin pendientes."], 0.15),
+        ("mapa_repo", "[ESTRUCTURA ACTUAL DEL REPO - NO INVENTES RUTAS]", priorizar_rutas(rutas, texto), 1.0),
+    ]
+    partes = [PROMPT_BASE]
+    for nombre, titulo, lineas, tope in secciones:
+        lineas = recortar_lineas(lineas, int(disponible * tope) - contar_tokens(titulo) - 1)
+        bloque = titulo + "\n" + "\n".join(lineas) + "\n"
+        conteo[nombre] = contar_tokens(bloque)
+        disponible -= conteo[nombre]
+        partes.append(bloque)
+    conteo["total"] = sum(conteo.values())
+    return "\n".join(partes), conteo
+
 # --- CEREBRO (FULL) ---
-def cerebro_lia(texto, usuario):
-    if not client: return "⚠️ Faltan ojos (GROQ_API_KEY)"
-    
-    memoria = obtener_recuerdos_relevantes(texto)
-    mapa_repo = obtener_estructura_repo()
-    tareas = obtener_tareas_db()
-    lista_tareas = "\n".join([f"- {t['descripcion']}" for t in tareas]) if tareas else "Sin pendientes."
-    
-    SYSTEM = f"""
-    {memoria}
-    [TU IDENTIDAD]
-    Eres Lia, Desarrolladora Principal de Kaia Alenia (GBA/C Specialist).
-    
-    [ESTRUCTURA ACTUAL DEL REPO - NO INVENTES RUTAS]
-    {mapa_repo}
-    
-    [TAREAS PENDIENTES]
-    {lista_tareas}
-    
-    {GBA_SPECS}
+async def cerebro_lia(texto, usuario, al_avanzar=None):
+    """Respuesta completa de Lía. Con al_avanzar(texto_parcial) la respuesta se pide en
+    streaming y el callback recibe el acumulado en cada fragmento (p. ej. MensajeEnVivo.actualizar)."""
+    if not motor_llm: return "⚠️ Faltan ojos (GROQ_API_KEY)"
     
-    [TUS HERRAMIENTAS - ÚSALAS BIEN]
-    1. CREAR/EDITAR:
-       [[FILE: src/main.c]]
-       ... código C puro ...
-       [[ENDFILE]]
-    
-    2. BORRAR ARCHIVOS:
-       [[DELETE: carpeta/archivo_viejo.c]]
-       
-    [REGLAS DE ORO]
-    1. **NO MARKDOWN:** Dentro de los bloques [[FILE]], NO pongas ```c ni ```. Solo el código.
-    2. **RUTAS:** Mira el mapa de arriba. Si el makefile dice 'src/', pon los .c en 'src/'.
-    3. **ANTI-PEREZA:** Escribe el archivo COMPLETO. Prohibido usar "// ... resto del código".
-    """
+    # Supabase y GitHub son clientes bloqueantes: los mandamos a hilos en paralelo
+    recuerdos, mapa_repo, tareas = await asyncio.gather(
+        asyncio.to_thread(buscar_recuerdos, texto),
+        asyncio.to_thread(obtener_estructura_repo),
+        asyncio.to_thread(obtener_tareas_db),
+    )
+    rutas = mapa_repo.split("\n") if repo_obj else [mapa_repo]
+    SYSTEM, conteo = armar_prompt_sistema(texto, recuerdos, rutas, tareas or [])
+    logger.info("🧮 Tokens prompt: " + " ".join(f"{k}={v}" for k, v in conteo.items()) + f" user={contar_tokens(texto)}")
     
+    messages = [{"role": "system", "content": SYSTEM}, {"role": "user", "content": texto}]
+    metricas.sumar("lia_cerebro_tokens_total", conteo["total"] + contar_tokens(texto), tipo="entrada")
+    with metricas.medir("cerebro", modo="completar" if al_avanzar is None else "stream"):
+        respuesta = await _pensar(messages, al_avanzar)
+    metricas.sumar("lia_cerebro_tokens_total", contar_tokens(respuesta), tipo="salida")
+    return respuesta
+
+async def _pensar(messages, al_avanzar):
+    if al_avanzar is None:
+        try: return await motor_llm.completar(messages, temperature=0.2)
+        except asyncio.TimeoutError: return f"⚠️ Error cerebral: sin respuesta en {LLM_TIMEOUT:.0f}s"
+        except Exception as e: return f"⚠️ Error cerebral: {e}"
+
+    acumulado = ""
     try:
-        resp = client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=[{"role": "system", "content": SYSTEM}, {"role": "user", "content": texto}],
-            temperature=0.2 
-        ).choices[0].message.content
-        return resp
-    except Exception as e: return f"⚠️ Error cerebral: {e}"
+        async for delta in motor_llm.transmitir(messages, temperature=0.2):
+            acumulado += delta
+            await al_avanzar(acumulado)
+        return acumulado
+    except asyncio.TimeoutError: error = f"sin respuesta en {LLM_TIMEOUT:.0f}s"
+    except Exception as e: error = str(e)
+    # Si ya se vio parte de la respuesta, no la tiramos: se marca como cortada
+    return f"{acumulado}\n\n⚠️ (respuesta cortada: {error})" if acumulado else f"⚠️ Error cerebral: {error}"
+
+# --- REVISIÓN POR PARTES (MAP-REDUCE) ---
+PROMPT_PARTE = """Eres Lía, revisora senior de C para Game Boy Advance.
+Vas a ver UN fragmento de un archivo más grande: no asumas que falta lo que no ves.
+Sé concreta y cita números de línea del fragmento. NO escribas código nuevo completo."""
+
+def partir_en_funciones(codigo, max_chars=None):
+    """Parte código C en trozos de <= max_chars cortando solo donde la profundidad de llaves
+    vuelve a 0 (entre funciones/structs), salvo que una función sola no entre.
+    Ignora llaves dentro de comentarios, strings y chars. Devuelve [(desde, hasta, texto)] 1-based."""
+    max_chars = max_chars or REVIEW_CHUNK_CHARS
+    lineas = codigo.splitlines(keepends=True)
+    bloques, inicio, prof, en_comentario = [], 0, 0, False
+    for n, linea in enumerate(lineas):
+        i, cadena = 0, None
+        while i < len(linea):
+            ch, par = linea[i], linea[i:i + 2]
+            if en_comentario:
+                if par == "*/": en_comentario, i = False, i + 1
+            elif cadena:
+                if ch == "\\": i += 1
+                elif ch == cadena: cadena = None
+            elif par == "//": break
+            elif par == "/*": en_comentario, i = True, i + 1
+            elif ch in "\"'": cadena = ch
+            elif ch == "{": prof += 1
+            elif ch == "}": prof = max(0, prof - 1)
+            i += 1
+        if prof == 0 and not en_comentario:
+            bloques.append((inicio, n + 1))
+            inicio = n + 1
+    if inicio < len(lineas): bloques.append((inicio, len(lineas)))
+
+    # Se juntan bloques consecutivos hasta llenar el trozo; un bloque gigante se corta por líneas
+    partes, desde, tam = [], None, 0
+    def cerrar(hasta):
+        if desde is not None and hasta > desde: partes.append((desde + 1, hasta, "".join(lineas[desde:hasta])))
+    for a, b in bloques:
+        largo = sum(len(l) for l in lineas[a:b])
+        if desde is not None and tam + largo > max_chars:
+            cerrar(a)
+            desde, tam = None, 0
+        if largo > max_chars:
+            for k in range(a, b):
+                if desde is not None and tam + len(lineas[k]) > max_chars:
+                    cerrar(k)
+                    desde, tam = None, 0
+                if desde is None: desde = k
+                tam += len(lineas[k])
+            continue
+        if desde is None: desde = a
+        tam += largo
+    cerrar(len(lineas))
+    return partes
+
+async def analizar_por_partes(ruta, codigo, tarea, max_paralelo=None):
+    """Map: corre la misma tarea sobre cada trozo en paralelo (con tope) y devuelve
+    un texto por trozo encabezado con su rango de líneas, en orden."""
+    partes = partir_en_funciones(codigo)
+    semaforo = asyncio.Semaphore(max(1, max_paralelo or REVIEW_MAX_PARALELO))
+    total = codigo.count("\n") + 1
+
+    async def una(desde, hasta, texto):
+        async with semaforo:
+            try:
+                r = await motor_llm.completar([
+                    {"role": "system", "content": PROMPT_PARTE},
+                    {"role": "user", "content": f"[ARCHIVO] {ruta} (líneas {desde}-{hasta} de {total})\n[TAREA]\n{tarea}\n\n[CÓDIGO]\n{texto}"},
+                ], temperature=0.2)
+            except Exception as e: r = f"⚠️ No se pudo analizar: {e}"
+        return f"[Líneas {desde}-{hasta}]\n{r.strip()}"
+
+    return await asyncio.gather(*(una(*p) for p in partes))
+
+# --- RESPUESTAS EN VIVO (STREAMING A TELEGRAM) ---
+def partir_texto_telegram(texto, limite=4096):
+    """Corta en trozos de <= limite, preferentemente en un salto de línea. Los cortes de un
+    texto que sigue creciendo no se mueven, así los mensajes ya enviados quedan estables."""
+    partes = []
+    while len(texto) > limite:
+        corte = texto.rfind("\n", 0, limite)
+        if corte <= 0: corte = limite
+        partes.append(texto[:corte])
+        texto = texto[corte:].lstrip("\n")
+    return partes + [texto]
+
+def _segundos(retry_after):
+    """RetryAfter.retry_after es int o timedelta según la versión de python-telegram-bot"""
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+class MensajeEnVivo:
+    """Pinta un texto que va creciendo editando mensajes de Telegram: como mucho una edición
+    cada STREAM_INTERVALO_SEG, y pasado el límite de 4096 caracteres sigue en mensajes nuevos.
+    Mientras escribe va sin formato (el Markdown a medias no parsea); el cierre intenta Markdown."""
+    def __init__(self, origen, primero=None, intervalo=None, limite=4096):
+        self.origen = origen  # Message al que se responde
+        self.mensajes = [primero] if primero else []
+        self.mostrado = [None] * len(self.mensajes)
+        self.intervalo = STREAM_INTERVALO_SEG if intervalo is None else intervalo
+        self.limite = limite
+        self.proxima = 0.0
+
+    async def _pintar(self, i, parte, parse_mode=None):
+        try:
+            if i < len(self.mensajes):
+                await self.mensajes[i].edit_text(parte, parse_mode=parse_mode)
+            else:
+                self.mensajes.append(await self.origen.reply_text(parte, parse_mode=parse_mode))
+                self.mostrado.append(None)
+            self.mostrado[i] = parte
+        except RetryAfter as e:
+            self.proxima = time.monotonic() + _segundos(e.retry_after)
+            raise
+        except BadRequest as e:
+            if "not modified" not in str(e).lower(): raise
+            self.mostrado[i] = parte
+
+    async def actualizar(self, texto):
+        if not texto.strip() or time.monotonic() < self.proxima: return
+        self.proxima = time.monotonic() + self.intervalo
+        try:
+            for i, parte in enumerate(partir_texto_telegram(texto, self.limite)):
+                if i >= len(self.mostrado) or self.mostrado[i] != parte: await self._pintar(i, parte)
+        except RetryAfter: pass  # se retoma en la próxima actualización
+        except Exception as e: logger.warning(f"Stream a Telegram: {e}")
+
+    async def cerrar(self, texto, parse_mode="Markdown", intentos=5):
+        """Última versión (con formato si parsea) y borra los mensajes que sobran.
+        Ante RetryAfter espera lo que pide Telegram; otros errores (red, timeouts) se reintentan
+        con backoff. Si una parte no sale, se registra y la limpieza corre igual."""
+        partes = partir_texto_telegram(texto or "…", self.limite)
+        try:
+            for i, parte in enumerate(partes):
+                for intento in range(intentos):
+                    try:
+                        try: await self._pintar(i, parte, parse_mode)
+                        except BadRequest: await self._pintar(i, parte)  # Markdown roto: va plano
+                        break
+                    except RetryAfter as e: await asyncio.sleep(_segundos(e.retry_after))
+                    except Exception as e:
+                        logger.warning(f"Cierre del stream (parte {i + 1}, intento {intento + 1}): {e}")
+                        if intento + 1 < intentos: await asyncio.sleep(0.5 * 2 ** intento)
+                else:
+                    # Las partes siguientes irían a un índice corrido: se corta acá
+                    logger.error(f"Stream a Telegram: parte {i + 1}/{len(partes)} sin versión final tras {intentos} intentos")
+                    return
+        finally:
+            for m in self.mensajes[len(partes):]:
+                try: await m.delete()
+                except Exception: pass
+            del self.mensajes[len(partes):], self.mostrado[len(partes):]
 
 # --- TTS ---
+class CacheAudio:
+    """LRU en disco direccionado por contenido: sha256(voz, rate, texto) -> mp3, acotado en bytes.
+    Crea la carpeta y lee el listado al construirse: usar solo a través de cache_audio (perezoso)."""
+    def __init__(self, carpeta, max_bytes):
+        os.makedirs(carpeta, exist_ok=True)
+        self.carpeta, self.max_bytes = carpeta, max_bytes
+        self.lock = threading.Lock()
+        self.entradas = OrderedDict()  # clave -> tamaño, de menos a más reciente
+        archivos = [n for n in os.listdir(carpeta) if n.endswith(".mp3")]
+        for n in sorted(archivos, key=lambda n: os.path.getmtime(os.path.join(carpeta, n))):
+            self.entradas[n[:-4]] = os.path.getsize(os.path.join(carpeta, n))
+        self.total = sum(self.entradas.values())
+
+    @staticmethod
+    def clave(texto, voz, rate):
+        return hashlib.sha256(f"{voz}\0{rate}\0{texto}".encode("utf-8")).hexdigest()
+
+    def _ruta(self, clave):
+        return os.path.join(self.carpeta, f"{clave}.mp3")
+
+    def obtener(self, clave):
+        with self.lock:
+            if clave not in self.entradas: return None
+            self.entradas.move_to_end(clave)
+        try:
+            with open(self._ruta(clave), "rb") as f: audio = f.read()
+            os.utime(self._ruta(clave))  # el mtime conserva el orden LRU entre reinicios
+            return audio
+        except OSError:
+            with self.lock: self.total -= self.entradas.pop(clave, 0)
+            return None
+
+    def guardar(self, clave, audio):
+        tmp = self._ruta(clave) + ".tmp"
+        with open(tmp, "wb") as f: f.write(audio)
+        os.replace(tmp, self._ruta(clave))
+        with self.lock:
+            self.total += len(audio) - self.entradas.pop(clave, 0)
+            self.entradas[clave] = len(audio)
+            while self.total > self.max_bytes and len(self.entradas) > 1:
+                vieja, tam = self.entradas.popitem(last=False)
+                self.total -= tam
+                try: os.remove(self._ruta(vieja))
+                except OSError: pass
+
+cache_audio = Perezoso("cache_tts", lambda: CacheAudio(TTS_CACHE_DIR, int(TTS_CACHE_MAX_MB * 1024 * 1024)))
+semaforo_tts = asyncio.Semaphore(3)
+
+def partir_en_frases(texto, max_chars=220):
+    """Corta por oraciones y las agrupa hasta max_chars: la primera nota de voz sale rápido"""
+    frases = [f.strip() for f in re.split(r"(?<=[.!?…])\s+|\n+", texto) if f.strip()]
+    trozos = []
+    for f in frases:
+        if trozos and len(trozos[-1]) + len(f) < max_chars and len(trozos) > 1: trozos[-1] += " " + f
+        else: trozos.append(f)
+    return trozos
+
+async def sintetizar_voz(texto, voz=TTS_VOZ, rate=TTS_RATE):
+    """MP3 en memoria (sin archivos temporales). Frases repetidas salen del cache sin sintetizar."""
+    clave = CacheAudio.clave(texto, voz, rate)
+    audio = await asyncio.to_thread(lambda: cache_audio.obtener(clave))  # disco (y la carpeta, la 1ra vez): fuera del loop
+    if audio: return audio
+    import edge_tts
+    buf = io.BytesIO()
+    async with semaforo_tts:
+        with metricas.medir("externo", servicio="tts", op="edge_tts"):
+            async for chunk in edge_tts.Communicate(texto, voz, rate=rate).stream():
+                if chunk["type"] == "audio": buf.write(chunk["data"])
+    audio = buf.getvalue()
+    if audio: await asyncio.to_thread(lambda: cache_audio.guardar(clave, audio))
+    return audio
+
 async def generar_audio_tts(texto, chat_id, context):
+    # Todas las frases se sintetizan en paralelo, pero se envían en orden apenas está cada una
+    tareas = [asyncio.ensure_future(sintetizar_voz(t)) for t in partir_en_frases(texto)]
     try:
-        archivo = f"voz_{random.randint(1000,9999)}.mp3"
-        await edge_tts.Communicate(texto, "es-MX-DaliaNeural", rate="+10%").save(archivo)
-        with open(archivo, 'rb') as audio: await context.bot.send_voice(chat_id=chat_id, voice=audio)
-        os.remove(archivo)
-    except: pass
+        for tarea in tareas:
+            audio = await tarea
+            if audio: await context.bot.send_voice(chat_id=chat_id, voice=audio)
+    except Exception as e: logger.error(f"Error TTS: {e}")
+    finally:
+        for tarea in tareas: tarea.cancel()
+
+# --- SCRAPING ITCH.IO (HTTP ASÍNCRONO + CACHE) ---
+http_async = None
+cache_assets = OrderedDict()  # tag -> (timestamp, [(titulo, link)])
+
+def obtener_http():
+    """Cliente HTTP compartido del loop del bot (pool de conexiones keep-alive)"""
+    global http_async
+    if http_async is None:
+        http_async = httpx.AsyncClient(
+            timeout=10, follow_redirects=True, headers={"User-Agent": "Mozilla/5.0"},
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10)
+        )
+    return http_async
+
+def parsear_game_cells(html_texto):
+    """Solo parsea las celdas de la grilla (SoupStrainer), no la página entera"""
+    from bs4 import BeautifulSoup, SoupStrainer
+    soup = BeautifulSoup(html_texto, "html.parser", parse_only=SoupStrainer("div", class_="game_cell"))
+    items = []
+    for g in soup.find_all("div", class_="game_cell"):
+        titulo, link = g.find("div", class_="game_title"), g.find("a", href=True)
+        if titulo and link: items.append((titulo.text.strip(), link["href"]))
+    return items
+
+async def buscar_assets_itch(tag):
+    """Assets gratis de un tag de itch.io; cada tag queda en cache ASSETS_TTL_SEG"""
+    en_cache = cache_assets.get(tag)
+    if en_cache and time.time() - en_cache[0] < ASSETS_TTL_SEG: return en_cache[1]
+    with metricas.medir("externo", servicio="itch", op="tag"):
+        r = await obtener_http().get(f"https://itch.io/game-assets/free/tag-{tag}")
+    if r.status_code != 200: return []
+    items = await asyncio.to_thread(parsear_game_cells, r.text)
+    cache_assets[tag] = (time.time(), items)
+    cache_assets.move_to_end(tag)
+    while len(cache_assets) > 200: cache_assets.popitem(last=False)
+    return items
+
+# --- GENERACIÓN DE IMÁGENES (COLA + CACHE) ---
+class GeneradorImagenes:
+    """Descargas sin bloquear el loop, con límite global de concurrencia, posición en cola,
+    fusión de pedidos idénticos en vuelo y cache LRU por (prompt, seed, tamaño, modelo)"""
+    def __init__(self, max_concurrencia, max_bytes):
+        self.semaforo = asyncio.Semaphore(max(1, max_concurrencia))
+        self.cola = deque()  # un Event por pedido esperando turno, en orden de llegada
+        self.avisos = set()  # tareas que editan la posición (referencia para que no las recolecte el GC)
+        self.en_vuelo = {}
+        self.cache = OrderedDict()
+        self.total, self.max_bytes = 0, max_bytes
+
+    def url(self, prompt, seed, ancho, alto, modelo):
+        params = urllib.parse.urlencode({"width": ancho, "height": alto, "seed": seed, "model": modelo, "nologo": "true"})
+        return f"{IMAGEN_URL_BASE}{urllib.parse.quote(prompt)}?{params}"
+
+    async def generar(self, prompt, seed, ancho=1024, alto=1024, modelo="flux", al_encolar=None):
+        clave = (prompt, seed, ancho, alto, modelo)
+        if clave in self.cache:
+            self.cache.move_to_end(clave)
+            return self.cache[clave]
+        tarea = self.en_vuelo.get(clave)
+        if tarea is None:
+            tarea = asyncio.ensure_future(self._descargar(clave, al_encolar))
+            self.en_vuelo[clave] = tarea
+            tarea.add_done_callback(lambda _t: self.en_vuelo.pop(clave, None))
+        return await asyncio.shield(tarea)
+
+    async def _seguir_posicion(self, turno, al_encolar):
+        """Edita el aviso cada vez que el pedido avanza en la cola (siempre con la posición más
+        reciente, sin acumular ediciones viejas); al salir avisa con posición 0"""
+        mostrada = 0
+        while True:
+            turno.clear()
+            posicion = self.cola.index(turno) + 1 if turno in self.cola else 0
+            if posicion != mostrada:
+                try: await al_encolar(posicion)
+                except Exception: pass  # el aviso es cosmético
+                mostrada = posicion
+            if not posicion: return
+            await turno.wait()
+
+    async def _descargar(self, clave, al_encolar):
+        if self.semaforo.locked():
+            turno = asyncio.Event()  # se marca cada vez que la cola avanza
+            self.cola.append(turno)
+            if al_encolar:
+                aviso = asyncio.ensure_future(self._seguir_posicion(turno, al_encolar))
+                self.avisos.add(aviso)
+                aviso.add_done_callback(self.avisos.discard)
+            try: await self.semaforo.acquire()
+            finally:
+                self.cola.remove(turno)
+                turno.set()
+                for otro in self.cola: otro.set()
+        else: await self.semaforo.acquire()
+        try:
+            with metricas.medir("externo", servicio="imagen", op="generar"):
+                r = await obtener_http().get(self.url(*clave), timeout=IMAGEN_TIMEOUT)
+        finally:
+            self.semaforo.release()
+        if r.status_code != 200 or not r.content: raise RuntimeError(f"Servidor de imágenes respondió {r.status_code}")
+        self.cache[clave] = r.content
+        self.total += len(r.content)
+        while self.total > self.max_bytes and len(self.cache) > 1:
+            self.total -= len(self.cache.popitem(last=False)[1])
+        return r.content
+
+generador_imagenes = GeneradorImagenes(IMAGEN_MAX_CONCURRENCIA, int(IMAGEN_CACHE_MB * 1024 * 1024))
 
 # --- RUTINAS ---
 async def rutina_buenos_dias(context: ContextTypes.DEFAULT_TYPE):
@@ -296,15 +1875,10 @@ async def vigilancia_proactiva(context: ContextTypes.DEFAULT_TYPE):
         temas = ["pixel-art", "sprites", "textures", "backgrounds", "chiptune", "fonts"]
         tema_del_dia = random.choice(temas)
         
-        headers = {'User-Agent': 'Mozilla/5.0'}
         # Usamos el tema aleatorio
-        r = requests.get(f"https://itch.io/game-assets/free/tag-{tema_del_dia}", headers=headers, timeout=10)
-        soup = BeautifulSoup(r.text, 'html.parser')
-        games = soup.find_all('div', class_='game_cell')
+        games = await buscar_assets_itch(tema_del_dia)
         if games:
-            pick = random.choice(games[:5])
-            title = pick.find('div', class_='game_title').text.strip()
-            link = pick.find('a')['href']
+            title, link = random.choice(games[:5])
             await context.bot.send_message(chat_id=MY_CHAT_ID, text=f"🎁 **Asset:** [{title}]({link})", parse_mode="Markdown")
     except: pass
 
@@ -313,42 +1887,60 @@ async def post_init(app):
     global global_app_loop
     global_app_loop = asyncio.get_running_loop()
 
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
     s = AsyncIOScheduler()
     tz = pytz.timezone('America/Mexico_City')
-    s.add_job(rutina_buenos_dias, 'cron', hour=8, minute=0, timezone=tz, args=[app])
-    s.add_job(vigilancia_proactiva, 'cron', hour=13, minute=0, timezone=tz, args=[app])
-    s.add_job(vigilancia_proactiva, 'cron', hour=19, minute=0, timezone=tz, args=[app])
+    # Todas las réplicas agendan los cron, pero solo la líder los corre (una vez por horario)
+    s.add_job(solo_lider(rutina_buenos_dias), 'cron', hour=8, minute=0, timezone=tz, args=[app])
+    s.add_job(solo_lider(vigilancia_proactiva), 'cron', hour=13, minute=0, timezone=tz, args=[app])
+    s.add_job(solo_lider(vigilancia_proactiva), 'cron', hour=19, minute=0, timezone=tz, args=[app])
+    s.add_job(estado_compartido.renovar, 'interval', seconds=LIDER_TTL_SEG / 3, next_run_time=datetime.now(tz))
+    # Función síncrona: APScheduler la corre en su pool de hilos, no en el loop del bot
+    s.add_job(refrescar_metricas_github, 'interval', minutes=METRICAS_GITHUB_MIN, next_run_time=datetime.now(tz))
     s.start()
     logger.info("⏰ Cronograma OK")
 
+    # Readiness: Telegram ya respondió (initialize hace getMe) y el cron corre
+    tiempos_arranque["listo"] = time.perf_counter() - T_ARRANQUE
+    bot_listo.set()
+    logger.info(f"🚀 Arranque: {reporte_arranque()}")
+    threading.Thread(target=precalentar_clientes, daemon=True).start()
+
 # --- COMANDOS (RESTAURADOS) ---
 async def cmd_imagina(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    prompt = " ".join(context.args)
-    if not prompt: return await update.message.reply_text("🎨 Uso: `/imagina robot`")
+    # Opciones: seed=42 size=512x512 model=flux (con la misma seed, repetir el pedido es instantáneo)
+    palabras, opciones = [], {}
+    for a in context.args:
+        k, sep, v = a.partition("=")
+        if sep and k in ("seed", "size", "model"): opciones[k] = v
+        else: palabras.append(a)
+    prompt = " ".join(palabras)
+    if not prompt: return await update.message.reply_text("🎨 Uso: `/imagina robot` (opcional: seed=42 size=512x512)")
+    try:
+        seed = int(opciones.get("seed") or random.randint(1, 1_000_000))
+        ancho, alto = (min(2048, max(64, int(x))) for x in opciones.get("size", "1024x1024").lower().split("x"))
+    except ValueError: return await update.message.reply_text("⚠️ seed o size inválidos.")
     msg = await update.message.reply_text(f"🎨 Imaginando '{prompt}'...")
-    seed = random.randint(1, 1e6)
-    url = f"https://image.pollinations.ai/prompt/{prompt.replace(' ','%20')}?width=1024&height=1024&seed={seed}&model=flux&nologo=true"
+
+    async def avisar_cola(posicion):
+        await msg.edit_text(f"🎨 En cola (posición {posicion})... '{prompt}'" if posicion else f"🎨 Imaginando '{prompt}'...")
+
     try:
-        r = requests.get(url, timeout=20)
-        if r.status_code == 200: await update.message.reply_photo(photo=r.content); await msg.delete()
-        else: await msg.edit_text("⚠️ Error imagen.")
-    except: await msg.edit_text("⚠️ Error conexión.")
+        imagen = await generador_imagenes.generar(prompt, seed, ancho, alto, opciones.get("model", "flux"), avisar_cola)
+        await update.message.reply_photo(photo=imagen, caption=f"seed={seed}")
+        await msg.delete()
+    except httpx.HTTPError: await msg.edit_text("⚠️ Error conexión.")
+    except Exception: await msg.edit_text("⚠️ Error imagen.")
 
 async def cmd_assets(update: Update, context: ContextTypes.DEFAULT_TYPE):
     tag = " ".join(context.args).strip() or "pixel-art"
     await update.message.reply_chat_action("typing")
-    headers = {"User-Agent": "Mozilla/5.0"}
     try:
-        # URL corregida: Sin corchetes [] ni paréntesis () del markdown
-        url = f"https://itch.io/game-assets/free/tag-{tag}"
-        
-        r = requests.get(url, headers=headers, timeout=10)
-        soup = BeautifulSoup(r.text, 'html.parser')
-        games = soup.find_all('div', class_='game_cell')
+        games = await buscar_assets_itch(tag)
         
         if games:
             picks = random.sample(games, min(len(games), 3))
-            lista = [f"- [{g.find('div','game_title').text.strip()}]({g.find('a')['href']})" for g in picks]
+            lista = [f"- [{titulo}]({link})" for titulo, link in picks]
             await update.message.reply_text(f"🔍 **{tag}:**\n" + "\n".join(lista), parse_mode="Markdown")
         else: 
             await update.message.reply_text("❌ Nada encontrado.")
@@ -359,19 +1951,14 @@ async def cmd_assets(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cmd_arbol(u, c):
     if not repo_obj: return await u.message.reply_text("❌ Sin Repo")
     await u.message.reply_chat_action("typing")
-    try:
-        q = [repo_obj.get_contents("")]
-        msg = "📂 **Repo:**\n"
-        count = 0
-        while q and count < 20:
-            items = q.pop(0)
-            if not isinstance(items, list): items = [items]
-            for i in items:
-                msg += f"{'📁' if i.type=='dir' else '📄'} {i.path}\n"
-                if i.type == "dir": q.append(repo_obj.get_contents(i.path))
-                count += 1
-        await u.message.reply_text(msg)
-    except: await u.message.reply_text("Error repo.")
+    indice = await asyncio.to_thread(obtener_indice_repo)
+    if not indice: return await u.message.reply_text("Error repo.")
+    # Mismo orden que recorrer por niveles, pero sale de un único árbol recursivo
+    entradas = sorted([(d, True) for d in indice["dirs"]] + [(r, False) for r in indice["rutas"]],
+                      key=lambda e: (e[0].count("/"), e[0]))
+    msg = "📂 **Repo:**\n" + "".join(f"{'📁' if es_dir else '📄'} {p}\n" for p, es_dir in entradas[:20])
+    if len(entradas) > 20: msg += f"… y {len(entradas) - 20} más\n"
+    await u.message.reply_text(msg)
 
 async def cmd_leer(u, c):
     if not c.args: return await u.message.reply_text("Uso: /leer archivo")
@@ -379,10 +1966,10 @@ async def cmd_leer(u, c):
     try:
         archivo = c.args[0].strip()
         # Leemos el contenido
-        code = repo_obj.get_contents(archivo).decoded_content.decode()
+        code = await asyncio.to_thread(leer_archivo_repo, archivo)
         
-        # Guardamos en memoria volátil
-        global ultimo_codigo_leido; ultimo_codigo_leido = code
+        # Guardamos en la sesión del chat
+        sesion_del_chat(u).recordar_codigo(code)
         
         # --- FIX DE SEGURIDAD PARA TELEGRAM ---
         # 1. Limpiamos caracteres que rompen HTML (<, >, &)
@@ -397,13 +1984,33 @@ async def cmd_leer(u, c):
     except Exception as e: 
         await u.message.reply_text(f"⚠️ {e}")
 
+async def cmd_restaurar(u, c):
+    if not c.args: return await u.message.reply_text("Uso: /restaurar src/main.c [n | sha]")
+    if not repo_obj: return await u.message.reply_text("❌ Sin Repo")
+    ruta = c.args[0].strip()
+    try:
+        if len(c.args) == 1:
+            versiones = await asyncio.to_thread(versiones_backup, ruta)
+            if not versiones: return await u.message.reply_text(f"📭 Sin backups de {ruta}")
+            lineas = [f"{i}. `{v['sha'][:7]}` {datetime.fromtimestamp(v['ts']).strftime('%d/%m %H:%M')}"
+                      for i, v in enumerate(versiones, 1)]
+            return await u.message.reply_text(f"🗂️ Backups de `{ruta}`:\n" + "\n".join(lineas) +
+                                              f"\n\nRestaurar: `/restaurar {ruta} 1`", parse_mode="Markdown")
+        await u.message.reply_text(await asyncio.to_thread(restaurar_backup, ruta, c.args[1].strip()))
+    except Exception as e: await u.message.reply_text(f"⚠️ {e}")
+
 async def cmd_run(u, c):
     code = u.message.text.replace("/run", "").strip()
     if any(x in code for x in ["os.system", "rm -rf"]): return await u.message.reply_text("⛔")
-    old = sys.stdout; sys.stdout = new = io.StringIO()
-    try: exec(code); await u.message.reply_text(f"```\n{new.getvalue()}\n```", parse_mode="Markdown")
+    # Sin tocar sys.stdout (es de todo el proceso): el print del código va al buffer de ESTE pedido
+    salida = io.StringIO()
+    def imprimir(*a, **k):
+        k.setdefault("file", salida)
+        print(*a, **k)
+    try:
+        await asyncio.to_thread(exec, code, {**globals(), "print": imprimir})
+        await u.message.reply_text(f"```\n{salida.getvalue()}\n```", parse_mode="Markdown")
     except Exception as e: await u.message.reply_text(f"💥 {e}")
-    finally: sys.stdout = old
 
 async def cmd_codear(update: Update, context: ContextTypes.DEFAULT_TYPE):
     peticion = " ".join(context.args)
@@ -413,29 +2020,14 @@ async def cmd_codear(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     msg_espera = await update.message.reply_text("🧠 *Lía está leyendo el código actual y pensando...*")
 
-    # 1. Identificar archivo objetivo (Default: src/main.c)
-    archivo_target = "src/main.c"
-    archivos_en_repo = []
-    
-    try:
-        contents = repo_obj.get_contents("")
-        while contents:
-            file_content = contents.pop(0)
-            if file_content.type == "dir":
-                contents.extend(repo_obj.get_contents(file_content.path))
-            else:
-                archivos_en_repo.append(file_content.path)
-                # Si el usuario mencionó un archivo específico, lo usamos
-                if file_content.path in peticion:
-                    archivo_target = file_content.path
-    except:
-        pass
+    # 1. Identificar archivo objetivo (Default: src/main.c) con el índice del repo
+    indice = await asyncio.to_thread(obtener_indice_repo)
+    archivo_target = resolver_ruta_repo(peticion, indice, "src/main.c")
 
     # 2. LEER CÓDIGO ACTUAL (CRÍTICO PARA EVITAR PANTALLA BLANCA)
     codigo_actual_contexto = ""
     try:
-        file_obj = repo_obj.get_contents(archivo_target)
-        codigo_actual_contexto = file_obj.decoded_content.decode()
+        codigo_actual_contexto = await asyncio.to_thread(leer_archivo_repo, archivo_target, fresco=True)
     except:
         codigo_actual_contexto = "// No se pudo leer el archivo actual o no existe."
 
@@ -462,31 +2054,36 @@ async def cmd_codear(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
 
     # 4. Llamar al cerebro
-    respuesta = cerebro_lia(prompt, "Senior Dev")
+    respuesta = await cerebro_lia(prompt, "Senior Dev")
 
-    # 5. Procesar respuesta (El backup se hace automáticamente dentro de subir_archivo_github)
+    # 5. Procesar respuesta (subir_cambios_github respalda la versión anterior fuera del árbol)
     archivos = re.findall(r"\[\[FILE:\s*(.*?)\]\]\s*\n(.*?)\s*\[\[ENDFILE\]\]", respuesta, re.DOTALL)
     
     if not archivos:
         await msg_espera.edit_text("⚠️ La IA no devolvió el formato correcto. Intenta ser más específico.")
         return
 
-    res_final = []
+    cambios = []
     for ruta_raw, contenido in archivos:
         ruta = ruta_raw.strip()
         contenido_limpio = contenido.replace("```c", "").replace("```", "").strip()
-        
-        # subir_archivo_github YA TIENE lógica de backup interna.
-        # Al enviarle el contenido nuevo, moverá el viejo a backups/ automáticamente.
-        resultado = subir_archivo_github(ruta, contenido_limpio, msg=f"🤖 IA: {peticion}")
-        res_final.append(f"✅ {resultado}")
+        cambios.append((ruta, contenido_limpio))
 
+    # Todos los archivos en un solo commit atómico (una sola corrida de CI)
+    resultados = await asyncio.to_thread(subir_cambios_github, cambios, msg=f"🤖 IA: {peticion}")
     await msg_espera.delete()
+    if commit_fallido(resultados):
+        return await update.message.reply_text("❌ No se aplicaron los cambios:\n" + "\n".join(resultados))
+    res_final = [f"✅ {r}" for r in resultados]
     await update.message.reply_text(f"🚀 **Cambios aplicados:**\n" + "\n".join(res_final))
 
 async def cmd_conectar(u, c):
-    global repo_obj
-    try: repo_obj = gh_client.get_repo(c.args[0])
+    # El repo queda en la sesión de ESTE chat; los demás siguen con el suyo
+    sesion = sesion_del_chat(u)
+    try:
+        sesion.repo = await asyncio.to_thread(gh_client.get_repo, c.args[0])
+        repo_sesion.set(sesion.repo)
+        sesion.version_repo = await asyncio.to_thread(estado_compartido.guardar_repo_chat, sesion.chat_id, sesion.repo.full_name)
     except: pass
     await u.message.reply_text(f"🐙 Conectado: {repo_obj.full_name if repo_obj else 'No'}")
 
@@ -495,8 +2092,14 @@ async def cmd_pendientes(u, c): t = obtener_tareas_db(); await u.message.reply_t
 async def cmd_hecho(u, c): 
     if c.args: cerrar_tarea_db(int(c.args[0])); await u.message.reply_text("🔥")
 async def cmd_status(u, c):
-    f, s = obtener_metricas_github_real()
-    await u.message.reply_text(f"📊 **Lía v8.0 (Full + AutoFix)**\nDB: {bool(supabase)}\nRepo: {repo_obj.full_name if repo_obj else 'No'}\nStars: {s}")
+    f, s, edad = obtener_metricas_github_real()
+    cs = cache_contenidos.stats()
+    await u.message.reply_text(f"📊 **Lía v8.0 (Full + AutoFix)**\nDB: {bool(supabase)}\nRepo: {repo_obj.full_name if repo_obj else 'No'}\n"
+                               f"Stars: {s} | Seguidores: {f} ({describir_edad(edad)})\n"
+                               f"Cache archivos: {cs['hits']} hits / {cs['misses']} misses ({cs['bytes'] // 1024} KB)\n"
+                               f"Réplica: {INSTANCIA_ID} ({'líder' if estado_compartido.soy_lider() else 'seguidora'}, "
+                               f"{'webhook' if TELEGRAM_WEBHOOK_URL else 'polling'})\n"
+                               f"Arranque: {reporte_arranque()}")
 
 async def cmd_review(u, c):
     if not c.args: return await u.message.reply_text("Uso: /review src/main.c")
@@ -507,27 +2110,44 @@ async def cmd_review(u, c):
     
     try:
         # 1. Leer código
-        codigo = repo_obj.get_contents(archivo).decoded_content.decode()
+        codigo = await asyncio.to_thread(leer_archivo_repo, archivo)
         
         # 2. Prompt de Auditoría
-        prompt = f"""
-        [MODO: SENIOR CODE REVIEWER]
-        Analiza el siguiente código C para Game Boy Advance.
-        NO ESCRIBAS CÓDIGO NUEVO. Solo dame un reporte de auditoría.
-        
+        aspectos = """
         Aspectos a criticar:
         1. Legibilidad (nombres de variables, indentación).
         2. Optimización (uso de memoria, bucles innecesarios).
         3. Posibles bugs o malas prácticas en C.
         4. Sugerencias de mejora.
-        
+        """
+        titulo = f"🧐 **Reporte de {archivo}:**\n\n"
+        vivo = MensajeEnVivo(u.message)
+        if len(codigo) <= REVIEW_CHUNK_CHARS:
+            prompt = f"""
+        [MODO: SENIOR CODE REVIEWER]
+        Analiza el siguiente código C para Game Boy Advance.
+        NO ESCRIBAS CÓDIGO NUEVO. Solo dame un reporte de auditoría.
+        {aspectos}
         [CÓDIGO]
-        {codigo[:3000]}
+        {codigo}
+        """
+        else:
+            # Archivo grande: cada función se revisa en paralelo (map) y se unifica (reduce)
+            await vivo.actualizar(f"🔎 Revisando {archivo} por partes ({len(codigo) // 1024} KB)...")
+            hallazgos = await analizar_por_partes(archivo, codigo, "Reporte de auditoría del fragmento." + aspectos)
+            prompt = f"""
+        [MODO: SENIOR CODE REVIEWER - UNIFICAR]
+        Estos son los hallazgos de revisar {archivo} por partes ({len(hallazgos)} fragmentos).
+        Únelos en UN solo reporte de auditoría: agrupa por aspecto, quita repetidos,
+        conserva los números de línea y ordena por gravedad. NO ESCRIBAS CÓDIGO NUEVO.
+
+        [HALLAZGOS]
+        {chr(10).join(hallazgos)}
         """
         
-        # 3. Respuesta
-        respuesta = cerebro_lia(prompt, "Senior Reviewer")
-        await u.message.reply_text(f"🧐 **Reporte de {archivo}:**\n\n{respuesta}", parse_mode="Markdown")
+        # 3. Respuesta (se va mostrando mientras se genera)
+        respuesta = await cerebro_lia(prompt, "Senior Reviewer", al_avanzar=lambda t: vivo.actualizar(titulo + t))
+        await vivo.cerrar(titulo + respuesta)
         
     except Exception as e:
         await u.message.reply_text(f"⚠️ No pude leer {archivo}: {e}")
@@ -548,22 +2168,20 @@ async def cmd_gba(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Pregunta: {pregunta}
     """
     
-    respuesta = cerebro_lia(prompt, "GBA Engineer")
-    
+    # La respuesta se escribe sobre el mensaje de "Pensando..." a medida que llega.
     # --- BLINDAJE ANTI-ERROR DE TELEGRAM ---
-    try:
-        # 1. Intentamos enviar con formato Markdown (Bonito)
-        await update.message.reply_text(respuesta, parse_mode='Markdown')
-    except Exception:
-        # 2. Si falla (porque el código C tiene guiones bajos _ que confunden a Telegram),
-        # lo enviamos como texto plano. Se ve menos bonito pero SIEMPRE LLEGA.
-        await update.message.reply_text(respuesta)
-
-    # Borramos el mensaje de "Pensando..." para limpiar el chat
-    try:
-        await avisar.delete()
-    except:
-        pass
+    # cerrar() intenta Markdown y, si el código C tiene guiones bajos _ que confunden a Telegram,
+    # lo deja como texto plano. Se ve menos bonito pero SIEMPRE LLEGA.
+    vivo = MensajeEnVivo(update.message, primero=avisar)
+    respuesta = await cerebro_lia(prompt, "GBA Engineer", al_avanzar=vivo.actualizar)
+    await vivo.cerrar(respuesta)
+
+async def cmd_voz(u, c):
+    """Lee el texto en voz alta: una nota de voz por frase, la primera sale sin esperar al resto"""
+    texto = " ".join(c.args)
+    if not texto: return await u.message.reply_text("🎙️ Uso: `/voz texto a leer`", parse_mode="Markdown")
+    await u.message.reply_chat_action("record_voice")
+    await generar_audio_tts(texto, u.effective_chat.id, c)
 
 # FÍJATE AQUÍ: Esta línea debe estar TOTALMENTE a la izquierda, sin espacios.
 async def cmd_readme(u, c):
@@ -574,15 +2192,23 @@ async def cmd_readme(u, c):
     
     try:
         try:
-            main_code = repo_obj.get_contents("src/main.c").decoded_content.decode()
+            main_code = await asyncio.to_thread(leer_archivo_repo, "src/main.c")
         except:
             main_code = "No se encontró main.c"
 
+        # main.c grande: en vez de cortarlo, se resume cada parte en paralelo
+        if len(main_code) > REVIEW_CHUNK_CHARS:
+            notas = await analizar_por_partes("src/main.c", main_code,
+                                              "Resume en 3-5 viñetas qué hace este fragmento: funciones, sistemas del juego y hardware que usa.")
+            seccion_codigo = "[RESUMEN DEL CÓDIGO PRINCIPAL POR PARTES]\n" + "\n".join(notas)
+        else:
+            seccion_codigo = f"[CÓDIGO PRINCIPAL]\n{main_code}"
+
         # TÉCNICA SEGURA TAMBIÉN AQUÍ
         prompt = (
             "[ROL: TECHNICAL WRITER]\n"
             "Genera un archivo README.md profesional para este proyecto de GBA.\n\n"
-            f"[CÓDIGO PRINCIPAL]\n{main_code[:2000]}\n\n"
+            f"{seccion_codigo}\n\n"
             "[REQUISITOS]\n"
             "1. Título Creativo (Invéntalo basado en el código).\n"
             "2. Descripción: Qué hace el juego/demo.\n"
@@ -591,21 +2217,31 @@ async def cmd_readme(u, c):
             "5. Formato: Markdown bonito (badges, emojis)."
         )
         
-        contenido_readme = cerebro_lia(prompt, "Tech Writer")
+        contenido_readme = await cerebro_lia(prompt, "Tech Writer")
         
-        res = subir_archivo_github("README.md", contenido_readme, "Docs: Auto-update README")
+        res = await asyncio.to_thread(subir_archivo_github, "README.md", contenido_readme, "Docs: Auto-update README")
+        if commit_fallido(res): return await u.message.reply_text(f"❌ README no actualizado: {res}")
         await u.message.reply_text(f"✅ **Documentación actualizada:**\n{res}")
         
     except Exception as e:
         await u.message.reply_text(f"❌ Error: {e}")
 
 async def handle_photo(u: Update, c: ContextTypes.DEFAULT_TYPE):
-    """Recibe imágenes, fuerza 64x64 y paleta reducida"""
+    """Recibe imágenes y las exporta como tiles 4bpp/8bpp para GBA.
+    Opciones en el pie de foto: '8bpp', 'bg' (tiles únicos + mapa), 'mode3' (array lineal)
+    y 'bin' (blobs en data/ comprimidos LZ77; con 'rle' o 'raw' se cambia la compresión)"""
     if not MY_CHAT_ID or str(u.effective_chat.id) != MY_CHAT_ID: return
     if not repo_obj: return await u.message.reply_text("❌ Sin repo.")
 
     photo = u.message.photo[-1]
     file_id = photo.file_id
+    opciones = (u.message.caption or "").lower().split()
+    bpp = 8 if "8bpp" in opciones else 4
+    modo = "mode3" if "mode3" in opciones else ("bg" if "bg" in opciones else "obj")
+    binario = "bin" in opciones
+    if binario and modo == "mode3":
+        return await u.message.reply_text("⚠️ 'bin' solo aplica a tiles (obj/bg); Mode 3 se exporta como array en C.")
+    compresion = "rle" if "rle" in opciones else ("raw" if "raw" in opciones else "lz77")
     await u.message.reply_chat_action("upload_document")
     
     try:
@@ -613,34 +2249,54 @@ async def handle_photo(u: Update, c: ContextTypes.DEFAULT_TYPE):
         f_bytes = await new_file.download_as_bytearray()
         
         # --- PROCESAMIENTO GBA ESTRICTO ---
+        from PIL import Image
         img = Image.open(io.BytesIO(f_bytes))
         
-        # 1. Forzar Redimensionado (Max 64x64)
-        if img.width > 64 or img.height > 64:
-            img.thumbnail((64, 64), Image.Resampling.NEAREST) # Nearest mantiene el look pixel art
+        # 1. Forzar Redimensionado (Sprites max 64x64, fondos max 256x256 = un screenblock)
+        limite = 256 if modo == "bg" else 64
+        if img.width > limite or img.height > limite:
+            img.thumbnail((limite, limite), Image.Resampling.NEAREST) # Nearest mantiene el look pixel art
             await u.message.reply_text(f"⚠️ Redimensionado a {img.width}x{img.height} para GBA.")
             
-        # 2. Reducción de Colores (Simular 16 colores)
-        # Esto ayuda a que el sprite se vea "legítimo" de GBA
-        img = img.quantize(colors=16).convert("RGB")
+        # 2. Reducción de Colores (solo Mode 3; los tiles cuantizan a su propia paleta)
+        if modo == "mode3": img = img.quantize(colors=16).convert("RGB")
         
         # Convertir a bytes para la función de C
         img_byte_arr = io.BytesIO()
         img.save(img_byte_arr, format='PNG')
         f_final = img_byte_arr.getvalue()
 
-        hora = datetime.now().strftime('%M%S')
-        nombre_asset = f"sprite_{hora}" 
-        
-        c_code, h_code, w, h = convertir_imagen_a_gba(f_final, nombre_asset)
+        # Nombre por contenido (+ opciones): dos fotos distintas nunca se pisan y reenviar la misma no duplica
+        huella = hashlib.sha1(f_final + f"{modo}:{bpp}:{binario}:{compresion}".encode()).hexdigest()[:8]
+        nombre_asset = f"{'bg' if modo == 'bg' else 'sprite'}_{huella}"
         
         path_c = f"src/{nombre_asset}.c"
         path_h = f"src/{nombre_asset}.h"
         
-        subir_archivo_github(path_c, c_code, f"Art: Nuevo asset {nombre_asset}")
-        subir_archivo_github(path_h, h_code, f"Art: Header {nombre_asset}")
+        if modo == "mode3":
+            c_code, h_code, w, h = await asyncio.to_thread(convertir_imagen_a_gba, f_final, nombre_asset)
+            archivos = [(path_c, c_code), (path_h, h_code)]
+            detalle = f"📐 {w}x{h} px (Mode 3, 16bpp lineal)"
+        else:
+            if binario:
+                blobs, h_code, info = await asyncio.to_thread(exportar_tiles_bin_gba, f_final, nombre_asset, bpp, modo, compresion)
+                archivos = blobs + [(path_h, h_code)]
+                path_c = blobs[0][0]
+            else:
+                c_code, h_code, info = await asyncio.to_thread(convertir_imagen_a_tiles_gba, f_final, nombre_asset, bpp, modo)
+                archivos = [(path_c, c_code), (path_h, h_code)]
+            detalle = (
+                f"📐 {info['w']}x{info['h']} px | {bpp}bpp {modo.upper()} | {info['colores']} colores\n"
+                f"🧩 Tiles: {info['tiles_unicos']}/{info['tiles']} | "
+                f"💾 {info['bytes']} B (Mode 3: {info['bytes_mode3']} B)"
+            )
+            if binario: detalle += f"\n🗜️ {compresion.upper()}: {info['bytes_crudos']} B -> {info['bytes']} B"
         
-        msg = f"✅ **Sprite 4bpp (Simulado) Integrado:**\n📍 `{path_c}`\n📐 {w}x{h} px"
+        resultados = await asyncio.to_thread(subir_cambios_github, archivos, msg=f"Art: Nuevo asset {nombre_asset}")
+        if commit_fallido(resultados):
+            return await u.message.reply_text(f"❌ El asset no se subió: {resultados[0]}")
+        
+        msg = f"✅ **Asset GBA Integrado:**\n📍 `{path_c}`\n{detalle}"
         await u.message.reply_text(msg, parse_mode="Markdown")
         
     except Exception as e:
@@ -652,7 +2308,7 @@ async def cmd_debug_video(u, c):
     
     try:
         # Intentamos leer el main.c
-        code = repo_obj.get_contents("src/main.c").decoded_content.decode()
+        code = await asyncio.to_thread(leer_archivo_repo, "src/main.c")
         
         checklist = []
         # 1. Chequeo de Registros (Mode 3)
@@ -694,87 +2350,258 @@ def notificar_telegram(texto):
             logger.error(f"Fallo al notificar Telegram: {e}")
 
 # --- SERVER WEBHOOK & AUTO-FIX (CEREBRO CONTEXTUAL + WEB VISUAL) ---
+# --- PARSER DE DIAGNÓSTICOS GCC/LD + VENTANAS DE CÓDIGO ---
+# "src/main.c:55:3: error: ..." | "src/x.h:9: fatal error: ..." | "main.c:20:(.text+0x8): undefined reference to `f'"
+RE_DIAG_GCC = re.compile(
+    r"^(?P<archivo>[^\s:]+\.(?:c|h|s|S|cpp|hpp|inc)):(?P<linea>\d+):(?:(?P<col>\d+):)?\s*"
+    r"(?:\([^)]*\):\s*)?(?:(?P<tipo>fatal error|error|warning|note):\s*)?(?P<mensaje>.+)$"
+)
+RE_DIAG_LD = re.compile(r"(undefined reference to|multiple definition of|cannot find -l|region .* overflowed|ld returned)")
+
+def _ruta_relativa(ruta):
+    ruta = re.sub(r"^/home/runner/work/[^/]+/[^/]+/", "", ruta)
+    return ruta[2:] if ruta.startswith("./") else ruta
+
+def parsear_log_gcc(error_log):
+    """Extrae todos los diagnósticos de GCC y del linker: [{archivo, linea, col, tipo, mensaje}].
+    Los warnings se ignoran; las 'note' se guardan porque suelen señalar la declaración culpable."""
+    diags, vistos = [], set()
+    for crudo in error_log.splitlines():
+        linea = crudo.strip()
+        m = RE_DIAG_GCC.match(linea)
+        if m:
+            tipo = m.group("tipo") or ("error" if RE_DIAG_LD.search(linea) else None)
+            if tipo not in ("error", "fatal error", "note"): continue
+            archivo = _ruta_relativa(m.group("archivo"))
+            if archivo.startswith("/"): continue  # headers del sistema/devkitPro: no son nuestros
+            d = {"archivo": archivo, "linea": int(m.group("linea")), "col": int(m.group("col") or 0),
+                 "tipo": tipo, "mensaje": m.group("mensaje").strip()}
+        elif RE_DIAG_LD.search(linea):
+            d = {"archivo": None, "linea": 0, "col": 0, "tipo": "linker", "mensaje": _ruta_relativa(linea)}
+        else:
+            continue
+        clave = (d["archivo"], d["linea"], d["mensaje"])
+        if clave not in vistos:
+            vistos.add(clave)
+            diags.append(d)
+    return diags
+
+def descargar_archivos_repo(rutas):
+    """Baja varios archivos del repo en paralelo (los que ya están en cache no se bajan).
+    Devuelve {ruta: contenido o None}"""
+    repo = repo_actual()
+    if not repo or not rutas: return {}
+    # El CI puede estar fallando por un push ajeno: revalidamos el índice (1 llamada si nada cambió)
+    _revalidar_mapa_repo(repo)
+    def bajar(ruta):
+        try: return leer_archivo_repo(ruta, repo)
+        except Exception as e:
+            logger.error(f"No pude descargar {ruta}: {e}")
+            return None
+    with ThreadPoolExecutor(max_workers=min(8, len(rutas))) as pool:
+        return dict(zip(rutas, pool.map(bajar, rutas)))
+
+def ventanas_de_codigo(diags, archivos, contexto=None):
+    """Arma el contexto para el LLM: archivos chicos completos, grandes solo en ventanas
+    alrededor de las líneas con error. Devuelve (texto, {ruta: [(desde, hasta)]} de las ventanas)."""
+    contexto = AUTOFIX_CONTEXTO_LINEAS if contexto is None else contexto
+    partes, ventanas = [], {}
+    for ruta, codigo in archivos.items():
+        if codigo is None: continue
+        lineas = codigo.split("\n")
+        marcadas = {d["linea"] for d in diags if d["archivo"] == ruta and d["linea"]}
+        if len(lineas) <= AUTOFIX_LINEAS_COMPLETO or not marcadas:
+            partes.append(f"[ARCHIVO COMPLETO: {ruta}]\n{codigo}")
+            continue
+        # Rangos [l-ctx, l+ctx] fusionados cuando se solapan
+        rangos = []
+        for l in sorted(marcadas):
+            a, b = max(1, l - contexto), min(len(lineas), l + contexto)
+            if rangos and a <= rangos[-1][1] + 1: rangos[-1] = (rangos[-1][0], max(b, rangos[-1][1]))
+            else: rangos.append((a, b))
+        ventanas[ruta] = rangos
+        for a, b in rangos:
+            cuerpo = "\n".join(f"{'>>' if n in marcadas else '  '}{n:5d} | {lineas[n - 1]}" for n in range(a, b + 1))
+            partes.append(f"[VENTANA: {ruta}:{a}-{b}] ({len(lineas)} líneas en total)\n{cuerpo}")
+    return "\n\n".join(partes), ventanas
+
+def _limpiar_bloque(contenido):
+    contenido = re.sub(r"^```[a-z]*\s*", "", contenido.strip()).replace("```", "")
+    lineas = contenido.split("\n")
+    # Si el modelo copió la numeración de la ventana ("  12 | código"), se la quitamos
+    if lineas and all(re.match(r"^\s*(?:>>)?\s*\d+ \| ?", l) for l in lineas if l.strip()):
+        lineas = [re.sub(r"^\s*(?:>>)?\s*\d+ \| ?", "", l) for l in lineas]
+    return "\n".join(lineas)
+
+def aplicar_respuesta_fix(respuesta, archivos, ventanas):
+    """Convierte la respuesta del LLM en [(ruta, contenido nuevo)]: bloques [[FILE]] completos
+    y bloques [[WINDOW: ruta:a-b]] que reemplazan solo esas líneas del archivo original."""
+    cambios = {}
+    for ruta_raw, contenido in re.findall(r"\[\[FILE:\s*(.*?)\]\]\s*\n(.*?)\s*\[\[ENDFILE\]\]", respuesta, re.DOTALL):
+        ruta = ruta_raw.strip().split(" ")[0].replace("]", "").replace("[", "")
+        contenido_limpio = _limpiar_bloque(contenido).strip()
+        if len(contenido_limpio) >= 10: cambios[ruta] = contenido_limpio
+    parches = {}
+    for ruta, a, b, contenido in re.findall(r"\[\[WINDOW:\s*(.*?):(\d+)-(\d+)\]\]\s*\n(.*?)\n?\s*\[\[ENDWINDOW\]\]", respuesta, re.DOTALL):
+        ruta, a, b = ruta.strip(), int(a), int(b)
+        if (a, b) in ventanas.get(ruta, []) and ruta not in cambios:
+            parches.setdefault(ruta, []).append((a, b, _limpiar_bloque(contenido).rstrip("\n").split("\n")))
+    for ruta, lista in parches.items():
+        lineas = archivos[ruta].split("\n")
+        for a, b, nuevas in sorted(lista, reverse=True):  # de abajo hacia arriba: los números no se mueven
+            lineas[a - 1:b] = nuevas
+        cambios[ruta] = "\n".join(lineas)
+    return list(cambios.items())
+
+# --- ANTI-BUCLE DEL AUTO-FIX (FIRMAS, BACKOFF E INTENTOS; EN EL ESTADO COMPARTIDO) ---
+
+class FixOmitido(Exception):
+    """El auto-fix decidió no gastar LLM ni commits en este reporte"""
+
+def firma_errores(error_log):
+    """Huella de las líneas de error de GCC/ld, sin números de línea/columna ni rutas del runner"""
+    lineas = set()
+    for linea in error_log.splitlines():
+        if not re.search(r"error|undefined reference", linea, re.IGNORECASE): continue
+        linea = re.sub(r"/home/runner/work/[^/]+/[^/]+/", "", linea)
+        linea = re.sub(r":\d+(?::\d+)?", "", linea)
+        lineas.add(re.sub(r"\s+", " ", linea).strip())
+    base = "\n".join(sorted(lineas)) or error_log.strip()[-500:]
+    return hashlib.sha1(base.encode("utf-8")).hexdigest()[:16]
+
+def sha_blob_git(contenido):
+    """Mismo sha que calcula git para el blob, sin preguntarle a GitHub"""
+    datos = contenido.encode("utf-8")
+    return hashlib.sha1(b"blob %d\0" % len(datos) + datos).hexdigest()
+
+def registrar_intento_fix(firma, archivos):
+    """Dedupe por ventana (mismo error + mismos archivos), backoff exponencial por archivo
+    y tope de intentos por error, compartidos entre réplicas. archivos: {ruta: contenido}.
+    Lanza FixOmitido si no toca gastar un intento."""
+    rutas = sorted(archivos) or [""]
+    huella = firma + "".join(f":{r}@{sha_blob_git(archivos[r] or '')}" for r in rutas if r)
+    motivo, avisar = estado_compartido.registrar_intento_fix(firma, huella, rutas)
+    if avisar: notificar_telegram(f"🛑 **Auto-fix detenido:** {motivo}.\nRevisa el build a mano (`{', '.join(rutas) or 'general'}`).")
+    if motivo: raise FixOmitido(motivo)
+
+def limpiar_historial_fixes():
+    """Build verde: se olvidan intentos y backoffs (en todas las réplicas)"""
+    estado_compartido.limpiar_fixes()
+
+# --- COLA DE AUTO-FIX (FUERA DEL HILO HTTP; ESTADO EN EL ESTADO COMPARTIDO) ---
+pool_autofix = ThreadPoolExecutor(max_workers=AUTOFIX_WORKERS, thread_name_prefix="autofix")
+
+def _correr_trabajo_fix(id_trabajo, error_log):
+    inicio = time.time()
+    estado_compartido.actualizar_trabajo(id_trabajo, estado="procesando", inicio=inicio)
+    try:
+        resultado, estado = WebhookHandler.procesar_error_github(error_log), "ok"
+    except FixOmitido as e:
+        logger.info(f"⏭️ Auto-fix {id_trabajo} omitido: {e}")
+        resultado, estado = str(e), "omitido"
+    except Exception as e:
+        logger.error(f"Fallo en auto-fix {id_trabajo}: {e}")
+        resultado, estado = str(e), "error"
+    fin = time.time()
+    estado_compartido.actualizar_trabajo(id_trabajo, estado=estado, fin=fin, resultado=resultado)
+    metricas.observar("lia_autofix_seconds", fin - inicio, estado=estado)
+
+def _trabajos_por_estado():
+    cuenta = estado_compartido.trabajos_por_estado()
+    return [({"estado": e}, cuenta.get(e, 0)) for e in ("en_cola", "procesando", "ok", "omitido", "error")]
+
+metricas.registrar_lectura("lia_autofix_trabajos", "gauge", _trabajos_por_estado)
+
+def encolar_fix(error_log):
+    """Registra el trabajo y lo manda al pool. Devuelve (id, es_duplicado); id None si la cola está llena.
+    Si ya hay un trabajo activo con la misma firma de error (en cualquier réplica), se devuelve ese."""
+    id_trabajo, duplicado = estado_compartido.encolar_trabajo(firma_errores(error_log), AUTOFIX_COLA_MAX)
+    if id_trabajo and not duplicado: pool_autofix.submit(_correr_trabajo_fix, id_trabajo, error_log)
+    return id_trabajo, duplicado
+
 class WebhookHandler(BaseHTTPRequestHandler):
-    def _set_response(self):
-        self.send_response(200)
+    def _set_response(self, code=200):
+        self.send_response(code)
         self.send_header('Content-type', 'application/json')
         self.end_headers()
 
-    def obtener_codigo_actual(self, error_log):
-        """Intenta deducir qué archivo falló y descargarlo de GitHub"""
-        # Buscamos patrones como "src/main.c:55: error:"
-        match = re.search(r"([a-zA-Z0-9_\/]+\.c):\d+", error_log)
-        if match:
-            ruta = match.group(1)
-            try:
-                # Usamos la variable global repo_obj
-                file_content = repo_obj.get_contents(ruta).decoded_content.decode()
-                return ruta, file_content
-            except Exception as e:
-                logger.error(f"No pude descargar {ruta}: {e}")
-                return ruta, None
-        return None, None
-
-    def procesar_error_github(self, error_log):
-        """Lia lee el CÓDIGO ACTUAL + EL ERROR y repara solo lo necesario"""
+    def _responder_json(self, data, code=200):
+        self._set_response(code)
+        self.wfile.write(json.dumps(data).encode('utf-8'))
+
+    def _token_ci_valido(self):
+        """CI_WEBHOOK_TOKEN en 'Authorization: Bearer ...' (o 'X-Lia-Token'). Sin token configurado: False"""
+        if not CI_WEBHOOK_TOKEN: return False
+        dado = self.headers.get("X-Lia-Token") or self.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+        return hmac.compare_digest(dado.encode(), CI_WEBHOOK_TOKEN.encode())
+
+    @staticmethod
+    def obtener_codigo_actual(error_log):
+        """Parsea TODOS los diagnósticos del log y baja en paralelo cada archivo culpable.
+        Devuelve (diagnósticos, {ruta: contenido o None})"""
+        diags = parsear_log_gcc(error_log)
+        rutas = list(dict.fromkeys(d["archivo"] for d in diags if d["archivo"]))
+        return diags, descargar_archivos_repo(rutas)
+
+    @staticmethod
+    def procesar_error_github(error_log):
+        """Lia lee el CÓDIGO ACTUAL + EL ERROR y repara solo lo necesario (corre en pool_autofix)"""
         logger.info("🚨 ERROR DE COMPILACIÓN - INICIANDO PROTOCOLO DE REPARACIÓN")
         
-        # 1. Identificar archivo culpable y leer su contenido
-        archivo_culpable, codigo_roto = self.obtener_codigo_actual(error_log)
-        
-        contexto_archivo = ""
-        if archivo_culpable and codigo_roto:
-            logger.info(f"🧐 Analizando archivo: {archivo_culpable}")
-            contexto_archivo = f"""
-            [CÓDIGO ACTUAL EN REPO (ROTO)]
-            Nombre: {archivo_culpable}
-            Contenido:
-            ```c
-            {codigo_roto}
-            ```
-            """
-            notificar_telegram(f"🚨 **Fallo en {archivo_culpable}**\n`{error_log[:200]}...`\n\n*Lia está leyendo el archivo para corregirlo...*")
+        # 1. Identificar archivos culpables y leer su contenido
+        diags, archivos = WebhookHandler.obtener_codigo_actual(error_log)
+        archivos = {r: c for r, c in archivos.items() if c is not None}
+        
+        # 2. Anti-bucle: ¿ya intentamos esto mismo? (lanza FixOmitido antes de gastar LLM/commits)
+        registrar_intento_fix(firma_errores(error_log), archivos)
+        
+        contexto_archivo, ventanas = ventanas_de_codigo(diags, archivos)
+        if archivos:
+            logger.info(f"🧐 Analizando: {', '.join(archivos)} ({len(diags)} diagnósticos)")
+            notificar_telegram(f"🚨 **Fallo en {', '.join(archivos)}**\n`{error_log[:200]}...`\n\n*Lia está leyendo el código para corregirlo...*")
         else:
             notificar_telegram(f"🚨 **Error General:**\n`{error_log[:200]}...`\n\n*Lia intentará arreglarlo a ciegas...*")
 
-        # 2. Prompt de Ingeniería Quirúrgica
+        # Solo los diagnósticos parseados; el log crudo (recortado) únicamente si no se entendió nada
+        errores = "\n".join(
+            f"- {d['archivo'] + ':' + str(d['linea']) if d['archivo'] else 'ld'}: {d['tipo']}: {d['mensaje']}" for d in diags
+        ) or error_log[-3000:]
+        formato = "[[FILE: ruta/archivo.c]] código completo [[ENDFILE]] para los ARCHIVOS COMPLETOS"
+        if ventanas:
+            formato += (" y [[WINDOW: ruta:desde-hasta]] líneas corregidas [[ENDWINDOW]] para cada VENTANA "
+                        "(mismo rango exacto, SIN números de línea, devuelve la ventana entera)")
+
+        # 3. Prompt de Ingeniería Quirúrgica
         prompt_fix = f"""
         [MODO: SENIOR SOFTWARE ENGINEER]
         Tienes un error de compilación en un proyecto GBA.
         
-        {contexto_archivo}
+        [CÓDIGO ACTUAL EN REPO (ROTO) - las líneas con >> son las que reporta GCC]
+        {contexto_archivo or 'No se pudo identificar/leer el archivo. Asume src/main.c.'}
         
-        [ERRORES REPORTADOS POR GCC]
-        {error_log}
+        [ERRORES REPORTADOS POR GCC/LD]
+        {errores}
         
         [TU MISIÓN - CRÍTICO]
         1. **NO REESCRIBAS LA LÓGICA:** Tu único trabajo es arreglar el error de sintaxis o compilación.
         2. **PRESERVA EL CÓDIGO:** Si el usuario tenía un cuadrado azul, DEBE SEGUIR SIENDO AZUL. No inventes "Hola Mundo" ni pantallas blancas.
         3. **CORRIGE EL ERROR:** Si falta una llave '}}', ponla. Si falta un ';', ponlo. Si hay un '?' sabotaje, bórralo.
-        4. **SALIDA:** Devuelve el archivo {archivo_culpable or 'src/main.c'} COMPLETO y CORREGIDO.
+        4. **TODOS LOS ARCHIVOS:** Corrige todos los archivos con errores en esta misma respuesta.
         
-        Responde formato: [[FILE: ruta/archivo.c]] código [[ENDFILE]].
+        Responde formato: {formato}.
         """
         
-        respuesta = cerebro_lia(prompt_fix, "Senior Dev")
-        archivos = re.findall(r"\[\[FILE:\s*(.*?)\]\]\s*\n(.*?)\s*\[\[ENDFILE\]\]", respuesta, re.DOTALL)
-        
-        fix_log = []
-        for ruta_raw, contenido in archivos:
-            ruta = ruta_raw.strip()
-            if " " in ruta: ruta = ruta.split(" ")[0]
-            ruta = ruta.replace("]", "").replace("[", "")
-            contenido_limpio = contenido.replace("```c", "").replace("```", "").strip()
-            
-            if len(contenido_limpio) < 10: continue
+        respuesta = ejecutar_en_loop(cerebro_lia(prompt_fix, "Senior Dev"))
+        cambios = aplicar_respuesta_fix(respuesta, archivos, ventanas)
+
+        # Subimos todo el fix en un commit
+        fix_log = subir_cambios_github(cambios, msg="🚑 Fix Quirúrgico por Lia") if cambios else []
+        if commit_fallido(fix_log): raise RuntimeError(fix_log[0])  # el trabajo queda en "error", no en "ok"
+        for res in fix_log: logger.info(f"✅ Fix Aplicado: {res}")
 
-            # Subimos el fix
-            res = subir_archivo_github(ruta, contenido_limpio, msg="🚑 Fix Quirúrgico por Lia")
-            fix_log.append(res)
-            logger.info(f"✅ Fix Aplicado: {res}")
-            
         if fix_log:
             notificar_telegram("✅ **Corrección Aplicada:**\n" + "\n".join(fix_log) + "\n*Respetando lógica original. Recompilando...*")
+        return fix_log
 
     # --- PING DE VIDA (HEAD) ---
     def do_HEAD(self):
@@ -783,6 +2610,25 @@ class WebhookHandler(BaseHTTPRequestHandler):
 
     # --- LA PARTE VISUAL NUEVA (GET) ---
     def do_GET(self):
+        if self.path.rstrip("/") == "/ready":
+            listo = bot_listo.is_set()
+            return self._responder_json({"listo": listo, "arranque": tiempos_arranque}, 200 if listo else 503)
+        if self.path.rstrip("/") == "/metrics":
+            cuerpo = metricas.exportar().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-type", "text/plain; version=0.0.4; charset=utf-8")
+            self.end_headers()
+            return self.wfile.write(cuerpo)
+
+        # Estado de los trabajos de auto-fix: /jobs y /jobs/<id> (exponen firmas y resultados: solo con el token del CI)
+        if self.path.rstrip("/") == "/jobs" or self.path.startswith("/jobs/"):
+            if not self._token_ci_valido(): return self._responder_json({"error": "no autorizado"}, 401)
+        if self.path.rstrip("/") == "/jobs":
+            return self._responder_json(estado_compartido.trabajos())
+        if self.path.startswith("/jobs/"):
+            trabajo = estado_compartido.trabajos(self.path[len("/jobs/"):].strip("/"))
+            return self._responder_json(trabajo[0] if trabajo else {"error": "trabajo no encontrado"}, 200 if trabajo else 404)
+
         self.send_response(200)
         self.send_header('Content-type', 'text/html; charset=utf-8')
         self.end_headers()
@@ -856,8 +2702,29 @@ class WebhookHandler(BaseHTTPRequestHandler):
         """
         self.wfile.write(html.encode('utf-8'))
 
+    def _recibir_update_telegram(self):
+        """Modo webhook: Telegram POSTea cada update acá. Va a la cola de la Application y se
+        responde 200 al instante; los handlers corren en el loop del bot como con polling."""
+        dado = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not TELEGRAM_WEBHOOK_SECRETO or not hmac.compare_digest(dado.encode(), TELEGRAM_WEBHOOK_SECRETO.encode()):
+            return self._responder_json({"error": "secreto inválido"}, 403)
+        if not (app and global_app_loop and bot_listo.is_set()):
+            return self._responder_json({"error": "bot no listo"}, 503)  # Telegram reintenta
+        try:
+            datos = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            update = Update.de_json(datos, app.bot)
+        except Exception as e:
+            return self._responder_json({"error": str(e)}, 400)
+        global_app_loop.call_soon_threadsafe(app.update_queue.put_nowait, update)
+        metricas.sumar("lia_webhook_updates_total")
+        self._responder_json({"ok": True})
+
     # --- LA PARTE FUNCIONAL ORIGINAL (POST) ---
     def do_POST(self):
+        if self.path.rstrip("/") == WEBHOOK_RUTA: return self._recibir_update_telegram()
+        # Este POST termina en commits hechos por el LLM: sin CI_WEBHOOK_TOKEN configurado queda cerrado
+        if not CI_WEBHOOK_TOKEN: return self._responder_json({"error": "CI_WEBHOOK_TOKEN no configurado"}, 503)
+        if not self._token_ci_valido(): return self._responder_json({"error": "no autorizado"}, 401)
         try:
             content_length = int(self.headers['Content-Length'])
             post_bytes = self.rfile.read(content_length)
@@ -866,8 +2733,14 @@ class WebhookHandler(BaseHTTPRequestHandler):
             # 1. TEXTO PLANO (CURL DEL ACTION)
             if not post_str.strip().startswith("{"):
                 if "error" in post_str.lower() or "failed" in post_str.lower() or "fatal" in post_str.lower():
-                    self.procesar_error_github(post_str)
+                    # El fix (GitHub + LLM + commits) va a la cola; el CI recibe 202 al instante
+                    id_trabajo, duplicado = encolar_fix(post_str)
+                    if not id_trabajo:
+                        return self._responder_json({'status': 'busy'}, 503)
+                    estado = 'duplicate' if duplicado else 'queued'
+                    return self._responder_json({'status': estado, 'job': id_trabajo, 'url': f'/jobs/{id_trabajo}'}, 202)
                 elif "exito" in post_str.lower() or "success" in post_str.lower():
+                    limpiar_historial_fixes()
                     notificar_telegram(f"🎉 **¡COMPILACIÓN EXITOSA!**\nLa ROM está lista y funcionando.")
 
             # 2. JSON (WEBHOOK NATIVO)
@@ -883,8 +2756,10 @@ class WebhookHandler(BaseHTTPRequestHandler):
 # --- ¡IMPORTANTE! ESTA FUNCIÓN VA PEGADA A LA IZQUIERDA (SIN ESPACIOS) ---
 def run_server():
     port = int(os.environ.get("PORT", 8080))
-    server = HTTPServer(('0.0.0.0', port), WebhookHandler)
+    # Un hilo por request: los HEAD de UptimeRobot no esperan a nadie
+    server = ThreadingHTTPServer(('0.0.0.0', port), WebhookHandler)
     logger.info(f"👂 Webhook activo en puerto {port}")
+    if not CI_WEBHOOK_TOKEN: logger.warning("⚠️ CI_WEBHOOK_TOKEN sin configurar: los logs del CI (POST /) y /jobs responden 503/401")
     server.serve_forever()
         
 # --- HANDLERS TEXTO (RESTAURADOS) ---
@@ -892,23 +2767,22 @@ async def recibir_archivo(u, c):
     if u.message.document.file_size < 1e6:
         f = await c.bot.get_file(u.message.document.file_id)
         txt = (await f.download_as_bytearray()).decode()
-        global ultimo_codigo_leido; ultimo_codigo_leido = txt
-        await u.message.reply_text(cerebro_lia(f"Analiza:\n{txt}", "User"), parse_mode="Markdown")
+        sesion_del_chat(u).recordar_codigo(txt)
+        await u.message.reply_text(await cerebro_lia(f"Analiza:\n{txt}", "User"), parse_mode="Markdown")
 
 async def chat_texto(u, c):
     await u.message.reply_chat_action("typing")
     user_msg = u.message.text
     
-    resp = cerebro_lia(user_msg, u.effective_user.first_name)
+    vivo = MensajeEnVivo(u.message)
+    resp = await cerebro_lia(user_msg, u.effective_user.first_name, al_avanzar=vivo.actualizar)
     msgs_log = []
     
     # 1. Borrados
-    borrados = re.findall(r"\[\[DELETE:\s*(.*?)\]\]", resp)
-    for ruta in borrados:
-        res = borrar_archivo_github(ruta.strip())
-        msgs_log.append(res)
+    borrados = [ruta.strip() for ruta in re.findall(r"\[\[DELETE:\s*(.*?)\]\]", resp)]
 
     # 2. Ediciones
+    cambios = []
     archivos = re.findall(r"\[\[FILE:\s*(.*?)\]\]\s*\n(.*?)\s*\[\[ENDFILE\]\]", resp, re.DOTALL)
     for ruta_raw, contenido in archivos:
         ruta = ruta_raw.strip().split(" ")[0].replace("]","").replace("[","")
@@ -918,23 +2792,54 @@ async def chat_texto(u, c):
              msgs_log.append(f"⚠️ Ignorado {ruta}: Código incompleto.")
              continue
 
-        res = subir_archivo_github(ruta, contenido_limpio, msg=f"Lia Auto: {ruta}")
-        msgs_log.append(f"🛠️ {res}")
+        cambios.append((ruta, contenido_limpio))
         resp = resp.replace(f"[[FILE: {ruta_raw}]]\n{contenido}\n[[ENDFILE]]", f"📄 *[{ruta} procesado]*")
 
-    await u.message.reply_text(resp, parse_mode="Markdown")
+    # 3. Un solo commit para ediciones + borrados
+    if cambios or borrados:
+        rutas = ", ".join([r for r, _ in cambios] + borrados)
+        resultados = await asyncio.to_thread(subir_cambios_github, cambios, borrados, msg=f"Lia Auto: {rutas}")
+        msgs_log.extend(r if r.startswith(("🗑️", "⚠️", "❌")) else f"🛠️ {r}" for r in resultados)
+
+    await vivo.cerrar(resp)
     if msgs_log: await u.message.reply_text("\n".join(msgs_log))
 
-# --- MAIN (CON PAUSA ANTI-CONFLICTO) ---
+tiempos_arranque["modulo"] = time.perf_counter() - T_ARRANQUE
+metricas.registrar_lectura("lia_arranque_seconds", "gauge",
+                           lambda: [({"fase": f}, round(v, 4)) for f, v in list(tiempos_arranque.items())])
+
+async def servir_webhook(app):
+    """En vez de run_polling: Telegram empuja los updates a WEBHOOK_RUTA del servidor HTTP.
+    Varias réplicas pueden quedar detrás del mismo URL (getUpdates solo admite un consumidor)."""
+    await app.initialize()
+    await post_init(app)  # run_polling lo llama solo; acá no
+    await app.bot.set_webhook(f"{TELEGRAM_WEBHOOK_URL.rstrip('/')}{WEBHOOK_RUTA}", secret_token=TELEGRAM_WEBHOOK_SECRETO,
+                              allowed_updates=Update.ALL_TYPES)
+    await app.start()
+    logger.info(f"🪝 Webhook de Telegram: {TELEGRAM_WEBHOOK_URL.rstrip('/')}{WEBHOOK_RUTA}")
+    parar = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(sig, parar.set)
+    try: await parar.wait()
+    finally:
+        await app.stop()
+        await app.shutdown()
+
+def reporte_arranque():
+    fases = ("imports", "modulo", "listo")
+    linea = " ".join(f"{f}={tiempos_arranque[f]:.2f}s" for f in fases if f in tiempos_arranque)
+    clientes = " ".join(f"{k[8:]}={v:.2f}s" for k, v in list(tiempos_arranque.items()) if k.startswith("cliente_"))
+    return linea + (f" | clientes: {clientes}" if clientes else "")
+
+# --- MAIN ---
 if __name__ == '__main__':
-    print("⏳ Esperando limpieza de sockets (2s)...")
-    time.sleep(2)
-
-    # Iniciar servidor web (para que Render no se duerma)
+    # Sin pausa fija: si quedó otra instancia escuchando, run_polling reintenta el Conflict solo.
+    # Iniciar servidor web (para que Render no se duerma); /ready responde 503 hasta que el bot escucha
     threading.Thread(target=run_server, daemon=True).start()
     
     # Construir la aplicación
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).post_init(post_init).build()
+    # Updates en paralelo: cada chat tiene su sesión y su lock, así que no se pisan entre sí
+    app = ApplicationBuilder().token(TELEGRAM_TOKEN).post_init(post_init).concurrent_updates(BOT_CONCURRENCIA).build()
     
     # --- LISTA DE COMANDOS ---
     cmds = [
@@ -945,6 +2850,7 @@ if __name__ == '__main__':
         ("assets", cmd_assets),
         ("arbol", cmd_arbol), 
         ("leer", cmd_leer),
+        ("restaurar", cmd_restaurar),
         ("run", cmd_run), 
         ("codear", cmd_codear), 
         ("tarea", cmd_tarea), 
@@ -952,6 +2858,7 @@ if __name__ == '__main__':
         ("hecho", cmd_hecho),
         ("review", cmd_review), # Auditoría de código
         ("gba", cmd_gba),       # Consulta técnica
+        ("voz", cmd_voz),       # Texto a nota de voz
         ("readme", cmd_readme), # Documentación auto
         ("readme", cmd_readme), # Documentación auto
         ("debug", cmd_debug_video), # <--- AGREGA ESTA LÍNEA
@@ -959,20 +2866,22 @@ if __name__ == '__main__':
     
     # Registramos los comandos de barra (/)
     for c, f in cmds: 
-        app.add_handler(CommandHandler(c, f))
+        app.add_handler(CommandHandler(c, medir_handler(c, en_sesion(f))))
     
     # --- HANDLERS DE MENSAJES (Sin comando /) ---
     
     # 1. Para archivos (Código, zips, etc)
-    app.add_handler(MessageHandler(filters.Document.ALL, recibir_archivo))
+    app.add_handler(MessageHandler(filters.Document.ALL, medir_handler("archivo", en_sesion(recibir_archivo))))
     
     # 2. Para FOTOS (El nuevo convertidor de Sprites) 🎨
-    app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    app.add_handler(MessageHandler(filters.PHOTO, medir_handler("foto", en_sesion(handle_photo))))
     
     # 3. Para texto normal (Chat con IA) - Este siempre va al final de los handlers
-    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), chat_texto))
+    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), medir_handler("chat", en_sesion(chat_texto))))
 
     print("🤖 Lia v8.0 Artista está lista...")
     
     # Esto mantiene al bot corriendo
-    app.run_polling()
+    if TELEGRAM_WEBHOOK_URL: asyncio.run(servir_webhook(app))
+    else: app.run_polling()
+    estado_compartido.liberar()  # la otra réplica toma los cron sin esperar al TTL
@@ -0,0 +1,124 @@
+"""Round-trip y formato de la compresión LZ77 (0x10) / RLE (0x30) compatible con la BIOS GBA."""
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lia_bot import comprimir_lz77_gba, comprimir_rle_gba, descomprimir_lz77_gba, descomprimir_rle_gba
+
+
+def tokens_lz77(blob):
+    """Recorre el stream LZ77 y devuelve [(largo, distancia)] de cada referencia hacia atrás"""
+    n = int.from_bytes(blob[1:4], "little")
+    refs, escritos, i = [], 0, 4
+    while escritos < n:
+        flag = blob[i]; i += 1
+        for bit in range(8):
+            if escritos >= n: break
+            if flag & (0x80 >> bit):
+                b1, b2 = blob[i], blob[i + 1]; i += 2
+                largo, disp = (b1 >> 4) + 3, (((b1 & 0xF) << 8) | b2) + 1
+                refs.append((largo, disp))
+                escritos += largo
+            else:
+                i += 1
+                escritos += 1
+    return refs
+
+
+def bloques_rle(blob):
+    """[(es_run, largo)] de cada bloque del stream RLE"""
+    n = int.from_bytes(blob[1:4], "little")
+    bloques, escritos, i = [], 0, 4
+    while escritos < n:
+        flag = blob[i]; i += 1
+        if flag & 0x80:
+            largo = (flag & 0x7F) + 3
+            i += 1
+        else:
+            largo = (flag & 0x7F) + 1
+            i += largo
+        bloques.append((bool(flag & 0x80), largo))
+        escritos += largo
+    return bloques
+
+
+def azar(n, semilla=1):
+    return random.Random(semilla).randbytes(n)
+
+
+CASOS = [b"", b"\x00", b"ab", b"aaa", b"abc", bytes(1000), b"ab" * 500, azar(3000), azar(64) * 40]
+COMPRESORES = [(comprimir_lz77_gba, descomprimir_lz77_gba, 0x10), (comprimir_rle_gba, descomprimir_rle_gba, 0x30)]
+
+
+@pytest.mark.parametrize("comprimir, descomprimir, tipo", COMPRESORES)
+@pytest.mark.parametrize("datos", CASOS)
+def test_round_trip_y_cabecera(comprimir, descomprimir, tipo, datos):
+    blob = comprimir(datos)
+    assert blob[0] == tipo
+    assert int.from_bytes(blob[1:4], "little") == len(datos)
+    assert len(blob) % 4 == 0  # la BIOS lee el origen alineado a 32 bits
+    assert descomprimir(blob) == datos
+
+
+@pytest.mark.parametrize("datos", [b"", b"x", b"xy"])
+def test_entradas_cortas(datos):
+    # Menos de 3 bytes no alcanza para una referencia ni para un run: todo va como literal
+    assert tokens_lz77(comprimir_lz77_gba(datos)) == []
+    assert bloques_rle(comprimir_rle_gba(datos)) == ([(False, len(datos))] if datos else [])
+    assert len(comprimir_lz77_gba(datos)) == (8 if datos else 4)
+
+
+@pytest.mark.parametrize("largo, esperado", [
+    (129, [(True, 129)]),
+    (130, [(True, 130)]),
+    (131, [(True, 130), (False, 1)]),
+    (133, [(True, 130), (True, 3)]),
+])
+def test_rle_limite_de_run(largo, esperado):
+    datos = b"\x07" * largo
+    blob = comprimir_rle_gba(datos)
+    assert bloques_rle(blob) == esperado
+    assert descomprimir_rle_gba(blob) == datos
+
+
+def test_rle_literales_largos_se_parten_en_128():
+    datos = azar(300, semilla=3)
+    blob = comprimir_rle_gba(datos)
+    assert descomprimir_rle_gba(blob) == datos
+    assert all(largo <= 128 for es_run, largo in bloques_rle(blob) if not es_run)
+
+
+def test_lz77_distancia_maxima_4096():
+    patron = azar(18, semilla=7)
+    datos = patron + azar(4096 - len(patron), semilla=8) + patron
+    blob = comprimir_lz77_gba(datos)
+    refs = tokens_lz77(blob)
+    assert (18, 4096) in refs
+    assert all(disp <= 4096 for _, disp in refs)
+    assert descomprimir_lz77_gba(blob) == datos
+
+
+def test_lz77_no_referencia_mas_alla_de_4096():
+    patron = azar(18, semilla=7)
+    datos = patron + azar(4097 - len(patron), semilla=8) + patron
+    blob = comprimir_lz77_gba(datos)
+    assert all(disp <= 4096 for _, disp in tokens_lz77(blob))
+    assert descomprimir_lz77_gba(blob) == datos
+
+
+@pytest.mark.parametrize("datos", [bytes(500), b"\xAA" * 37, b"ab" * 300, bytes([1, 1, 1, 2]) * 100])
+def test_lz77_vram_nunca_usa_distancia_1(datos):
+    blob = comprimir_lz77_gba(datos)
+    assert all(disp >= 2 for _, disp in tokens_lz77(blob))
+    assert descomprimir_lz77_gba(blob) == datos
+
+
+def test_lz77_wram_si_usa_distancia_1():
+    datos = bytes(500)
+    blob = comprimir_lz77_gba(datos, vram=False)
+    assert any(disp == 1 for _, disp in tokens_lz77(blob))
+    assert descomprimir_lz77_gba(blob) == datos
@@ -0,0 +1,67 @@
+"""Anti-bucle y cola del auto-fix compartidos entre réplicas: dos EstadoCompartido sobre el mismo SQLite."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import lia_bot as L
+
+
+@pytest.fixture
+def replicas(tmp_path):
+    db = str(tmp_path / "estado.db")
+    return L.EstadoCompartido(db, "replica-a", 30), L.EstadoCompartido(db, "replica-b", 30)
+
+
+def test_mismo_reporte_en_otra_replica_es_repetido(replicas):
+    a, b = replicas
+    assert a.registrar_intento_fix("f1", "f1:src/main.c@abc", ["src/main.c"]) == (None, False)
+    motivo, _ = b.registrar_intento_fix("f1", "f1:src/main.c@abc", ["src/main.c"])
+    assert motivo.startswith("reporte repetido")
+
+
+def test_backoff_por_archivo_vale_en_todas_las_replicas(replicas):
+    a, b = replicas
+    a.registrar_intento_fix("f1", "f1:src/main.c@abc", ["src/main.c"])
+    motivo, _ = b.registrar_intento_fix("f2", "f2:src/main.c@def", ["src/main.c"])
+    assert motivo.startswith("backoff en src/main.c")
+
+
+def test_tope_de_intentos_avisa_una_sola_vez(replicas, monkeypatch):
+    a, b = replicas
+    monkeypatch.setattr(L, "AUTOFIX_BACKOFF_SEG", 0)
+    for i in range(L.AUTOFIX_MAX_INTENTOS):
+        assert (a, b)[i % 2].registrar_intento_fix("f1", f"f1:src/main.c@{i}", ["src/main.c"]) == (None, False)
+    assert b.registrar_intento_fix("f1", "f1:src/main.c@x", ["src/main.c"])[1] is True
+    motivo, avisar = a.registrar_intento_fix("f1", "f1:src/main.c@y", ["src/main.c"])
+    assert motivo.startswith("límite") and avisar is False
+
+
+def test_build_verde_limpia_para_todas(replicas):
+    a, b = replicas
+    a.registrar_intento_fix("f1", "f1:src/main.c@abc", ["src/main.c"])
+    b.limpiar_fixes()
+    assert a.registrar_intento_fix("f1", "f1:src/main.c@abc", ["src/main.c"]) == (None, False)
+
+
+def test_trabajo_activo_se_reusa_y_se_ve_desde_otra_replica(replicas):
+    a, b = replicas
+    id_trabajo, duplicado = a.encolar_trabajo("f1", cola_max=5)
+    assert id_trabajo and not duplicado
+    assert b.encolar_trabajo("f1", cola_max=5) == (id_trabajo, True)
+    a.actualizar_trabajo(id_trabajo, estado="ok", fin=1.0, resultado=["Actualizado: `src/main.c`"])
+    (trabajo,) = b.trabajos(id_trabajo)
+    assert trabajo["estado"] == "ok" and trabajo["instancia"] == "replica-a"
+    assert trabajo["resultado"] == ["Actualizado: `src/main.c`"]
+    # Terminado: el mismo error vuelve a encolarse
+    assert b.encolar_trabajo("f1", cola_max=5)[0] not in (None, id_trabajo)
+
+
+def test_cola_llena_es_por_replica(replicas):
+    a, b = replicas
+    assert a.encolar_trabajo("f1", cola_max=1)[0]
+    assert a.encolar_trabajo("f2", cola_max=1) == (None, False)
+    assert b.encolar_trabajo("f2", cola_max=1)[0]
+    assert [t["firma"] for t in a.trabajos()] == ["f1", "f2"]
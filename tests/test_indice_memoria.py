@@ -0,0 +1,65 @@
+"""Sincronización incremental de IndiceMemoria contra una tabla 'memoria' en memoria."""
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import lia_bot as L
+
+
+class TablaMemoria:
+    """Lo mínimo de supabase-py que usa sincronizar(): select/order/gte/range/execute"""
+    def __init__(self, filas):
+        self.filas = filas
+
+    def table(self, nombre):
+        return Consulta(self.filas)
+
+
+class Consulta:
+    def __init__(self, filas):
+        self.filas, self.desde, self.rango = filas, None, None
+
+    def select(self, *_): return self
+    def order(self, *_): return self
+    def gte(self, col, valor): self.desde = valor; return self
+    def range(self, a, b): self.rango = (a, b + 1); return self
+
+    def execute(self):
+        filas = sorted((f for f in self.filas if self.desde is None or f["created_at"] >= self.desde), key=lambda f: f["created_at"])
+        return SimpleNamespace(data=filas[slice(*self.rango)])
+
+
+def fila(i, t, texto):
+    return {"id": i, "contenido": texto, "created_at": f"2026-01-01T00:00:{t:02d}"}
+
+
+@pytest.fixture
+def remoto(monkeypatch):
+    filas = [fila(1, 1, "paletas de sprites en OAM")]
+    monkeypatch.setattr(L, "supabase", TablaMemoria(filas))
+    return filas
+
+
+def test_fila_remota_anterior_a_un_guardado_local_se_sincroniza(tmp_path, remoto):
+    indice = L.IndiceMemoria(str(tmp_path / "memoria.db"))
+    indice.sincronizar()
+    # Otra réplica guarda B (t=2) y nosotros guardamos C (t=3) antes del próximo sync
+    remoto.append(fila(2, 2, "scroll de fondos con BG0HOFS"))
+    local = fila(3, 3, "interrupciones de VBlank")
+    remoto.append(local)
+    indice.agregar([local])  # lo mismo que hace guardar_aprendizaje
+    indice.sincronizar()
+    assert indice.buscar("BG0HOFS", limite=1) == ["scroll de fondos con BG0HOFS"]
+
+
+def test_sync_incremental_no_duplica(tmp_path, remoto):
+    indice = L.IndiceMemoria(str(tmp_path / "memoria.db"))
+    indice.sincronizar()
+    remoto.append(fila(2, 1, "empate de created_at con otra fila"))
+    indice.sincronizar()
+    indice.sincronizar()
+    assert indice.db.execute("SELECT COUNT(*) FROM memoria_sync").fetchone()[0] == 2